@@ -0,0 +1,73 @@
+"""
+Бенчмарк матчинга снапшота от сырого тела ответа. Матчер в обеих строках один и тот же —
+check_items_in_auctions_per_item + best_per_item; разница только в разборе:
+json.loads всего тела против decode_watched_auctions (regex по id вотчлиста, разбор только этих лотов).
+
+    python bench/bench_matching.py --auctions 100000 --watch 50 --repeat 5
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import track_ah_gsheets as ah  # noqa: E402
+from snapshots import make_auctions  # noqa: E402
+
+
+def best_of(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--auctions", type=int, default=100000)
+    ap.add_argument("--watch", type=int, default=50, help="сколько предметов в вотчлисте")
+    ap.add_argument("--repeat", type=int, default=5)
+    args = ap.parse_args()
+
+    auctions = make_auctions(args.auctions)
+    body = json.dumps({"_links": {}, "auctions": auctions}, separators=(",", ":")).encode()
+    # вотчлист — из предметов, которые в снапшоте есть, иначе сравнивать нечего
+    rnd = random.Random(7)
+    present = sorted({a["item"]["id"] for a in auctions})
+    id_map = {i: f"Item {i}" for i in rnd.sample(present, min(args.watch, len(present)))}
+    id_thr = {i: rnd.choice((50.0, 500.0, 2000.0)) for i in id_map}
+
+    parsed = json.loads(body)
+    watched, _ = ah.decode_watched_auctions(body, id_map)
+
+    def match(snapshot):
+        return ah.best_per_item(ah.check_items_in_auctions_per_item(snapshot, id_map, id_thr))
+
+    ref = match(parsed)
+    assert ref, "watchlist matched nothing — nothing to compare"
+    assert match({"auctions": watched}) == ref, "prefiltered rows disagree with the full parse"
+
+    t_loads = best_of(lambda: json.loads(body), args.repeat)
+    t_prefilter = best_of(lambda: ah.decode_watched_auctions(body, id_map), args.repeat)
+    t_match_full = best_of(lambda: match(parsed), args.repeat)
+    t_match_watched = best_of(lambda: match({"auctions": watched}), args.repeat)
+    t_full = t_loads + t_match_full
+    t_fast = t_prefilter + t_match_watched
+
+    print(f"auctions={args.auctions} watched items={len(id_map)} watched lots={len(watched)} "
+          f"body={len(body) / 1e6:.1f} MB matches={len(ref)}")
+    print(f"json.loads                : {t_loads * 1000:8.1f} ms")
+    print(f"row match, all lots       : {t_match_full * 1000:8.1f} ms  ({args.auctions / t_match_full:12,.0f} auc/s)")
+    print(f"decode_watched_auctions   : {t_prefilter * 1000:8.1f} ms")
+    print(f"row match, watched lots   : {t_match_watched * 1000:8.1f} ms")
+    print(f"end to end, json.loads    : {t_full * 1000:8.1f} ms")
+    print(f"end to end, prefilter     : {t_fast * 1000:8.1f} ms  x{t_full / t_fast:.1f} (весь выигрыш — от разбора)")
+
+
+if __name__ == "__main__":
+    main()
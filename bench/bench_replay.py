@@ -0,0 +1,85 @@
+"""
+Бенчмарк архива снапшотов и RUN_MODE=replay: синтетическая «неделя» почасовых сканов пишется
+в SnapshotArchive, затем весь конвейер (матчинг, группировка, сборка сообщений) гоняется по архиву.
+
+    python bench/bench_replay.py --passes 168 --realms 8 --auctions 10000
+    DECODE_WORKERS=2 python bench/bench_replay.py
+
+Отчёт: размер архива (сырые/сжатые байты), время записи и replay, мс на снапшот, peak RSS.
+"""
+import argparse
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from email.utils import formatdate
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("AH_STATE_DIR", tempfile.mkdtemp(prefix="ah_bench_"))
+
+import track_ah_gsheets as ah  # noqa: E402
+import snapshots  # noqa: E402
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--passes", type=int, default=168, help="архивных проходов (168 — неделя почасовых сканов)")
+    ap.add_argument("--realms", type=int, default=8)
+    ap.add_argument("--auctions", type=int, default=10000, help="аукционов на connected realm")
+    ap.add_argument("--commodities", type=int, default=20000)
+    ap.add_argument("--items", type=int, default=5000)
+    ap.add_argument("--watch", type=int, default=100)
+    ap.add_argument("--variants", type=int, default=4, help="разных тел на реалм (генерация снапшотов дорогая)")
+    args = ap.parse_args()
+
+    crs = [1000 + i for i in range(args.realms)]
+    bodies = {}
+    for v in range(args.variants):
+        for cr in crs:
+            doc = snapshots.realm_snapshot(cr, args.auctions, args.items)
+            doc["auctions"] = snapshots.make_auctions(args.auctions, args.items, seed=cr * 100 + v)
+            bodies[(cr, v)] = json.dumps(doc, separators=(",", ":")).encode("utf-8")
+        doc = {"auctions": snapshots.make_commodities(args.commodities, seed=v)}
+        bodies[("commodities", v)] = json.dumps(doc, separators=(",", ":")).encode("utf-8")
+
+    # 1) пишем архив: проход в час, у каждого снапшота свой Last-Modified — дедупликации нет
+    archive = ah.SnapshotArchive()
+    start = time.time() - args.passes * 3600
+    raw = packed = 0
+    t0 = time.perf_counter()
+    for p in range(args.passes):
+        ts = start + p * 3600
+        archive.begin_scan(ts)
+        for key in ["commodities"] + crs:
+            body = bodies[(key, p % args.variants)]
+            archive.put(key, body, formatdate(ts - 60, usegmt=True))
+            raw += len(body)
+        archive.flush()
+        packed += archive.written
+    write_sec = time.perf_counter() - t0
+    archive.close()
+
+    # 2) replay по всему архиву
+    rows = snapshots.make_watchlist(args.watch, args.items, name_share=0.0)
+    id_map = {int(k): snapshots.item_name(int(k)) for k, _ in rows}
+    id_thr = {int(k): thr for k, thr in rows}
+    item_cache = ah.ItemCache()
+    n_snaps = args.passes * (args.realms + 1)
+    with open(os.devnull, "w", encoding="utf-8") as out:
+        t0 = time.perf_counter()
+        totals = ah.replay_region((id_map, id_thr, None), item_cache, start - 1, time.time(), out)
+        replay_sec = time.perf_counter() - t0
+    ah.shutdown_decode_pool()
+
+    print()
+    print(f"archive: {n_snaps} snapshots, {raw / 1e6:.0f} MB raw -> {packed / 1e6:.0f} MB zlib "
+          f"(x{raw / max(packed, 1):.1f}), written in {write_sec:.1f}s")
+    print(f"replay (threads={ah.SCAN_CONCURRENCY}, decode workers={ah.DECODE_WORKERS}): {replay_sec:.1f}s, "
+          f"{replay_sec / n_snaps * 1000:.1f} ms/snapshot, {totals['alerts']} alerts -> {totals['messages']} messages "
+          f"| peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
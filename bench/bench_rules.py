@@ -0,0 +1,90 @@
+"""
+Бенчмарк RuleIndex: стоимость матчинга снапшота при растущем числе правил на фиксированном
+наборе предметов. С индексом время на аукцион не зависит от числа правил; для сравнения —
+линейный перебор всех правил предмета.
+
+    python bench/bench_rules.py --auctions 100000 --items 1000 --rules 1500 5000 20000
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+os.environ.setdefault("AH_STATE_DIR", tempfile.mkdtemp(prefix="ah_bench_"))
+
+import track_ah_gsheets as ah  # noqa: E402
+from snapshots import COMMODITY_ITEMS, make_auctions, make_rule_rows  # noqa: E402
+
+REALMS = {1000 + i: [f"synthetic-realm-{1000 + i}-0"] for i in range(20)}
+
+
+def linear_match(rules: ah.RuleIndex, realm_of: dict):
+    """
+    Эталон без индекса: для каждого лота перебираем все правила его предмета.
+    """
+    def match(item_id, cr_id, item):
+        feats = ah.auction_features(item)
+        best = None
+        for row, (thr, need, realms, label) in enumerate(rules.rules.get(item_id, ())):
+            if realms and cr_id not in {realm_of.get(n) for n in realms}:
+                continue
+            if need <= feats:
+                key = (bool(realms), len(need), thr, row)
+                if best is None or key > best[0]:
+                    best = (key, thr, label)
+        return (best[1], best[2]) if best else None
+    return match
+
+
+def best_of(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--auctions", type=int, default=100000)
+    ap.add_argument("--items", type=int, default=1000, help="предметов в вотчлисте (фиксировано)")
+    ap.add_argument("--rules", type=int, nargs="+", default=[1500, 5000, 10000, 20000])
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args()
+
+    snapshot = {"auctions": make_auctions(args.auctions)}
+    items = list(range(COMMODITY_ITEMS + 1, COMMODITY_ITEMS + 1 + args.items))
+    realm_names = [n for names in REALMS.values() for n in names]
+    realm_of = {n: cr for cr, names in REALMS.items() for n in names}
+    cache = ah.ItemCache()
+    cr_id = next(iter(REALMS))
+
+    print(f"auctions={args.auctions} watched items={args.items}")
+    for n_rules in args.rules:
+        rows = make_rule_rows(n_rules, items, realm_names)
+        id_map = {i: f"Item {i}" for i in items}
+        id_thr = {i: 0.0 for i in items}
+        rules = ah.compile_rules(rows, cache, id_map, id_thr)
+        rules.bind_realms(REALMS)
+
+        indexed = ah.check_items_with_rules(snapshot, id_map, rules, cr_id)
+        fast_match = rules.match
+        rules.match = linear_match(rules, realm_of)
+        try:
+            assert ah.check_items_with_rules(snapshot, id_map, rules, cr_id) == indexed, \
+                "RuleIndex disagrees with linear rule scan"
+            t_linear = best_of(lambda: ah.check_items_with_rules(snapshot, id_map, rules, cr_id), args.repeat)
+        finally:
+            rules.match = fast_match
+        t_index = best_of(lambda: ah.check_items_with_rules(snapshot, id_map, rules, cr_id), args.repeat)
+
+        print(f"rules={len(rules):6d}: indexed {t_index * 1e9 / args.auctions:7.0f} ns/auction "
+              f"| linear {t_linear * 1e9 / args.auctions:7.0f} ns/auction "
+              f"| {len(indexed)} matches")
+
+
+if __name__ == "__main__":
+    main()
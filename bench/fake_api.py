@@ -0,0 +1,209 @@
+"""
+Локальный стенд Blizzard API для офлайн-бенчмарков: отвечает на те же эндпоинты,
+что дёргает track_ah_gsheets.py (token, connected-realm index/detail, item, search/item,
+connected-realm auctions, auctions/commodities), с настраиваемой задержкой.
+
+    python bench/fake_api.py --port 8765 --realms 20 --auctions 20000 --latency-ms 50
+
+Скрипт печатает строку "READY <base_url>", когда готов принимать запросы.
+/__stats отдаёт счётчики запросов, байт и отданных аукционов.
+Для тестов HTTP-слоя: revoke() отзывает выданный токен (дальше на него — 401), fail_next() ставит
+в очередь ответы-ошибки (429 с Retry-After, 5xx) для ближайших GET.
+"""
+import argparse
+import json
+import re
+import threading
+import time
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import snapshots
+
+
+class FakeBlizzard:
+    def __init__(self, realms: int, auctions_per_realm: int, n_items: int, commodities: int,
+                 latency_ms: float = 0.0):
+        self.cr_ids = [1000 + i for i in range(realms)]
+        self.auctions_per_realm = auctions_per_realm
+        self.n_items = n_items
+        self.commodities = commodities
+        self.latency = latency_ms / 1000.0
+        self.last_modified = formatdate(time.time(), usegmt=True)
+        self.base = ""
+        self._bodies = {}
+        self._lock = threading.Lock()
+        self.stats = {"requests": 0, "not_modified": 0, "bytes": 0, "auctions_served": 0, "by_endpoint": {}}
+        self.tokens_issued = 0
+        self.revoked = set()
+        self._faults = []  # (status, заголовки) — ответы ближайшим GET вместо обычных
+
+    def issue_token(self) -> str:
+        with self._lock:
+            self.tokens_issued += 1
+            return f"fake-token-{self.tokens_issued}"
+
+    def revoke(self):
+        with self._lock:
+            self.revoked.add(f"fake-token-{self.tokens_issued}")
+
+    def fail_next(self, status: int, n: int = 1, retry_after: str = None):
+        headers = {"Retry-After": retry_after} if retry_after is not None else {}
+        with self._lock:
+            self._faults.extend([(status, headers)] * n)
+
+    def next_fault(self):
+        with self._lock:
+            return self._faults.pop(0) if self._faults else None
+
+    def body(self, key, build):
+        # снапшоты сериализуем один раз: стенд не должен быть узким местом бенчмарка
+        with self._lock:
+            if key not in self._bodies:
+                doc = build()
+                self._bodies[key] = (json.dumps(doc, separators=(",", ":")).encode("utf-8"),
+                                     len(doc.get("auctions", [])))
+            return self._bodies[key]
+
+    def count(self, endpoint: str, nbytes: int, auctions: int = 0, not_modified: bool = False):
+        with self._lock:
+            st = self.stats
+            st["requests"] += 1
+            st["bytes"] += nbytes
+            st["auctions_served"] += auctions
+            st["not_modified"] += int(not_modified)
+            st["by_endpoint"][endpoint] = st["by_endpoint"].get(endpoint, 0) + 1
+
+
+def make_handler(fake: FakeBlizzard):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, *args):
+            pass
+
+        def _send(self, status: int, body: bytes = b"", headers=None):
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json;charset=UTF-8")
+            self.send_header("Content-Length", str(len(body)))
+            for k, v in (headers or {}).items():
+                self.send_header(k, v)
+            self.end_headers()
+            if body:
+                self.wfile.write(body)
+
+        def _json(self, endpoint: str, doc, status: int = 200):
+            body = json.dumps(doc).encode("utf-8")
+            fake.count(endpoint, len(body))
+            self._send(status, body)
+
+        def _auctions(self, endpoint: str, key, build):
+            if self.headers.get("If-Modified-Since") == fake.last_modified:
+                fake.count(endpoint, 0, not_modified=True)
+                self._send(304)
+                return
+            body, n = fake.body(key, build)
+            fake.count(endpoint, len(body), auctions=n)
+            self._send(200, body, {"Last-Modified": fake.last_modified})
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            self.rfile.read(length)
+            if urlparse(self.path).path == "/token":
+                self._json("token", {"access_token": fake.issue_token(), "token_type": "bearer", "expires_in": 86399})
+            else:
+                self._send(404)
+
+        def do_GET(self):
+            if fake.latency:
+                time.sleep(fake.latency)
+            u = urlparse(self.path)
+            path, qs = u.path, parse_qs(u.query)
+
+            if path == "/__stats":
+                self._send(200, json.dumps(fake.stats).encode("utf-8"))
+                return
+            auth = self.headers.get("Authorization", "")
+            if auth.startswith("Bearer ") and auth[len("Bearer "):] in fake.revoked:
+                fake.count("unauthorized", 0)
+                self._send(401)
+                return
+            fault = fake.next_fault()
+            if fault is not None:
+                fake.count("fault", 0)
+                self._send(fault[0], b"", fault[1])
+                return
+            if path == "/data/wow/connected-realm/index":
+                self._json("cr_index", {"connected_realms": [
+                    {"href": f"{fake.base}/data/wow/connected-realm/{cr}?namespace=dynamic-eu"} for cr in fake.cr_ids
+                ]})
+                return
+            m = re.fullmatch(r"/data/wow/connected-realm/(\d+)", path)
+            if m:
+                cr = int(m.group(1))
+                self._json("cr_detail", {"id": cr, "realms": [
+                    {"id": cr * 10 + i, "slug": f"synthetic-realm-{cr}-{i}", "name": f"Synthetic {cr}-{i}"}
+                    for i in range(1 + cr % 3)
+                ]})
+                return
+            m = re.fullmatch(r"/data/wow/connected-realm/(\d+)/auctions", path)
+            if m:
+                cr = int(m.group(1))
+                if cr not in fake.cr_ids:
+                    self._send(404)
+                    return
+                self._auctions("auctions", cr, lambda: snapshots.realm_snapshot(
+                    cr, fake.auctions_per_realm, fake.n_items, fake.base))
+                return
+            if path == "/data/wow/auctions/commodities":
+                self._auctions("commodities", "commodities",
+                               lambda: snapshots.commodities_snapshot(fake.commodities, fake.base))
+                return
+            m = re.fullmatch(r"/data/wow/item/(\d+)", path)
+            if m:
+                self._json("item", {"id": int(m.group(1)), "name": snapshots.item_name(int(m.group(1)))})
+                return
+            if path == "/data/wow/search/item":
+                name = (qs.get("name.en_US") or [""])[0]
+                m = re.fullmatch(r"Synthetic Item (\d+)", name, flags=re.IGNORECASE)
+                results = []
+                if m:
+                    item_id = int(m.group(1))
+                    results.append({"data": {"id": item_id, "name": {"en_US": snapshots.item_name(item_id)}}})
+                self._json("search", {"page": 1, "pageSize": len(results), "results": results})
+                return
+            self._send(404)
+
+    return Handler
+
+
+def start_server(fake: FakeBlizzard, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    srv = ThreadingHTTPServer((host, port), make_handler(fake))
+    srv.daemon_threads = True
+    fake.base = f"http://{host}:{srv.server_address[1]}"
+    return srv
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=0)
+    ap.add_argument("--realms", type=int, default=20)
+    ap.add_argument("--auctions", type=int, default=20000, help="аукционов на connected realm")
+    ap.add_argument("--items", type=int, default=5000, help="размер каталога предметов")
+    ap.add_argument("--commodities", type=int, default=50000, help="лотов на аукционе товаров")
+    ap.add_argument("--latency-ms", type=float, default=0.0)
+    args = ap.parse_args()
+
+    fake = FakeBlizzard(args.realms, args.auctions, args.items, args.commodities, args.latency_ms)
+    srv = start_server(fake, args.host, args.port)
+    print(f"READY {fake.base}", flush=True)
+    try:
+        srv.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
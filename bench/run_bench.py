@@ -0,0 +1,235 @@
+"""
+Офлайн-прогон main() против локального стенда bench/fake_api.py — без квоты Blizzard,
+Google Sheets и Telegram. Режимы скана задаются теми же ENV, что и в проде:
+
+    SCAN_CONCURRENCY=8 STREAM_AUCTIONS=1 python bench/run_bench.py --realms 30 --auctions 20000
+    python bench/run_bench.py --runs 2          # второй прогон — по тёплому состоянию (304, кэши)
+
+Отчёт: wall time, realms/sec, auctions/sec, совпадения (лучший лот на предмет × снапшот),
+запросы/байты и peak RSS: своего процесса, самого большого из дочерних (пул DECODE_WORKERS)
+и воркеров --workers; total — сумма пиков (верхняя оценка). Пул разбора: DECODE_WORKERS=4 python bench/run_bench.py
+Масштабирование пула: --scale 1,2,4 — по отдельному прогону (свежее состояние) на каждое DECODE_WORKERS.
+В multi-region (REGIONS=eu,us) все регионы ходят в один стенд, а совпадения считаются
+в процессах-шардах и в отчёт не попадают (matches = 0). Так же и с --workers N: main() работает
+координатором (RUN_MODE=coordinator), CR сканируют N процессов RUN_MODE=worker через общую очередь.
+"""
+import argparse
+import json
+import os
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, ".."))
+
+import snapshots  # noqa: E402
+
+
+def start_fake_api(args) -> (subprocess.Popen, str):
+    # стенд — отдельный процесс, чтобы его память и CPU не попадали в замеры main()
+    proc = subprocess.Popen(
+        [sys.executable, os.path.join(HERE, "fake_api.py"),
+         "--realms", str(args.realms), "--auctions", str(args.auctions),
+         "--items", str(args.items), "--commodities", str(args.commodities),
+         "--latency-ms", str(args.latency_ms)],
+        stdout=subprocess.PIPE, text=True,
+    )
+    line = proc.stdout.readline().strip()
+    if not line.startswith("READY "):
+        proc.kill()
+        raise RuntimeError(f"fake API failed to start: {line!r}")
+    return proc, line.split(" ", 1)[1]
+
+
+def start_workers(n: int, state_dir: str) -> list:
+    # воркеры — отдельные процессы со своим состоянием, как на разных машинах; общая у них только очередь
+    procs = []
+    for i in range(n):
+        env = dict(os.environ, RUN_MODE="worker", WORK_WORKER_ID=f"bench-{i}", WORK_IDLE_EXIT_SEC="0",
+                   AH_STATE_DIR=os.path.join(state_dir, f"worker-{i}"))
+        procs.append(subprocess.Popen([sys.executable, os.path.join(HERE, "..", "track_ah_gsheets.py")],
+                                      env=env, stdout=subprocess.DEVNULL))
+    return procs
+
+
+def stop_workers(procs: list):
+    # SIGINT, а не kill: finally в main_worker закрывает пул DECODE_WORKERS, иначе его процессы остаются сиротами
+    for p in procs:
+        p.send_signal(signal.SIGINT)
+    for p in procs:
+        try:
+            p.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            p.kill()
+
+
+def peak_rss_mb(pid: int) -> float:
+    # VmHWM живого процесса (Linux); 0 — недоступно
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return 0.0
+
+
+def scale_runs(args, argv: list):
+    # каждое значение DECODE_WORKERS — отдельный процесс run_bench со своим AH_STATE_DIR
+    rows = []
+    for n in [int(x) for x in args.scale.split(",")]:
+        out = subprocess.run([sys.executable, os.path.abspath(__file__), *argv, "--json"],
+                             env=dict(os.environ, DECODE_WORKERS=str(n)), capture_output=True, text=True, check=True)
+        rows.append(json.loads(out.stdout.strip().splitlines()[-1])[-1])
+    base = rows[0]["wall_sec"]
+    print(f"{'decode workers':>14} {'wall s':>8} {'auctions/s':>12} {'speedup':>8} "
+          f"{'rss MB':>8} {'child MB':>9} {'total MB':>9}")
+    for r in rows:
+        print(f"{r['decode_workers']:>14} {r['wall_sec']:>8.2f} {r['auctions_per_sec']:>12,} "
+              f"{base / r['wall_sec']:>7.2f}x {r['peak_rss_mb']:>8} {r['child_peak_rss_mb']:>9} "
+              f"{r['total_peak_rss_mb']:>9}")
+
+
+def fetch_stats(base: str) -> dict:
+    with urllib.request.urlopen(f"{base}/__stats") as r:
+        return json.loads(r.read())
+
+
+def warm_up(base: str, args):
+    # снапшоты сериализуются стендом лениво — прогреваем, чтобы не мерить генератор
+    for cr in range(1000, 1000 + args.realms):
+        urllib.request.urlopen(f"{base}/data/wow/connected-realm/{cr}/auctions").read()
+    urllib.request.urlopen(f"{base}/data/wow/auctions/commodities").read()
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--realms", type=int, default=20)
+    ap.add_argument("--auctions", type=int, default=20000, help="аукционов на connected realm")
+    ap.add_argument("--items", type=int, default=5000)
+    ap.add_argument("--commodities", type=int, default=50000)
+    ap.add_argument("--watch", type=int, default=100, help="строк в вотчлисте")
+    ap.add_argument("--commodity-share", type=float, default=0.5)
+    ap.add_argument("--latency-ms", type=float, default=20.0)
+    ap.add_argument("--runs", type=int, default=1, help="прогонов подряд на одном состоянии")
+    ap.add_argument("--state-dir", default=None, help="AH_STATE_DIR (по умолчанию — временная папка)")
+    ap.add_argument("--workers", type=int, default=0, help="процессов-воркеров распределённого скана (0 — без них)")
+    ap.add_argument("--json", action="store_true", help="отчёт одной JSON-строкой")
+    ap.add_argument("--scale", default=None,
+                    help="значения DECODE_WORKERS через запятую (1,2,4): таблица масштабирования пула разбора")
+    args = ap.parse_args()
+    if args.scale:
+        # те же параметры стенда, но без общего --state-dir: каждому прогону — свежее состояние
+        argv = [f"--{k.replace('_', '-')}={v}" for k, v in vars(args).items()
+                if k not in ("scale", "json", "state_dir")]
+        scale_runs(args, argv)
+        return
+
+    proc, base = start_fake_api(args)
+    workers = []
+    try:
+        warm_up(base, args)
+        os.environ.update({
+            "BLIZZARD_API_BASE": base,
+            "BLIZZARD_AUTH_URL": f"{base}/token",
+            "BLIZZARD_CLIENT_ID": "bench",
+            "BLIZZARD_CLIENT_SECRET": "bench",
+            "AH_STATE_DIR": args.state_dir or tempfile.mkdtemp(prefix="ah_bench_"),
+        })
+        os.environ.setdefault("SLEEP_BETWEEN_REALMS_SEC", "0")
+        # лист подменён синтетическими строками — ревизию в Drive API не проверяем
+        os.environ.setdefault("WATCHLIST_CACHE", "0")
+        # отправка в Telegram подменена счётчиком — темп Bot API в wall time не меряем
+        os.environ.setdefault("TELEGRAM_RATE_PER_CHAT", "1000")
+        for k in ("TELEGRAM_TOKEN", "TELEGRAM_CHAT_ID"):
+            os.environ.pop(k, None)
+        if args.workers:
+            os.environ.update(RUN_MODE="coordinator",
+                              WORK_QUEUE=os.path.join(os.environ["AH_STATE_DIR"], "work_queue.sqlite"))
+            workers = start_workers(args.workers, os.environ["AH_STATE_DIR"])
+
+        import track_ah_gsheets as ah
+
+        rows = snapshots.make_watchlist(args.watch, args.items, commodity_share=args.commodity_share)
+        ah.load_items_with_thresholds = lambda *_: rows
+
+        counters = {"matches": 0, "messages": 0}
+        lock = threading.Lock()
+        match_payload = ah.match_payload
+
+        def counting_match(*a, **kw):
+            found, lots = match_payload(*a, **kw)
+            # пул DECODE_WORKERS сразу сводит к лучшему лоту на предмет — считаем так во всех режимах
+            n = len(ah.best_per_item(found))
+            with lock:
+                counters["matches"] += n
+            return found, lots
+
+        def counting_send(text, chat_id=None):
+            counters["messages"] += 1
+
+        ah.match_payload = counting_match
+        ah.send_telegram = counting_send
+
+        reports = []
+        for run in range(1, args.runs + 1):
+            counters.update(matches=0, messages=0)
+            before = fetch_stats(base)
+            t0 = time.perf_counter()
+            ah.main()
+            wall = time.perf_counter() - t0
+            after = fetch_stats(base)
+            served = after["auctions_served"] - before["auctions_served"]
+            # ru_maxrss на Linux — в килобайтах, пик за всё время процесса; RUSAGE_CHILDREN — самый большой
+            # из дождавшихся детей (пул разбора закрывается в конце main()), воркеры живы — по /proc
+            rss_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+            rss_child = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+            rss_workers = sum(peak_rss_mb(p.pid) for p in workers)
+            reports.append({
+                "run": run,
+                "wall_sec": round(wall, 3),
+                "realms": args.realms,
+                "scan_concurrency": ah.SCAN_CONCURRENCY,
+                "decode_workers": ah.DECODE_WORKERS,
+                "scan_workers": args.workers,
+                "realms_per_sec": round(args.realms / wall, 2),
+                "auctions_scanned": served,
+                "auctions_per_sec": round(served / wall),
+                "matches": counters["matches"],
+                "messages": counters["messages"],
+                "requests": after["requests"] - before["requests"],
+                "not_modified": after["not_modified"] - before["not_modified"],
+                "mbytes": round((after["bytes"] - before["bytes"]) / 1e6, 2),
+                "peak_rss_mb": round(rss_self, 1),
+                "child_peak_rss_mb": round(rss_child, 1),
+                "workers_peak_rss_mb": round(rss_workers, 1),
+                "total_peak_rss_mb": round(rss_self + rss_child * ah.DECODE_WORKERS + rss_workers, 1),
+            })
+    finally:
+        stop_workers(workers)
+        proc.kill()
+
+    if args.json:
+        print(json.dumps(reports))
+        return
+    print()
+    for r in reports:
+        print(f"run {r['run']} (threads={r['scan_concurrency']}, decode workers={r['decode_workers']}, "
+              f"scan workers={r['scan_workers']}): "
+              f"{r['wall_sec']:.2f}s wall | {r['realms_per_sec']} realms/s | "
+              f"{r['auctions_per_sec']:,} auctions/s ({r['auctions_scanned']:,} scanned) | "
+              f"{r['matches']} matches, {r['messages']} messages | {r['requests']} requests "
+              f"({r['not_modified']} x 304), {r['mbytes']} MB | peak RSS {r['peak_rss_mb']} MB "
+              f"(+ child {r['child_peak_rss_mb']} MB x {r['decode_workers']}, "
+              f"workers {r['workers_peak_rss_mb']} MB; total {r['total_peak_rss_mb']} MB)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Генератор синтетических снапшотов аукциона в формате Blizzard API:
+/connected-realm/{id}/auctions, /auctions/commodities и вотчлист под них.
+Всё детерминировано от seed, чтобы прогоны можно было сравнивать между собой.
+"""
+import random
+from typing import Dict, List, Tuple
+
+TIME_LEFT = ("SHORT", "MEDIUM", "LONG", "VERY_LONG")
+
+# предметы 1..COMMODITY_ITEMS — товары (региональный аукцион), остальные — реалмовые
+COMMODITY_ITEMS = 1000
+
+
+def item_name(item_id: int) -> str:
+    return f"Synthetic Item {item_id}"
+
+
+def _pick_item(rnd: random.Random, lo: int, hi: int) -> int:
+    # популярные предметы встречаются чаще: грубое приближение к живому аукциону
+    return lo + min(int(rnd.paretovariate(1.2)) - 1, hi - lo)
+
+
+def make_auctions(n: int, n_items: int = 5000, seed: int = 42) -> List[Dict]:
+    """
+    Реалмовые лоты: buyout за весь лот (часть лотов только со ставкой), bonus_lists/modifiers у предметов.
+    """
+    rnd = random.Random(seed)
+    out = []
+    for i in range(n):
+        qty = rnd.choice((1, 1, 1, 2, 5, 20, 200))
+        item = {"id": _pick_item(rnd, COMMODITY_ITEMS + 1, n_items)}
+        if rnd.random() < 0.3:
+            item["context"] = rnd.choice((3, 13, 35))
+            item["bonus_lists"] = sorted(rnd.sample(range(6500, 8000), rnd.randint(1, 4)))
+            item["modifiers"] = [{"type": 9, "value": rnd.randint(1, 70)}]
+        a = {
+            "id": seed * 10_000_000 + i,
+            "item": item,
+            "quantity": qty,
+            "time_left": rnd.choice(TIME_LEFT),
+        }
+        if rnd.random() < 0.9:
+            a["buyout"] = rnd.randint(1, 50000) * 100 * qty
+        a["bid"] = rnd.randint(1, 50000) * 90
+        out.append(a)
+    return out
+
+
+def make_commodities(n: int, seed: int = 7) -> List[Dict]:
+    """
+    Лоты регионального аукциона товаров: unit_price за штуку, без buyout.
+    """
+    rnd = random.Random(seed)
+    return [{
+        "id": 900_000_000 + i,
+        "item": {"id": _pick_item(rnd, 1, COMMODITY_ITEMS)},
+        "quantity": rnd.choice((1, 5, 20, 100, 200, 1000)),
+        "unit_price": rnd.randint(1, 5000) * 100,
+        "time_left": rnd.choice(TIME_LEFT),
+    } for i in range(n)]
+
+
+def realm_snapshot(cr_id: int, n_auctions: int, n_items: int, base: str = "") -> Dict:
+    return {
+        "_links": {"self": {"href": f"{base}/data/wow/connected-realm/{cr_id}/auctions?namespace=dynamic-eu"}},
+        "connected_realm": {"href": f"{base}/data/wow/connected-realm/{cr_id}?namespace=dynamic-eu"},
+        "auctions": make_auctions(n_auctions, n_items, seed=cr_id),
+        "commodities": {"href": f"{base}/data/wow/auctions/commodities?namespace=dynamic-eu"},
+    }
+
+
+def commodities_snapshot(n_auctions: int, base: str = "") -> Dict:
+    return {
+        "_links": {"self": {"href": f"{base}/data/wow/auctions/commodities?namespace=dynamic-eu"}},
+        "auctions": make_commodities(n_auctions),
+    }
+
+
+def make_watchlist(n_watch: int, n_items: int, name_share: float = 0.5, commodity_share: float = 0.5,
+                   seed: int = 11) -> List[Tuple[str, float]]:
+    """
+    Строки «листа» в формате load_items_with_thresholds: (ID или английское имя, порог в золоте).
+    Пороги подобраны так, чтобы заметная доля предметов находилась хотя бы на части реалмов.
+    """
+    rnd = random.Random(seed)
+    n_comm = int(n_watch * commodity_share)
+    ids = rnd.sample(range(1, COMMODITY_ITEMS + 1), n_comm)
+    ids += rnd.sample(range(COMMODITY_ITEMS + 1, n_items + 1), n_watch - n_comm)
+    rows = []
+    for item_id in ids:
+        key = item_name(item_id) if rnd.random() < name_share else str(item_id)
+        rows.append((key, float(rnd.choice((5, 20, 100, 500)))))
+    return rows
+
+
+def make_rule_rows(n_rules: int, items: List[int], realms: List[str], seed: int = 13) -> List[Tuple]:
+    """
+    Строки листа с вариантами (как отдаёт load_items_with_thresholds): на каждый предмет из items —
+    общее правило, остальные n_rules - len(items) — bonus_lists/modifiers-варианты и пороги по реалмам.
+    """
+    rnd = random.Random(seed)
+    rows = [(str(i), float(rnd.choice((5, 20, 100, 500)))) for i in items]
+    for _ in range(max(0, n_rules - len(items))):
+        variant = {}
+        kind = rnd.random()
+        if kind < 0.6:
+            variant["bonus"] = sorted(rnd.sample(range(6500, 8000), rnd.randint(1, 2)))
+        elif kind < 0.8:
+            variant["modifiers"] = [(9, rnd.randint(1, 70))]
+        if kind >= 0.8 or rnd.random() < 0.2:
+            variant["realms"] = [rnd.choice(realms)]
+        rows.append((str(rnd.choice(items)), float(rnd.choice((50, 500, 2000, 20000))), variant))
+    return rows
@@ -0,0 +1,34 @@
+import os
+import sys
+import tempfile
+import threading
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "bench")]
+# состояние (кэши, история) — во временной папке, не в .ah_state рабочей копии
+os.environ.setdefault("AH_STATE_DIR", tempfile.mkdtemp(prefix="ah_test_"))
+
+
+@pytest.fixture
+def fake_api(monkeypatch):
+    """
+    Стенд Blizzard API в этом процессе и свежий BlizzardClient на него: 8 CR по 3000 аукционов.
+    """
+    import fake_api as fake_mod
+    import track_ah_gsheets as ah
+
+    fake = fake_mod.FakeBlizzard(realms=8, auctions_per_realm=3000, n_items=5000, commodities=2000)
+    srv = fake_mod.start_server(fake)
+    threading.Thread(target=srv.serve_forever, daemon=True).start()
+    monkeypatch.setattr(ah, "BASE_API", fake.base)
+    monkeypatch.setattr(ah, "BASE_AUTH", f"{fake.base}/token")
+    monkeypatch.setattr(ah, "BLIZZARD", ah.BlizzardClient("test", "test"))
+    monkeypatch.setattr(ah, "HTTP_BACKOFF_SEC", 0.01)
+    monkeypatch.setattr(ah, "SLEEP_BETWEEN_REALMS_SEC", 0)
+    try:
+        yield fake
+    finally:
+        srv.shutdown()
+        srv.server_close()
@@ -0,0 +1,107 @@
+import track_ah_gsheets as ah
+
+
+class _Sink:
+    def __init__(self):
+        self.blocks = []
+
+    def put(self, text):
+        self.blocks.append(text)
+
+
+def _rec(item_id, price, auction_id):
+    return {"item_id": item_id, "item_name": f"Item {item_id}", "per_unit_copper": price,
+            "quantity": 1, "auction_id": auction_id, "time_left": "LONG"}
+
+
+def _blocks(realm_order):
+    realms = {
+        "Realm A": [_rec(30, 500, 1), _rec(10, 900, 2)],
+        "Realm B": [_rec(20, 100, 3), _rec(10, 800, 4)],
+        "Realm C": [_rec(40, 700, 5)],
+    }
+    grouped = ah.TopOffers(k=2)
+    for realm in realm_order:
+        grouped.add(realm, ah.best_per_item(realms[realm]))
+    sink = _Sink()
+    ah.queue_grouped_alerts(sink, grouped, {})
+    return sink.blocks
+
+
+def test_alert_blocks_do_not_depend_on_realm_finish_order():
+    first = _blocks(["Realm A", "Realm B", "Realm C"])
+    assert _blocks(["Realm C", "Realm B", "Realm A"]) == first
+    assert [b.split("(ID ")[1].split(")")[0] for b in first] == ["10", "20", "30", "40"]
+
+
+def test_snapshot_cache_keeps_only_best_per_item():
+    cache = ah.SnapshotCache({10: "Item 10"}, {10: 1.0})
+    cache.store(1, "Mon, 01 Jan 2024 00:00:00 GMT", [_rec(10, 900, 1), _rec(10, 500, 2), _rec(10, 500, 3)])
+    assert cache.cached_found(1) == [dict(_rec(10, 500, 2), quantity=2)]
+
+
+def _queue(monkeypatch, replies=()):
+    # send_telegram подменён: отвечает по очереди replies (исключение — бросить), дальше — успех
+    sent, replies = [], list(replies)
+
+    def send(text, chat_id=None):
+        if replies:
+            reply = replies.pop(0)
+            if reply is not None:
+                raise reply
+        sent.append(text)
+
+    monkeypatch.setattr(ah, "send_telegram", send)
+    monkeypatch.setattr(ah, "HTTP_BACKOFF_SEC", 0.01)
+    alerts = ah.AlertQueue(chat_id="1", start=False)
+    alerts.buckets = []
+    alerts.linger = 60  # всё, что положено до close(), уходит одной пачкой
+    alerts._thread.start()
+    return alerts, sent
+
+
+def test_alert_queue_packs_blocks_into_messages_within_budget(monkeypatch):
+    alerts, sent = _queue(monkeypatch)
+    blocks = [f"🔔 Item {i}\n" + "- 1g 0s 0c • x1 • Realm • auc 1 • LONG\n" * 20 for i in range(30)]
+    for block in blocks:
+        alerts.put(block)
+    alerts.close()
+    assert 1 < len(sent) < len(blocks)
+    assert all(ah.telegram_len(m) <= ah.TELEGRAM_MESSAGE_BUDGET for m in sent)
+    body = "\n\n".join(m[len(alerts.header):] for m in sent)
+    assert body == "\n\n".join(blocks)
+    assert alerts.summary()["messages"] == len(sent)
+
+
+def test_alert_queue_splits_long_blocks_on_lines_in_utf16_units(monkeypatch):
+    alerts, sent = _queue(monkeypatch)
+    # 🔔 — две единицы UTF-16: по символам Python строки влезли бы в лимит, по меркам Telegram — нет
+    lines = [f"🔔🔔 line {i} " + "🧭" * 40 for i in range(200)] + ["x" * 5000]
+    alerts.put("\n".join(lines))
+    alerts.close()
+    assert len(sent) > 1
+    assert all(ah.telegram_len(m) <= ah.TELEGRAM_MESSAGE_BUDGET for m in sent)
+    got = "\n".join(m[len(alerts.header):].replace("\n\n", "\n") for m in sent).split("\n")
+    assert got[:200] == lines[:200]
+    assert "".join(got[200:]) == lines[200]
+
+
+def test_alert_queue_retries_after_429(monkeypatch):
+    alerts, sent = _queue(monkeypatch, [ah.TelegramRetryAfter(0.01), ah.TelegramRetryAfter(0.01)])
+    alerts.put("🔔 Item 1")
+    alerts.close()
+    assert sent == [alerts.header + "🔔 Item 1"]
+    st = alerts.summary()
+    assert (st["retries"], st["messages"], st["dropped"]) == (2, 1, 0)
+
+
+def test_snapshot_cache_keeps_full_found_in_new_mode(monkeypatch):
+    id_map, id_thr = {10: "Item 10"}, {10: 1.0}
+    snapshot = {"auctions": [{"id": 1, "item": {"id": 10}, "buyout": 500, "quantity": 1, "time_left": "LONG"}]}
+    ctx = ah.ScanContext(ah.SnapshotCache(id_map, id_thr), differ=ah.SnapshotDiff(persist=False))
+    monkeypatch.setattr(ah, "ALERT_MODE", "new")
+    ah._match_snapshot(7, snapshot, "Mon, 01 Jan 2024 00:00:00 GMT", id_map, id_thr, ctx, 7)
+    assert ah._match_snapshot(7, None, None, id_map, id_thr, ctx, 7) == []
+    # переключились на all — по 304 те же находки, а не пустой список из режима new
+    monkeypatch.setattr(ah, "ALERT_MODE", "all")
+    assert [f["auction_id"] for f in ah._match_snapshot(7, None, None, id_map, id_thr, ctx, 7)] == [1]
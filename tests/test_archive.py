@@ -0,0 +1,60 @@
+import os
+import time
+
+import track_ah_gsheets as ah
+
+
+def _row(archive, key):
+    (_, rows), = archive.passes(archive.scan_ts, archive.scan_ts)
+    return rows[key]
+
+
+def test_read_remaps_grown_segment_and_closes_old_map(tmp_path):
+    archive = ah.SnapshotArchive(os.path.join(tmp_path, "archive"))
+    try:
+        archive.put(1, b'{"auctions":[1]}', "Mon, 01 Jan 2024 00:00:00 GMT")
+        archive.flush()
+        assert archive.read(_row(archive, "1")) == (b'{"auctions":[1]}', "Mon, 01 Jan 2024 00:00:00 GMT")
+        (old,) = archive._maps.values()
+
+        archive.put(2, b'{"auctions":[2]}', "Mon, 01 Jan 2024 01:00:00 GMT")
+        archive.flush()
+        assert archive.read(_row(archive, "2"))[0] == b'{"auctions":[2]}'
+        assert old.closed
+        assert archive.read(_row(archive, "1"))[0] == b'{"auctions":[1]}'
+    finally:
+        archive.close()
+
+
+def test_prune_drops_expired_segments_and_their_maps(tmp_path):
+    archive = ah.SnapshotArchive(os.path.join(tmp_path, "archive"))
+    try:
+        archive.begin_scan(time.time() - 10 * 86400)
+        archive.put(1, b'{"auctions":[]}', None)
+        archive.flush()
+        (_, rows), = archive.passes(0, time.time())
+        archive.close()
+        archive = ah.SnapshotArchive(os.path.join(tmp_path, "archive"))
+        archive.read(rows["1"])
+        (old,) = archive._maps.values()
+        archive.prune(retention_days=1)
+        assert old.closed and not archive._maps
+        assert archive.passes(0, time.time()) == []
+        assert not [n for n in os.listdir(archive.path) if n.endswith(".seg")]
+    finally:
+        archive.close()
+
+
+def test_not_modified_without_blob_is_recorded_as_gap(tmp_path):
+    archive = ah.SnapshotArchive(os.path.join(tmp_path, "archive"))
+    try:
+        archive.put(1, b'{"auctions":[1]}', "Mon, 01 Jan 2024 00:00:00 GMT")
+        archive.put(2, None, "Mon, 01 Jan 2024 00:00:00 GMT")
+        assert archive.flush() == 1
+        (_, rows), = archive.passes(archive.scan_ts, archive.scan_ts)
+        assert list(rows) == ["1"]
+        assert archive.gaps(0, time.time()) == {archive.scan_ts: ["2"]}
+        archive.prune(retention_days=-1)
+        assert archive.gaps(0, time.time() + 86400) == {}
+    finally:
+        archive.close()
@@ -0,0 +1,37 @@
+import time
+
+import track_ah_gsheets as ah
+
+
+def test_revoked_token_is_refreshed_once_and_stale_token_substituted(fake_api):
+    t1 = ah.get_token("test", "test")
+    fake_api.revoke()
+    body, last_modified = ah.fetch_auctions_if_modified(t1, 1000, raw=True)
+    assert body and last_modified
+    assert fake_api.tokens_issued == 2
+    assert fake_api.stats["by_endpoint"]["unauthorized"] == 1
+    assert ah.BLIZZARD.stats["auctions"]["retries"] == 1
+    # вызывающий всё ещё держит t1 — клиент подставляет актуальный токен без нового 401
+    ah.fetch_auctions_if_modified(t1, 1001, raw=True)
+    assert fake_api.stats["by_endpoint"]["unauthorized"] == 1
+    assert ah.BLIZZARD._prev_token == t1
+
+
+def test_429_retries_after_retry_after_and_5xx_backs_off(fake_api):
+    token = ah.get_token("test", "test")
+    fake_api.fail_next(429, retry_after="0.3")
+    fake_api.fail_next(503)
+    t0 = time.monotonic()
+    body, _ = ah.fetch_auctions_if_modified(token, 1000, raw=True)
+    assert time.monotonic() - t0 >= 0.3
+    assert body
+    st = ah.BLIZZARD.stats["auctions"]
+    assert (st["requests"], st["retries"], st["errors"]) == (3, 2, 0)
+
+
+def test_stats_reset_per_run(fake_api):
+    token = ah.get_token("test", "test")
+    ah.fetch_auctions_if_modified(token, 1000, raw=True)
+    assert ah.BLIZZARD.stats["auctions"]["requests"] == 1
+    ah.BLIZZARD.reset_stats()
+    assert ah.BLIZZARD.report() == ""
@@ -0,0 +1,48 @@
+import os
+import time
+
+import track_ah_gsheets as ah
+
+
+def _lots(price):
+    return {10: [(price, 5, 1)], 20: [(300, 1, 2)]}
+
+
+def test_unchanged_summaries_are_not_written_again(tmp_path):
+    history = ah.PriceHistory(os.path.join(tmp_path, "h.sqlite"))
+    try:
+        history.add(1, _lots(100))
+        assert history.flush() == 2
+        history.add(1, _lots(100))
+        assert history.flush() == 0
+        history.add(1, _lots(90))
+        assert history.flush() == 1
+        # предмет пропал и вернулся с той же сводкой — это снова изменение
+        history.add(1, {10: [(90, 5, 1)]})
+        history.add(1, _lots(90))
+        assert history.flush() == 1
+        history.close()
+        history = ah.PriceHistory(os.path.join(tmp_path, "h.sqlite"))
+        history.add(1, _lots(90))
+        assert history.flush() == 0
+    finally:
+        history.close()
+
+
+def test_rollup_folds_old_rows_into_daily_min_and_median(tmp_path):
+    history = ah.PriceHistory(os.path.join(tmp_path, "h.sqlite"))
+    try:
+        day = (int(time.time()) // 86400 - 30) * 86400
+        for hour, price in enumerate((500, 100, 300)):
+            history.begin_scan(day + hour * 3600)
+            history.add(1, {10: [(price, 1, hour)]})
+        history.begin_scan()
+        history.add(1, {10: [(700, 1, 9)]})
+        history.flush()
+        history.prune(retention_days=400)
+        assert history.daily(10, 0) == [(1, day, 100, 300)]
+        assert [r[1] for r in history.range(10, 0)] == [history.scan_ts]
+        history.prune(retention_days=1)
+        assert history.daily(10, 0) == []
+    finally:
+        history.close()
@@ -0,0 +1,20 @@
+import time
+
+import track_ah_gsheets as ah
+
+
+def test_zero_rate_means_unlimited():
+    limiter = ah.RateLimiter(0, 0)
+    t0 = time.monotonic()
+    for _ in range(1000):
+        limiter.acquire()
+    assert time.monotonic() - t0 < 1.0
+    ah.TokenBucket(-1, 0).acquire()
+
+
+def test_bucket_still_throttles_after_burst():
+    bucket = ah.TokenBucket(50, 2)
+    t0 = time.monotonic()
+    for _ in range(7):
+        bucket.acquire()
+    assert time.monotonic() - t0 >= 0.09
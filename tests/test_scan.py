@@ -0,0 +1,63 @@
+import random
+
+import pytest
+
+import track_ah_gsheets as ah
+from snapshots import COMMODITY_ITEMS, make_auctions
+
+CR_LIST = list(range(1000, 1008))
+
+
+def _watch(n=60, seed=3):
+    # предметы из снапшотов стенда, часть порогов ниже всех цен — чтобы находки были, но не все
+    rnd = random.Random(seed)
+    present = sorted({a["item"]["id"] for a in make_auctions(3000, 5000, seed=1000)} - set(range(COMMODITY_ITEMS + 1)))
+    id_map = {i: f"Item {i}" for i in rnd.sample(present, n)}
+    id_thr = {i: rnd.choice((0.01, 50.0, 500.0, 5000.0)) for i in id_map}
+    return id_map, id_thr
+
+
+def _scan(monkeypatch, concurrency, budget=None):
+    monkeypatch.setattr(ah, "SCAN_CONCURRENCY", concurrency)
+    id_map, id_thr = _watch()
+    token = ah.get_token("test", "test")
+    ctx = ah.ScanContext(budget=budget)
+    return {cr: found for cr, found in ah.iter_realm_scans(token, CR_LIST, id_map, id_thr, ctx)}, id_thr
+
+
+def _alert_text(scans, id_thr):
+    grouped = ah.TopOffers()
+    for cr, found in scans.items():
+        grouped.add(f"CR-{cr}", ah.best_per_item(found))
+    return [ah.format_item_alert(i, n, grouped, id_thr) for i, n in sorted(grouped.items)]
+
+
+def test_concurrent_scan_matches_sequential(fake_api, monkeypatch):
+    sequential, id_thr = _scan(monkeypatch, 1)
+    concurrent, _ = _scan(monkeypatch, 4)
+    assert sorted(sequential) == CR_LIST
+    assert any(sequential.values())
+    key = lambda f: (f["item_id"], f["auction_id"])  # noqa: E731
+    assert {cr: sorted(f, key=key) for cr, f in concurrent.items()} == \
+        {cr: sorted(f, key=key) for cr, f in sequential.items()}
+    assert _alert_text(concurrent, id_thr) == _alert_text(sequential, id_thr)
+
+
+@pytest.mark.parametrize("concurrency", [1, 4])
+def test_budget_skips_realms_past_the_request_limit(fake_api, monkeypatch, concurrency):
+    budget = ah.ScanBudget(max_requests=3)
+    scans, _ = _scan(monkeypatch, concurrency, budget)
+    assert sorted(scans) == CR_LIST[:3]
+    assert budget.started == 3
+    assert budget.skipped == CR_LIST[3:]
+    assert fake_api.stats["by_endpoint"]["auctions"] == 3
+
+
+@pytest.mark.parametrize("concurrency", [1, 4])
+def test_budget_past_deadline_starts_nothing(fake_api, monkeypatch, concurrency):
+    budget = ah.ScanBudget(seconds=60)
+    budget.deadline -= 61
+    scans, _ = _scan(monkeypatch, concurrency, budget)
+    assert scans == {}
+    assert budget.skipped == CR_LIST
+    assert "auctions" not in fake_api.stats["by_endpoint"]
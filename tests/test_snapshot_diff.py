@@ -0,0 +1,20 @@
+import track_ah_gsheets as ah
+
+
+def test_cheaper_is_per_item_best_price_not_per_auction():
+    differ = ah.SnapshotDiff(persist=False)
+    differ.update(1, {10: [(500, 1, 1), (700, 1, 2)], 20: [(300, 1, 3)]})
+    # лот 1 продан, пришёл 4 дешевле прошлого лучшего; у 20 новый лот дороже — не «подешевел»
+    delta = differ.update(1, {10: [(700, 1, 2), (400, 1, 4)], 20: [(300, 1, 3), (350, 1, 5)]})
+    assert delta["new"] == {4, 5}
+    assert delta["removed"] == {1}
+    assert delta["cheaper"] == {10: (500, 400)}
+    # другой CR — своя база
+    assert differ.update(2, {10: [(100, 1, 6)]})["cheaper"] == {}
+
+
+def test_state_without_item_ids_reports_nothing_cheaper():
+    differ = ah.SnapshotDiff(persist=False)
+    differ.realms["1"] = {"ids": differ._pack([1]), "prices": differ._pack([500])}
+    delta = differ.update(1, {10: [(400, 1, 2)]})
+    assert (delta["new"], delta["removed"], delta["cheaper"]) == ({2}, {1}, {})
@@ -0,0 +1,68 @@
+import json
+import random
+
+import pytest
+
+import track_ah_gsheets as ah
+from snapshots import COMMODITY_ITEMS, make_auctions
+
+
+def _payload(n=3000, seed=3):
+    auctions = make_auctions(n)
+    rnd = random.Random(seed)
+    # многобайтные строки внутри лотов — их куски обязаны склеиваться посреди символа
+    for a in rnd.sample(auctions, n // 10):
+        a["item"]["pet_name"] = "Пушистик 🐉"
+    body = json.dumps({"_links": {"self": {"href": "x"}}, "connected_realm": {"href": "y"},
+                       "auctions": auctions, "commodities": {"href": "z"}},
+                      ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    id_map = {i: f"Item {i}" for i in rnd.sample(range(COMMODITY_ITEMS + 1, 5001), 60)}
+    id_thr = {i: rnd.choice((50.0, 500.0, 2000.0)) for i in id_map}
+    return body, id_map, id_thr
+
+
+def _chunks(body, size):
+    return (body[i:i + size] for i in range(0, len(body), size))
+
+
+def _mid_char_split(body):
+    # два куска, граница ровно внутри многобайтного символа
+    cut = body.index("🐉".encode("utf-8")) + 2
+    return [body[:cut], body[cut:]]
+
+
+@pytest.mark.parametrize("chunking", ["1 byte", "mid utf-8", "64 KiB"])
+def test_filtered_stream_matches_full_parse(chunking):
+    body, id_map, id_thr = _payload()
+    chunks = {
+        "1 byte": lambda: _chunks(body, 1),
+        "mid utf-8": lambda: _mid_char_split(body),
+        "64 KiB": lambda: _chunks(body, 64 * 1024),
+    }[chunking]()
+    full = json.loads(body)
+    streamed = list(ah.iter_auctions_filtered(chunks, id_map))
+    assert streamed == [a for a in full["auctions"] if a["item"]["id"] in id_map]
+    assert (ah.check_items_in_auctions_per_item({"auctions": streamed}, id_map, id_thr)
+            == ah.check_items_in_auctions_per_item(full, id_map, id_thr))
+
+
+def test_unfiltered_stream_yields_every_auction():
+    body, _, _ = _payload(500)
+    assert list(ah.iter_auctions_filtered(_chunks(body, 4096))) == json.loads(body)["auctions"]
+
+
+@pytest.mark.parametrize("back", [1, 3, 40])
+def test_truncated_payload_raises(back):
+    # обрыв внутри последнего лота: raw_decode падает уже на eof
+    body, id_map, _ = _payload(500)
+    end = body.rindex(b"]")
+    with pytest.raises(ValueError):  # json.JSONDecodeError — тоже ValueError
+        list(ah.iter_auctions_filtered(_chunks(body[:end - back], 1024), id_map))
+
+
+@pytest.mark.parametrize("where", ["between lots", "before ]"])
+def test_truncated_between_lots_raises(where):
+    body, _, _ = _payload(500)
+    cut = body.index(b"},{", len(body) // 2) + 2 if where == "between lots" else body.rindex(b"]")
+    with pytest.raises(ValueError, match="Truncated auctions payload"):
+        list(ah.iter_auctions_filtered(_chunks(body[:cut], 1024)))
@@ -0,0 +1,58 @@
+import json
+import random
+
+import track_ah_gsheets as ah
+from snapshots import make_auctions
+
+
+def _watch(auctions, n=40, seed=7):
+    # только id, которые в снапшоте реально есть — иначе обе стороны сравнения пустые
+    rnd = random.Random(seed)
+    present = sorted({a["item"]["id"] for a in auctions})
+    id_map = {i: f"Item {i}" for i in rnd.sample(present, min(n, len(present)))}
+    id_thr = {i: rnd.choice((50.0, 500.0, 2000.0)) for i in id_map}
+    return id_map, id_thr
+
+
+def _match(snapshot, id_map, id_thr):
+    return ah.best_per_item(ah.check_items_in_auctions_per_item(snapshot, id_map, id_thr))
+
+
+def _prefiltered(body, id_map, id_thr):
+    watched, total = ah.decode_watched_auctions(body, id_map)
+    return _match({"auctions": watched}, id_map, id_thr), total
+
+
+def test_watched_decode_matches_full_parse():
+    auctions = make_auctions(20000)
+    id_map, id_thr = _watch(auctions)
+    body = json.dumps({"_links": {}, "auctions": auctions}, separators=(",", ":")).encode()
+    got, total = _prefiltered(body, id_map, id_thr)
+    assert total == len(auctions)
+    assert got
+    assert got == _match(json.loads(body), id_map, id_thr)
+
+
+def test_watched_decode_falls_back_on_non_compact_json():
+    auctions = make_auctions(3000)
+    id_map, id_thr = _watch(auctions)
+    # пробелы после ':' и другой порядок ключей item у лота из вотчлиста — быстрый путь обязан уступить json.loads
+    lot = next(a for a in auctions if a["item"]["id"] in id_map)
+    lot["item"] = {"context": 1, **lot["item"]}
+    body = json.dumps({"auctions": auctions}, indent=1).encode()
+    watched, total = ah.decode_watched_auctions(body, id_map)
+    assert total == len(auctions)
+    assert lot in watched
+    got = _match({"auctions": watched}, id_map, id_thr)
+    assert got
+    assert got == _match(json.loads(body), id_map, id_thr)
+
+
+def test_watched_decode_does_not_match_id_prefixes():
+    body = json.dumps({"auctions": [
+        {"id": 1, "item": {"id": 1234}, "buyout": 100, "quantity": 1, "time_left": "LONG"},
+        {"id": 2, "item": {"id": 123}, "buyout": 100, "quantity": 1, "time_left": "LONG"},
+    ]}, separators=(",", ":")).encode()
+    watched, total = ah.decode_watched_auctions(body, {123: "Item"})
+    assert total == 2
+    assert [a["id"] for a in watched] == [2]
@@ -0,0 +1,81 @@
+import os
+
+import bench_rules
+import track_ah_gsheets as ah
+from snapshots import COMMODITY_ITEMS, make_auctions, make_rule_rows
+
+
+def _watch():
+    items = list(range(COMMODITY_ITEMS + 1, COMMODITY_ITEMS + 201))
+    realm_of = {n: cr for cr, names in bench_rules.REALMS.items() for n in names}
+    rows = make_rule_rows(2000, items, list(realm_of))
+    id_map = {i: f"Item {i}" for i in items}
+    id_thr = {i: 0.0 for i in items}
+    rules = ah.compile_rules(rows, ah.ItemCache(), id_map, id_thr)
+    rules.bind_realms(bench_rules.REALMS)
+    return id_map, id_thr, rules
+
+
+def test_watch_round_trips_through_json():
+    id_map, id_thr, rules = _watch()
+    text = ah.dump_watch(id_map, id_thr, rules)
+    id_map2, id_thr2, rules2 = ah.load_watch(text, ah.ItemCache(read_only=True))
+    assert (id_map2, id_thr2) == (id_map, id_thr)
+    assert ah.watch_fingerprint(id_map2, id_thr2, rules2) == ah.watch_fingerprint(id_map, id_thr, rules)
+    snapshot = {"auctions": make_auctions(20000)}
+    for cr in bench_rules.REALMS:
+        assert (ah.check_items_with_rules(snapshot, id_map2, rules2, cr)
+                == ah.check_items_with_rules(snapshot, id_map, rules, cr))
+
+
+def test_plain_watch_round_trips_without_rules():
+    text = ah.dump_watch({5: "Item 5"}, {5: 12.5})
+    assert ah.load_watch(text, ah.ItemCache(read_only=True)) == ({5: "Item 5"}, {5: 12.5}, None)
+
+
+def test_cancel_queued_keeps_leased_tasks(tmp_path):
+    work = ah.WorkQueue(os.path.join(tmp_path, "q.sqlite"))
+    try:
+        run_id = work.publish("eu", ah.dump_watch({5: "Item 5"}, {5: 1.0}), [11, 12, 13, 14])
+        assert work.open_run("eu")[0] == run_id
+        assert work.claim(run_id, "w1") == (11, None)
+        assert work.cancel_queued(run_id) == [12, 13, 14]
+        assert work.pending(run_id) == 1
+        assert work.claim(run_id, "w2") is None
+        assert work.complete(run_id, 11, "w1", {"worker": "w1", "found": []})
+        assert work.pending(run_id) == 0
+    finally:
+        work.close()
+
+
+def test_expired_lease_is_reclaimed_and_late_complete_dropped(tmp_path, monkeypatch):
+    work = ah.WorkQueue(os.path.join(tmp_path, "q.sqlite"))
+    try:
+        run_id = work.publish("eu", ah.dump_watch({5: "Item 5"}, {5: 1.0}), [11])
+        monkeypatch.setattr(ah, "WORK_LEASE_SEC", -1)  # аренда просрочена сразу
+        assert work.claim(run_id, "w1") == (11, None)
+        monkeypatch.setattr(ah, "WORK_LEASE_SEC", 600)
+        assert work.claim(run_id, "w2") == (11, None)
+        assert work.claim(run_id, "w3") is None
+        assert not work.complete(run_id, 11, "w1", {"worker": "w1", "found": []})
+        assert work.complete(run_id, 11, "w2", {"worker": "w2", "found": []})
+        assert [(cr, r["worker"]) for cr, r in work.collect(run_id)] == [(11, "w2")]
+        assert work.close_run(run_id)["re_leased"] == 1
+    finally:
+        work.close()
+
+
+def test_late_complete_on_last_attempt_is_accepted(tmp_path, monkeypatch):
+    work = ah.WorkQueue(os.path.join(tmp_path, "q.sqlite"))
+    try:
+        run_id = work.publish("eu", ah.dump_watch({5: "Item 5"}, {5: 1.0}), [11])
+        monkeypatch.setattr(ah, "WORK_MAX_ATTEMPTS", 1)
+        monkeypatch.setattr(ah, "WORK_LEASE_SEC", -1)
+        assert work.claim(run_id, "w1") == (11, None)
+        # попыток не осталось: CR никому не перевыдаётся, pending() помечает его провалом
+        assert work.claim(run_id, "w2") is None
+        assert work.pending(run_id) == 0
+        assert work.complete(run_id, 11, "w1", {"worker": "w1", "found": []})
+        assert work.close_run(run_id)["done"] == 1
+    finally:
+        work.close()
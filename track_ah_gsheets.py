@@ -1,20 +1,140 @@
 import os
 import time
 import json
+import csv
 import base64
+import codecs
 import math
+import hashlib
+import sqlite3
+import threading
+import queue
+import multiprocessing
+import cProfile
+import pstats
+import tracemalloc
+import heapq
+import zlib
+import mmap
+import socket
+from contextlib import contextmanager
+from array import array
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from typing import List, Dict, Tuple
 import requests
+from requests.adapters import HTTPAdapter
 
 # ----------- ПАРАМЕТРЫ ЧЕРЕЗ ENV -----------
-REGION = "eu"
+# Регион (eu/us/kr/tw); namespaces и BASE_API переключает configure_region()
+REGION = os.getenv("REGION", "eu").strip().lower()
 NAMESPACE_DYNAMIC = f"dynamic-{REGION}"
 NAMESPACE_STATIC = f"static-{REGION}"
+# Multi-region: REGIONS=eu,us — каждый регион сканируется в своём процессе, алерты сводятся в одни
+REGIONS = [r.strip().lower() for r in os.getenv("REGIONS", REGION).split(",") if r.strip()]
+# Общий дедлайн шардов multi-region (с запуска): зависшие завершаются, алерты уходят по успевшим.
+# По умолчанию — с запасом до timeout-minutes: 20 в workflow
+REGIONS_TIMEOUT_SEC = float(os.getenv("REGIONS_TIMEOUT_SEC", "900"))
 LOCALE_CANDIDATES = ["ru_RU", "en_US"]  # пробуем обе локали по очереди
 USE_HTML = os.getenv("USE_HTML", "0") == "1"
 
 PRICE_THRESHOLD_G = float(os.getenv("PRICE_THRESHOLD_G", "5000"))  # 5000 золота
 SLEEP_BETWEEN_REALMS_SEC = int(os.getenv("SLEEP_BETWEEN_REALMS_SEC", "1"))  # чуть притормозим чтобы не долбить API
+# Параллельный скан реалмов: 1 — старый последовательный путь, >1 — пул потоков
+SCAN_CONCURRENCY = int(os.getenv("SCAN_CONCURRENCY", "1"))
+# Порядок скана реалмов по статистике прошлых запусков (находки, время, свежесть снапшота); 0 — по ID
+REALM_PRIORITY = os.getenv("REALM_PRIORITY", "1") == "1"
+# Бюджет скана реалмов за запуск: секунды от начала скана и запросы снапшотов CR (0 — без ограничения)
+SCAN_BUDGET_SEC = float(os.getenv("SCAN_BUDGET_SEC", "0"))
+SCAN_BUDGET_REQUESTS = int(os.getenv("SCAN_BUDGET_REQUESTS", "0"))
+# Квоты Blizzard API: 100 запросов/сек и 36 000 запросов/час на клиента (шарды multi-region делят их поровну);
+# 0 — без ограничения
+API_RATE_PER_SEC = float(os.getenv("API_RATE_PER_SEC", "100"))
+API_RATE_PER_HOUR = float(os.getenv("API_RATE_PER_HOUR", "36000"))
+# HTTP-клиент Blizzard: размер пула keep-alive соединений и ретраи 429/5xx с экспоненциальной паузой
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "16"))
+HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "4"))
+HTTP_BACKOFF_SEC = float(os.getenv("HTTP_BACKOFF_SEC", "1"))
+# Локальное состояние между запусками (в Actions сохраняется через actions/cache)
+AH_STATE_DIR = os.getenv("AH_STATE_DIR", ".ah_state")
+REGION_STATE_DIR = AH_STATE_DIR  # у шардов multi-region — AH_STATE_DIR/<region>
+# Условные запросы аукционов (If-Modified-Since) + переиспользование прошлых находок на 304
+SNAPSHOT_CACHE = os.getenv("SNAPSHOT_CACHE", "1") == "1"
+# Потоковый разбор тела /auctions: в памяти только аукционы по предметам из вотчлиста
+STREAM_AUCTIONS = os.getenv("STREAM_AUCTIONS", "0") == "1"
+STREAM_CHUNK_BYTES = 256 * 1024
+# Разбор и матчинг тел /auctions в пуле процессов (JSON-парсинг держит GIL); 0 — в потоке скана
+DECODE_WORKERS = int(os.getenv("DECODE_WORKERS", "0"))
+# Кэш резолва предметов (имя -> id, id -> имя): статика не меняется между запусками
+ITEM_CACHE_TTL_DAYS = float(os.getenv("ITEM_CACHE_TTL_DAYS", "30"))
+ITEM_LOOKUP_CONCURRENCY = int(os.getenv("ITEM_LOOKUP_CONCURRENCY", "8"))
+# Кэш индекса connected realms и имён реалмов; REFRESH_REALM_CACHE=1 — принудительно перечитать
+REALM_CACHE_TTL_HOURS = float(os.getenv("REALM_CACHE_TTL_HOURS", "24"))
+REFRESH_REALM_CACHE = os.getenv("REFRESH_REALM_CACHE", "0") == "1"
+REALM_DETAIL_CONCURRENCY = int(os.getenv("REALM_DETAIL_CONCURRENCY", "8"))
+# Региональный аукцион товаров (/auctions/commodities): с 9.2.7 стакающиеся товары живут только там
+SCAN_COMMODITIES = os.getenv("SCAN_COMMODITIES", "1") == "1"
+# История цен (SQLite в AH_STATE_DIR): min/p10/median/qty по предмету × CR, строка — только когда сводка
+# изменилась. Сырые строки старше PRICE_HISTORY_RAW_DAYS сворачиваются в дневные min/median, дневные
+# живут PRICE_HISTORY_RETENTION_DAYS. Худший случай (50 предметов на всех 250 CR, снапшот раз в час):
+# ~4 млн сырых строк + ~5 млн дневных за год — сотни МБ вместо ~6 ГБ построчной истории каждого скана
+PRICE_HISTORY = os.getenv("PRICE_HISTORY", "1") == "1"
+PRICE_HISTORY_RAW_DAYS = float(os.getenv("PRICE_HISTORY_RAW_DAYS", "14"))
+PRICE_HISTORY_RETENTION_DAYS = float(os.getenv("PRICE_HISTORY_RETENTION_DAYS", "400"))
+# Дифф снапшотов: какие лоты отслеживаемых предметов появились/исчезли с прошлого скана и у каких
+# предметов подешевел лучший лот в CR (по желанию: состояние — все лоты вотчлиста по каждому CR)
+SNAPSHOT_DIFF = os.getenv("SNAPSHOT_DIFF", "0") == "1"
+# Алерты: all — все лоты ниже порога, new — только новые лоты и подешевевшие предметы с прошлого снапшота реалма
+ALERT_MODE = os.getenv("ALERT_MODE", "all")
+# Режим запуска: scan — один проход (cron), daemon — долгоживущий процесс с расписанием по реалмам,
+# replay — тот же конвейер по архиву снапшотов за [REPLAY_FROM, REPLAY_UNTIL] без обращений к API,
+# coordinator / worker — скан одного региона, разложенный по нескольким машинам через общую очередь CR
+RUN_MODE = os.getenv("RUN_MODE", "scan")
+# Очередь распределённого скана — SQLite-файл на общем диске (по умолчанию AH_STATE_DIR/<region>/work_queue.sqlite).
+# Воркер берёт CR в аренду на WORK_LEASE_SEC; не сданный вовремя CR достаётся другому (до WORK_MAX_ATTEMPTS раз)
+WORK_QUEUE = os.getenv("WORK_QUEUE", "")
+WORK_LEASE_SEC = float(os.getenv("WORK_LEASE_SEC", "120"))
+WORK_MAX_ATTEMPTS = int(os.getenv("WORK_MAX_ATTEMPTS", "3"))
+WORK_POLL_SEC = float(os.getenv("WORK_POLL_SEC", "1"))
+WORK_RUN_TIMEOUT_SEC = float(os.getenv("WORK_RUN_TIMEOUT_SEC", "1800"))  # сколько координатор ждёт воркеров
+WORK_IDLE_EXIT_SEC = float(os.getenv("WORK_IDLE_EXIT_SEC", "300"))  # воркер без открытых проходов выходит; 0 — ждёт всегда
+WORK_WORKER_ID = os.getenv("WORK_WORKER_ID", "")  # по умолчанию host:pid
+# Архив сырых тел /auctions (zlib-сегменты по суткам + индекс SQLite) для бэктеста правил.
+# Тело качается целиком (STREAM_AUCTIONS при этом не действует); по умолчанию — snapshot_archive/ в состоянии региона
+SNAPSHOT_ARCHIVE = os.getenv("SNAPSHOT_ARCHIVE", "0") == "1"
+SNAPSHOT_ARCHIVE_DIR = os.getenv("SNAPSHOT_ARCHIVE_DIR", "")
+SNAPSHOT_ARCHIVE_DAYS = float(os.getenv("SNAPSHOT_ARCHIVE_DAYS", "8"))
+SNAPSHOT_ARCHIVE_LEVEL = int(os.getenv("SNAPSHOT_ARCHIVE_LEVEL", "6"))
+# Replay: границы — unix-время или ISO-дата (UTC), по умолчанию последние 7 суток; сообщения — в файл или stdout
+REPLAY_FROM = os.getenv("REPLAY_FROM", "")
+REPLAY_UNTIL = os.getenv("REPLAY_UNTIL", "")
+REPLAY_OUTPUT = os.getenv("REPLAY_OUTPUT", "")
+# Отчёт о прогоне: JSON в состоянии региона (run_report.json) + опционально Prometheus textfile
+RUN_REPORT = os.getenv("RUN_REPORT", "1") == "1"
+METRICS_PROM_FILE = os.getenv("METRICS_PROM_FILE", "")
+# Профилирование матчинга: cprofile | tracemalloc (вызовы матчинга при этом идут по одному)
+PROFILE_MATCHING = os.getenv("PROFILE_MATCHING", "")
+# Очередь уведомлений Telegram: лимиты Bot API (~1 сообщ./сек в чат, 20/мин в группу, 30/сек всего),
+# ретраи с паузой (retry_after на 429), склейка блоков в сообщения до TELEGRAM_MESSAGE_BUDGET
+TELEGRAM_RATE_PER_CHAT = float(os.getenv("TELEGRAM_RATE_PER_CHAT", "1"))
+TELEGRAM_GROUP_RATE_PER_MIN = float(os.getenv("TELEGRAM_GROUP_RATE_PER_MIN", "20"))
+TELEGRAM_RATE_GLOBAL = float(os.getenv("TELEGRAM_RATE_GLOBAL", "30"))
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "5"))
+TELEGRAM_LINGER_SEC = float(os.getenv("TELEGRAM_LINGER_SEC", "1"))  # ждём ещё блоков перед отправкой
+# Лимит Telegram — 4096 единиц UTF-16 (эмодзи вне BMP, 🔔 и 🧭, — по две); склеиваем с запасом, как раньше
+TELEGRAM_MESSAGE_BUDGET = 3500
+# Группировка алертов: realm — блок на предмет × CR, уходит сразу, как только реалм досканирован;
+# item — предмет со всеми CR одним блоком, но находки по реалмам уходят только после всего скана
+ALERT_GROUP_BY = os.getenv("ALERT_GROUP_BY", "realm")
+# В блоке предмета — K самых дешёвых предложений по всем CR + итог; 0 — все CR, как раньше
+ALERT_TOP_K = int(os.getenv("ALERT_TOP_K", "5"))
+DAEMON_POLL_DELAY_SEC = float(os.getenv("DAEMON_POLL_DELAY_SEC", "90"))  # запас после предсказанного обновления
+DAEMON_RETRY_SEC = float(os.getenv("DAEMON_RETRY_SEC", "60"))  # первая пауза, если снапшот ещё не обновился
+DAEMON_MAX_RETRY_SEC = float(os.getenv("DAEMON_MAX_RETRY_SEC", "600"))
+DAEMON_WATCHLIST_REFRESH_SEC = float(os.getenv("DAEMON_WATCHLIST_REFRESH_SEC", "900"))
+DAEMON_PRUNE_SEC = float(os.getenv("DAEMON_PRUNE_SEC", "86400"))  # как часто чистить архив и историю цен по сроку
+DAEMON_DEFAULT_PERIOD_SEC = 3600  # пока период реалма не выучен — раз в час
 
 BLIZZARD_CLIENT_ID = os.getenv("BLIZZARD_CLIENT_ID")
 BLIZZARD_CLIENT_SECRET = os.getenv("BLIZZARD_CLIENT_SECRET")
@@ -26,14 +146,34 @@ GSHEET_SPREADSHEET_ID = os.getenv("GSHEET_SPREADSHEET_ID")
 GSHEET_WORKSHEET_NAME = os.getenv("GSHEET_WORKSHEET_NAME", "Items")
 # Сервис-аккаунт: base64 JSON в секрете GOOGLE_SERVICE_ACCOUNT_B64
 GOOGLE_SERVICE_ACCOUNT_B64 = os.getenv("GOOGLE_SERVICE_ACCOUNT_B64")
+# Источник вотчлиста: gsheet (по умолчанию) или csv/json — локальный файл WATCHLIST_FILE с колонками как в листе
+WATCHLIST_SOURCE = os.getenv("WATCHLIST_SOURCE", "gsheet").strip().lower()
+WATCHLIST_FILE = os.getenv("WATCHLIST_FILE", "")
+# Кэш разобранного вотчлиста по ревизии источника: лист скачивается заново, только если он изменился
+WATCHLIST_CACHE = os.getenv("WATCHLIST_CACHE", "1") == "1"
 
 # ----------- КОНСТАНТЫ -----------
-BASE_AUTH = "https://oauth.battle.net/token"
-BASE_API = f"https://{REGION}.api.blizzard.com"
+# переопределяются для локального стенда (bench/fake_api.py) или прокси
+BASE_AUTH = os.getenv("BLIZZARD_AUTH_URL", "https://oauth.battle.net/token")
+BASE_API = os.getenv("BLIZZARD_API_BASE", f"https://{REGION}.api.blizzard.com")
 COPPER_PER_GOLD = 10000
 
+
+def configure_region(region: str, own_state_dir: bool = False):
+    """
+    Переключает регион в рантайме: namespaces и BASE_API (если он не задан через BLIZZARD_API_BASE).
+    own_state_dir — региональное состояние (реалмы, снапшоты, история) в AH_STATE_DIR/<region>;
+    кэш предметов общий для всех регионов и остаётся в AH_STATE_DIR.
+    """
+    global REGION, NAMESPACE_DYNAMIC, NAMESPACE_STATIC, BASE_API, REGION_STATE_DIR
+    REGION = region.strip().lower()
+    NAMESPACE_DYNAMIC = f"dynamic-{REGION}"
+    NAMESPACE_STATIC = f"static-{REGION}"
+    BASE_API = os.getenv("BLIZZARD_API_BASE", f"https://{REGION}.api.blizzard.com")
+    REGION_STATE_DIR = os.path.join(AH_STATE_DIR, REGION) if own_state_dir else AH_STATE_DIR
+
 # ----------- GOOGLE SHEETS (через gspread) -----------
-# Минималистично: не тащим гигантские libs. Возьмём gspread + google-auth
+# gspread и google-auth импортируются лениво: при неизменном листе (кэш вотчлиста) gspread не нужен вовсе
 import re
 
 def _extract_id(href: str, kind: str) -> int:
@@ -56,35 +196,63 @@ def pretty_realms(names):
     # делаem читаемо: 'argent-dawn' -> 'Argent Dawn'
     return ", ".join(n.replace("-", " ").title() for n in names)
 
-import gspread
-from google.oauth2.service_account import Credentials
+GOOGLE_SCOPES = [
+    "https://www.googleapis.com/auth/spreadsheets.readonly",
+    "https://www.googleapis.com/auth/drive.metadata.readonly",  # ревизия листа для кэша вотчлиста
+]
+
+
+def get_google_credentials():
+    from google.oauth2.service_account import Credentials
 
-def get_gs_client():
     if not GOOGLE_SERVICE_ACCOUNT_B64:
         raise RuntimeError("Missing GOOGLE_SERVICE_ACCOUNT_B64 secret")
     creds_json = json.loads(base64.b64decode(GOOGLE_SERVICE_ACCOUNT_B64).decode("utf-8"))
-    scopes = ["https://www.googleapis.com/auth/spreadsheets.readonly"]
-    credentials = Credentials.from_service_account_info(creds_json, scopes=scopes)
-    return gspread.authorize(credentials)
+    return Credentials.from_service_account_info(creds_json, scopes=GOOGLE_SCOPES)
+
+
+def get_gs_client():
+    import gspread
+
+    return gspread.authorize(get_google_credentials())
+
+
+def get_sheet_revision(spreadsheet_id: str) -> str:
+    """
+    Номер версии и время изменения таблицы из Drive API (files.get) — без gspread и без скачивания листа.
+    """
+    from google.auth.transport.requests import AuthorizedSession
+
+    r = AuthorizedSession(get_google_credentials()).get(
+        f"https://www.googleapis.com/drive/v3/files/{spreadsheet_id}",
+        params={"fields": "version,modifiedTime", "supportsAllDrives": "true"},
+        timeout=10,
+    )
+    r.raise_for_status()
+    meta = r.json()
+    return f"{meta.get('version')}@{meta.get('modifiedTime')}"
 
 # ----------- НОВАЯ ФУНКЦИЯ: Узнаем имя по ID -----------
-def get_item_name_by_id(token: str, item_id: int) -> str:
+def fetch_item_name(token: str, item_id: int) -> str:
     """
     Делает прямой запрос к Blizzard API, чтобы узнать название предмета по его ID.
+    Ошибки пробрасывает наружу (для кэша важно отличать настоящее имя от заглушки).
     """
     url = f"{BASE_API}/data/wow/item/{item_id}"
     # Используем static namespace, где хранятся названия предметов
     params = {"namespace": NAMESPACE_STATIC, "locale": "en_US"}
-    headers = {"Authorization": f"Bearer {token}"}
-    
+
+    r = BLIZZARD.get(url, "item", token=token, params=params, timeout=10)
+    r.raise_for_status()
+    data = r.json()
+    return data.get("name") or f"Item {item_id}"
+
+def get_item_name_by_id(token: str, item_id: int) -> str:
     try:
-        r = requests.get(url, headers=headers, params=params, timeout=10)
-        if r.status_code == 200:
-            data = r.json()
-            return data.get("name") or f"Item {item_id}"
+        return fetch_item_name(token, item_id)
     except Exception as e:
         print(f"[WARN] Failed to fetch name for ID {item_id}: {e}")
-    
+
     # Если не удалось узнать имя, вернем ID как запасной вариант
     return f"Item ID {item_id}"
     
@@ -117,13 +285,18 @@ def parse_price_to_gold(s: str):
 def load_items_with_thresholds(spreadsheet_id: str, worksheet_name: str):
     """
     Читает лист Items и возвращает список (name, per_item_thr_or_None).
-    Принимает гибкие заголовки: item_name / Item Name, max_price / MaxPrice / Max Price.
     """
     gc = get_gs_client()
     sh = gc.open_by_key(spreadsheet_id)
     ws = sh.worksheet(worksheet_name)
-    rows = ws.get_all_records()  # [{'item_name': '...', 'max_price': '...'}, ...]
+    return parse_watch_records(ws.get_all_records())  # [{'item_name': '...', 'max_price': '...'}, ...]
 
+
+def parse_watch_records(rows) -> List[Tuple]:
+    """
+    Записи листа/файла (dict на строку) -> [(name, thr_or_None[, variant])].
+    Принимает гибкие заголовки: item_name / Item Name, max_price / MaxPrice / Max Price.
+    """
     items = []
     for r in rows:
         # нормализуем ключи: нижний регистр, убираем пробелы, дефисы, приводим к snake_case
@@ -141,25 +314,506 @@ def load_items_with_thresholds(spreadsheet_id: str, worksheet_name: str):
 
         raw_thr = r_norm.get("max_price") or r_norm.get("maxprice") or r_norm.get("price_max")
         thr = parse_price_to_gold(raw_thr) if raw_thr not in ("", None) else None
-        items.append((name, thr))
+        # необязательные колонки варианта (bonus_ids, modifiers, pet_species, pet_level, realm)
+        variant = parse_variant(r_norm)
+        items.append((name, thr, variant) if variant else (name, thr))
     return items
 
 
-def load_item_names_from_sheet(spreadsheet_id: str, worksheet_name: str) -> List[str]:
-    gc = get_gs_client()
-    sh = gc.open_by_key(spreadsheet_id)
-    ws = sh.worksheet(worksheet_name)
-    values = ws.get_all_records()
-    # ожидаем столбец item_name
-    names = []
-    for row in values:
-        name = (row.get("item_name") or "").strip()
-        if name:
-            names.append(name)
-    return names
+def _parse_ints(v) -> List[int]:
+    return [int(x) for x in re.findall(r"\d+", str(v))] if v not in ("", None) else []
+
+
+def realm_slug(name: str) -> str:
+    # 'Argent Dawn' -> 'argent-dawn', "Kel'Thuzad" -> 'kelthuzad' (как slug в Blizzard API)
+    return re.sub(r"\s+", "-", str(name).strip().lower().replace("'", ""))
+
+
+def parse_variant(r_norm: Dict) -> Dict:
+    """
+    Колонки варианта из строки листа -> dict (пустой, если строка — просто предмет + порог):
+      bonus_ids   '6652, 7981'  — все перечисленные bonus_lists должны быть у лота
+      modifiers   '9:70, 29:36' — пары type:value из item.modifiers
+      pet_species / pet_level   — для клеток с питомцами (item 82800)
+      realm       'Kazzak, Argent Dawn' или id CR — порог действует только на этих реалмах
+    """
+    variant = {}
+    bonus = _parse_ints(r_norm.get("bonus_ids") or r_norm.get("bonus_lists") or r_norm.get("bonus"))
+    if bonus:
+        variant["bonus"] = bonus
+    mods = re.findall(r"(\d+)\s*[:=]\s*(\d+)", str(r_norm.get("modifiers") or r_norm.get("modifier") or ""))
+    if mods:
+        variant["modifiers"] = [(int(t), int(v)) for t, v in mods]
+    for key, col in (("pet_species", "pet_species"), ("pet_species", "pet_species_id"), ("pet_level", "pet_level")):
+        val = _parse_ints(r_norm.get(col))
+        if val and key not in variant:
+            variant[key] = val[0]
+    realms = r_norm.get("realm") or r_norm.get("realms")
+    if realms not in ("", None):
+        variant["realms"] = [realm_slug(x) for x in str(realms).split(",") if x.strip()]
+    return variant
+
+
+# ----------- WATCHLIST SOURCES -----------
+class GSheetSource:
+    """
+    Вотчлист из Google Sheets. revision() — версия таблицы из Drive API: дёшево, без скачивания листа.
+    """
+    kind = "gsheet"
+
+    def __init__(self, spreadsheet_id: str, worksheet_name: str):
+        self.spreadsheet_id = spreadsheet_id
+        self.worksheet_name = worksheet_name
+        self.name = f"gsheet:{spreadsheet_id}/{worksheet_name}"
+
+    def revision(self):
+        return get_sheet_revision(self.spreadsheet_id)
+
+    def rows(self) -> List[Tuple]:
+        return load_items_with_thresholds(self.spreadsheet_id, self.worksheet_name)
+
+
+class FileSource:
+    """
+    Вотчлист из локального файла для офлайна: CSV с заголовком или JSON — список объектов
+    (или {"items": [...]}); колонки те же, что в листе. Ревизия — mtime и размер файла.
+    """
+    def __init__(self, kind: str, path: str):
+        if not path:
+            raise RuntimeError(f"WATCHLIST_SOURCE={kind} needs WATCHLIST_FILE")
+        self.kind = kind
+        self.path = path
+        self.name = f"{kind}:{os.path.abspath(path)}"
+
+    def revision(self):
+        st = os.stat(self.path)
+        return f"{st.st_mtime_ns}:{st.st_size}"
+
+    def rows(self) -> List[Tuple]:
+        with open(self.path, "r", encoding="utf-8-sig", newline="") as f:
+            if self.kind == "csv":
+                return parse_watch_records(csv.DictReader(f))
+            data = json.load(f)
+        return parse_watch_records(data.get("items", []) if isinstance(data, dict) else data)
+
+
+def watchlist_source():
+    if WATCHLIST_SOURCE in ("csv", "json"):
+        return FileSource(WATCHLIST_SOURCE, WATCHLIST_FILE)
+    if WATCHLIST_SOURCE != "gsheet":
+        raise RuntimeError(f"Unknown WATCHLIST_SOURCE={WATCHLIST_SOURCE!r} (gsheet | csv | json)")
+    return GSheetSource(GSHEET_SPREADSHEET_ID, GSHEET_WORKSHEET_NAME)
+
+
+def load_watch_rows(source) -> List[Tuple]:
+    """
+    Строки вотчлиста через кэш watchlist_cache.json: пока ревизия источника та же, берём разобранные
+    строки из кэша. Не удалось узнать ревизию — читаем источник как раньше (и кэш не обновляем).
+    """
+    try:
+        rev = source.revision() if WATCHLIST_CACHE else None
+    except Exception as e:
+        print(f"[WARN] Watchlist revision check failed ({source.name}), reading it in full: {e}")
+        rev = None
+    if rev is not None:
+        cached = load_state(WATCHLIST_CACHE_FILE, {})
+        if cached.get("source") == source.name and cached.get("revision") == rev:
+            print(f"[INFO] Watchlist unchanged since last run ({source.kind} rev {rev}); using cached rows")
+            return [tuple(r) for r in cached["rows"]]
+    rows = source.rows()
+    if rev is not None:
+        try:
+            save_state(WATCHLIST_CACHE_FILE, {"source": source.name, "revision": rev, "rows": rows})
+        except Exception as e:
+            print(f"[WARN] Failed to save watchlist cache: {e}")
+    return rows
+
+# ----------- ЛОКАЛЬНОЕ СОСТОЯНИЕ -----------
+# файлы состояния, общие для всех регионов (id и имена предметов в регионах совпадают)
+WATCHLIST_CACHE_FILE = "watchlist_cache.json"
+SHARED_STATE_FILES = ("items_cache.json", WATCHLIST_CACHE_FILE)
+
+def _state_path(name: str) -> str:
+    return os.path.join(AH_STATE_DIR if name in SHARED_STATE_FILES else REGION_STATE_DIR, name)
+
+def load_state(name: str, default):
+    """
+    Читает JSON-файл состояния из AH_STATE_DIR (региональные — из REGION_STATE_DIR). Нет файла/битый файл -> default.
+    """
+    try:
+        with open(_state_path(name), "r", encoding="utf-8") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except Exception as e:
+        print(f"[WARN] State file {name} unreadable, starting fresh: {e}")
+        return default
+
+def save_state(name: str, data):
+    # пишем во временный файл и атомарно подменяем, чтобы не оставить полузаписанный JSON
+    path = _state_path(name)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+# ----------- RATE LIMIT -----------
+class TokenBucket:
+    """
+    Потокобезопасный token bucket: пополняется на rate токенов в секунду, не больше capacity.
+    rate <= 0 — без ограничения (API_RATE_*=0, TELEGRAM_RATE_*=0).
+    """
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._ts = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, n: float = 1.0):
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.capacity, self._tokens + (now - self._ts) * self.rate)
+                self._ts = now
+                if self._tokens >= n:
+                    self._tokens -= n
+                    return
+                wait = (n - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class RateLimiter:
+    """
+    Глобальный лимитер запросов к Blizzard API: секундная и часовая квоты одновременно.
+    """
+    def __init__(self, per_sec: float, per_hour: float):
+        self.buckets = [
+            TokenBucket(per_sec, per_sec),
+            TokenBucket(per_hour / 3600.0, per_hour),
+        ]
+
+    def acquire(self):
+        for b in self.buckets:
+            b.acquire()
+
+
+API_LIMITER = RateLimiter(API_RATE_PER_SEC, API_RATE_PER_HOUR)
+
+# ----------- METRICS -----------
+class RunMetrics:
+    """
+    Структурные метрики прогона: тайминги этапов (span), счётчики с метками и записи по реалмам.
+    Внутри realm(key) всё, что насчитали HTTP-клиент и матчинг в этом потоке (статус, байты,
+    ретраи, разобранные аукционы, совпадения), дополнительно пишется в запись реалма.
+    """
+    REALM_FIELDS = ("http_requests", "http_retries", "http_bytes", "auctions_parsed", "matches", "not_modified")
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.stages: List[Dict] = []
+            self.counters: Dict[Tuple, float] = {}
+            self.realms: Dict[str, Dict] = {}
+
+    @contextmanager
+    def span(self, stage: str, **labels):
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.stages.append({"stage": stage, **labels, "start": round(t0 - self.started, 3),
+                                    "sec": round(time.time() - t0, 4)})
+
+    @contextmanager
+    def realm(self, key):
+        rec = {"realm": str(key), "status": None, **{f: 0 for f in self.REALM_FIELDS}}
+        prev = getattr(self._local, "realm", None)
+        self._local.realm = rec
+        t0 = time.time()
+        try:
+            yield rec
+        except Exception as e:
+            rec["error"] = f"{e.__class__.__name__}: {e}"
+            raise
+        finally:
+            self._local.realm = prev
+            rec["start"] = round(t0 - self.started, 3)
+            rec["sec"] = round(time.time() - t0, 4)
+            with self._lock:
+                self.realms[rec["realm"]] = rec
+
+    def add(self, name: str, n: float = 1, **labels):
+        key = (name,) + tuple(sorted(labels.items()))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + n
+        rec = getattr(self._local, "realm", None)
+        if rec is not None and name in rec:
+            rec[name] += n
+
+    def set_status(self, status: int):
+        rec = getattr(self._local, "realm", None)
+        if rec is not None:
+            rec["status"] = status
+
+    def report(self, **extra) -> Dict:
+        with self._lock:
+            stages: Dict[str, Dict] = {}
+            for sp in self.stages:
+                st = stages.setdefault(sp["stage"], {"count": 0, "sec": 0.0, "max_sec": 0.0})
+                st["count"] += 1
+                st["sec"] = round(st["sec"] + sp["sec"], 4)
+                st["max_sec"] = max(st["max_sec"], sp["sec"])
+            return {
+                "region": REGION,
+                "started": int(self.started),
+                "wall_sec": round(time.time() - self.started, 3),
+                "stages": stages,
+                "spans": list(self.stages),
+                "counters": [{"name": k[0], **dict(k[1:]), "value": v} for k, v in sorted(self.counters.items())],
+                "realms": sorted(self.realms.values(), key=lambda r: r["start"]),
+                **extra,
+            }
+
+    def prometheus(self, report: Dict) -> str:
+        def lbl(**kv):
+            return "{" + ",".join(f'{k}="{v}"' for k, v in kv.items()) + "}"
+        out = [f"ah_run_wall_seconds{lbl(region=REGION)} {report['wall_sec']}"]
+        for stage, st in report["stages"].items():
+            out.append(f"ah_stage_seconds{lbl(region=REGION, stage=stage)} {st['sec']}")
+        for c in report["counters"]:
+            labels = {k: v for k, v in c.items() if k not in ("name", "value")}
+            out.append(f"ah_{c['name']}_total{lbl(region=REGION, **labels)} {c['value']}")
+        for r in report["realms"]:
+            out.append(f"ah_realm_seconds{lbl(region=REGION, realm=r['realm'])} {r['sec']}")
+        return "\n".join(out) + "\n"
+
+    def write(self, **extra) -> Dict:
+        """
+        Пишет run_report.json в состояние региона и, если задан METRICS_PROM_FILE, Prometheus textfile.
+        """
+        report = self.report(**extra)
+        if RUN_REPORT:
+            try:
+                save_state("run_report.json", report)
+            except Exception as e:
+                print(f"[WARN] Failed to write run report: {e}")
+        if METRICS_PROM_FILE:
+            try:
+                tmp = METRICS_PROM_FILE + ".tmp"
+                with open(tmp, "w", encoding="utf-8") as f:
+                    f.write(self.prometheus(report))
+                os.replace(tmp, METRICS_PROM_FILE)
+            except Exception as e:
+                print(f"[WARN] Failed to write Prometheus metrics: {e}")
+        return report
+
+
+METRICS = RunMetrics()
+
+
+class MatchProfiler:
+    """
+    Opt-in профилирование горячего пути матчинга (PROFILE_MATCHING): cprofile — сводная статистика
+    по функциям (match_profile.prof в состоянии региона), tracemalloc — пик памяти на вызов и
+    топ строк по аллокациям. Профилировщики глобальные, поэтому вызовы сериализуются.
+    """
+    def __init__(self, mode: str):
+        self.mode = mode
+        self.calls = 0
+        self.stats = None
+        self.peak_bytes = 0
+        self._lock = threading.Lock()
+        if mode == "tracemalloc" and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    @contextmanager
+    def measure(self):
+        if self.mode not in ("cprofile", "tracemalloc"):
+            yield
+            return
+        with self._lock:
+            self.calls += 1
+            if self.mode == "cprofile":
+                prof = cProfile.Profile()
+                prof.enable()
+                try:
+                    yield
+                finally:
+                    prof.disable()
+                    if self.stats is None:
+                        self.stats = pstats.Stats(prof)
+                    else:
+                        self.stats.add(prof)
+            else:
+                base = tracemalloc.get_traced_memory()[0]
+                tracemalloc.reset_peak()
+                try:
+                    yield
+                finally:
+                    self.peak_bytes = max(self.peak_bytes, tracemalloc.get_traced_memory()[1] - base)
+
+    def summary(self) -> Dict:
+        if not self.calls:
+            return {}
+        out = {"mode": self.mode, "calls": self.calls}
+        if self.mode == "cprofile" and self.stats is not None:
+            path = _state_path("match_profile.prof")
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            self.stats.dump_stats(path)
+            top = sorted(self.stats.stats.items(), key=lambda kv: kv[1][3], reverse=True)[:15]
+            out["profile_file"] = path
+            out["top_cumulative"] = [{"func": f"{fn}:{line}({name})", "calls": st[1], "cum_sec": round(st[3], 4)}
+                                     for (fn, line, name), st in top]
+        if self.mode == "tracemalloc":
+            out["peak_bytes_per_call"] = self.peak_bytes
+            out["top_allocations"] = [str(st) for st in tracemalloc.take_snapshot().statistics("lineno")[:10]]
+        return out
+
+
+MATCH_PROFILER = MatchProfiler(PROFILE_MATCHING)
+
+
+# ----------- BLIZZARD HTTP CLIENT -----------
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class BlizzardClient:
+    """
+    Единый HTTP-слой для Blizzard API: пул keep-alive соединений, gzip, токен в кэше до истечения
+    (с обновлением на 401), ретраи 429/5xx/сетевых ошибок с экспоненциальной паузой и Retry-After,
+    общий API_LIMITER и счётчики по эндпоинтам (requests / retries / bytes / errors).
+    """
+    def __init__(self, client_id: str, client_secret: str):
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(HTTP_POOL_SIZE, SCAN_CONCURRENCY))
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["Accept-Encoding"] = "gzip"
+        self._token = None
+        self._token_exp = 0.0
+        self._prev_token = None  # прошлый токен: если вызывающий передаёт его — подставляем актуальный
+        self._lock = threading.Lock()
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    def reset_stats(self):
+        # счётчики report() — за один прогон (main() в одном процессе зовут повторно: бенч, демон)
+        with self._lock:
+            self.stats = {}
+
+    def count(self, endpoint: str, key: str, n: int = 1):
+        with self._lock:
+            st = self.stats.setdefault(endpoint, {"requests": 0, "retries": 0, "bytes": 0, "errors": 0})
+            st[key] += n
+        METRICS.add(f"http_{key}", n, endpoint=endpoint)
+
+    def token(self, force: bool = False) -> str:
+        with self._lock:
+            if self._token and not force and time.time() < self._token_exp - 60:
+                return self._token
+            old = self._token
+        r = self._send("POST", BASE_AUTH, "token", throttle=False,
+                       data={"grant_type": "client_credentials"}, auth=(self.client_id, self.client_secret),
+                       timeout=30)
+        r.raise_for_status()
+        data = r.json()
+        with self._lock:
+            if old:
+                self._prev_token = old
+            self._token = data["access_token"]
+            self._token_exp = time.time() + float(data.get("expires_in", 86400))
+            return self._token
+
+    def _auth_token(self, token: str = None) -> str:
+        with self._lock:
+            if self._token and (token is None or token == self._prev_token):
+                return self._token
+        return token or self.token()
+
+    @staticmethod
+    def _retry_delay(attempt: int, retry_after: str = None) -> float:
+        if retry_after:
+            try:
+                return min(float(retry_after), 60.0)
+            except ValueError:
+                try:
+                    return min(max(parsedate_to_datetime(retry_after).timestamp() - time.time(), 0.0), 60.0)
+                except Exception:
+                    pass
+        return HTTP_BACKOFF_SEC * (2 ** attempt)
+
+    def _send(self, method: str, url: str, endpoint: str, token: str = None, with_token: bool = False,
+              throttle: bool = True, headers: Dict = None, **kw):
+        headers = dict(headers or {})
+        attempt = 0
+        refreshed = False
+        while True:
+            if with_token:
+                headers["Authorization"] = f"Bearer {self._auth_token(token)}"
+            if throttle:
+                API_LIMITER.acquire()
+            self.count(endpoint, "requests")
+            try:
+                r = self.session.request(method, url, headers=headers, **kw)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= HTTP_MAX_RETRIES:
+                    self.count(endpoint, "errors")
+                    raise
+                delay = self._retry_delay(attempt)
+                print(f"[HTTP] {endpoint}: {e.__class__.__name__}, retry in {delay:.1f}s")
+            else:
+                METRICS.add("http_responses", endpoint=endpoint, status=r.status_code)
+                METRICS.set_status(r.status_code)
+                if r.status_code == 401 and with_token and not refreshed and self.client_id:
+                    # токен отозван/истёк раньше срока — берём новый и повторяем один раз
+                    r.close()
+                    refreshed = True
+                    self.token(force=True)
+                    token = None
+                    self.count(endpoint, "retries")
+                    continue
+                if r.status_code not in RETRY_STATUSES or attempt >= HTTP_MAX_RETRIES:
+                    if r.status_code >= 400:
+                        self.count(endpoint, "errors")
+                    if not kw.get("stream"):
+                        self.count(endpoint, "bytes", len(r.content))
+                    return r
+                delay = self._retry_delay(attempt, r.headers.get("Retry-After"))
+                print(f"[HTTP] {endpoint}: HTTP {r.status_code}, retry in {delay:.1f}s")
+                r.close()
+            attempt += 1
+            self.count(endpoint, "retries")
+            time.sleep(delay)
+
+    def get(self, url: str, endpoint: str, token: str = None, **kw):
+        return self._send("GET", url, endpoint, token=token, with_token=True, **kw)
+
+    def report(self) -> str:
+        return "; ".join(
+            f"{ep}: {st['requests']} req, {st['retries']} retries, {st['errors']} errors, {st['bytes'] / 1e6:.1f} MB"
+            for ep, st in sorted(self.stats.items())
+        )
+
+
+BLIZZARD = BlizzardClient(BLIZZARD_CLIENT_ID, BLIZZARD_CLIENT_SECRET)
+
 
 # ----------- BLIZZARD AUTH -----------
-def get_token(client_id: str, client_secret: str) -> str:
+def get_token(client_id: str, client_secret: str, force: bool = False) -> str:
+    # для своих кредов токен живёт в BLIZZARD до истечения; force — взять новый
+    if (client_id, client_secret) == (BLIZZARD.client_id, BLIZZARD.client_secret):
+        return BLIZZARD.token(force=force)
     r = requests.post(BASE_AUTH, data={"grant_type":"client_credentials"}, auth=(client_id, client_secret))
     r.raise_for_status()
     return r.json()["access_token"]
@@ -172,25 +826,224 @@ def human_price(copper: int) -> str:
     c = rem % 100
     return f"{g}g {s}s {c}c"
 
-def send_telegram(text):
-    if not TELEGRAM_TOKEN or not TELEGRAM_CHAT_ID:
+# ----------- TELEGRAM -----------
+class TelegramRetryAfter(Exception):
+    """
+    Telegram ответил 429: повторять не раньше чем через delay секунд.
+    """
+    def __init__(self, delay: float):
+        super().__init__(f"retry after {delay}s")
+        self.delay = delay
+
+
+TELEGRAM_SESSION = requests.Session()
+TELEGRAM_LIMITER = TokenBucket(TELEGRAM_RATE_GLOBAL, TELEGRAM_RATE_GLOBAL)
+
+
+def send_telegram(text, chat_id: str = None):
+    """
+    Одна отправка sendMessage. 429 -> TelegramRetryAfter, прочие ошибки HTTP/сети пробрасываются
+    (ретраи — в AlertQueue).
+    """
+    chat_id = chat_id or TELEGRAM_CHAT_ID
+    if not TELEGRAM_TOKEN or not chat_id:
         print("[TELEGRAM] missing creds; skip")
         return
     url = f"https://api.telegram.org/bot{TELEGRAM_TOKEN}/sendMessage"
     payload = {
-        "chat_id": TELEGRAM_CHAT_ID,
+        "chat_id": chat_id,
         "text": text,
         # parse_mode только если явно включим HTML
         **({"parse_mode": "HTML"} if USE_HTML else {}),
         "disable_web_page_preview": True,
     }
-    try:
-        r = requests.post(url, data=payload, timeout=30)
-        if r.status_code != 200:
-            print(f"[TELEGRAM ERROR] {r.status_code}: {r.text[:400]}")
-            r.raise_for_status()
-    except Exception as e:
-        print("Telegram send failed:", e)
+    r = TELEGRAM_SESSION.post(url, data=payload, timeout=30)
+    if r.status_code == 429:
+        try:
+            delay = float(r.json().get("parameters", {}).get("retry_after", 1))
+        except ValueError:
+            delay = 1.0
+        raise TelegramRetryAfter(delay)
+    if r.status_code != 200:
+        print(f"[TELEGRAM ERROR] {r.status_code}: {r.text[:400]}")
+        r.raise_for_status()
+
+
+def telegram_len(text: str) -> int:
+    # длина так, как её считает Telegram: в единицах UTF-16
+    return len(text.encode("utf-16-le")) // 2
+
+
+def _split_long_line(line: str, limit: int) -> List[str]:
+    if telegram_len(line) <= limit:
+        return [line]
+    out, cur, n = [], [], 0
+    for ch in line:
+        w = 2 if ord(ch) > 0xFFFF else 1
+        if n + w > limit:
+            out.append("".join(cur))
+            cur, n = [], 0
+        cur.append(ch)
+        n += w
+    out.append("".join(cur))
+    return out
+
+
+class AlertQueue:
+    """
+    Исходящая очередь уведомлений. put() кладёт готовый текстовый блок и сразу возвращается;
+    фоновый поток склеивает накопившиеся блоки в сообщения до TELEGRAM_MESSAGE_BUDGET, ждёт лимитеров
+    (на чат и глобального) и ретраит 429/5xx/сетевые ошибки. Метрики: глубина очереди и задержка
+    доставки (от put() до успешной отправки сообщения с блоком).
+    """
+    def __init__(self, chat_id: str = None, regions: List[str] = None, start: bool = True):
+        # start=False — поток отправки запускает подкласс сам, когда донастроит очередь
+        self.chat_id = chat_id or TELEGRAM_CHAT_ID
+        self.header = f"🧭 Найдены лоты ({'+'.join(r.upper() for r in regions or [REGION])})\n"
+        self.buckets = [TokenBucket(TELEGRAM_RATE_PER_CHAT, 1), TELEGRAM_LIMITER]
+        if str(self.chat_id or "").startswith("-"):
+            # группы и каналы: отдельная минутная квота
+            self.buckets.insert(1, TokenBucket(TELEGRAM_GROUP_RATE_PER_MIN / 60.0, TELEGRAM_GROUP_RATE_PER_MIN))
+        self._q = queue.Queue()  # (monotonic ts, text); None — конец
+        self._pending: List[Tuple[float, str]] = []
+        self.stats = {"blocks": 0, "messages": 0, "retries": 0, "dropped": 0, "max_depth": 0}
+        self.latencies: List[float] = []
+        self.linger = TELEGRAM_LINGER_SEC
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._run, name="alert-queue", daemon=True)
+        if start:
+            self._thread.start()
+
+    def depth(self) -> int:
+        return self._q.qsize() + len(self._pending)
+
+    def put(self, block: str):
+        limit = TELEGRAM_MESSAGE_BUDGET - telegram_len(self.header)
+        # блок длиннее сообщения режем по строкам, строку длиннее сообщения — на куски; ничего не теряем
+        parts, cur, size = [], [], 0
+        for ln in block.split("\n"):
+            for piece in _split_long_line(ln, limit):
+                n = telegram_len(piece)
+                if cur and size + 1 + n > limit:
+                    parts.append("\n".join(cur))
+                    cur, size = [], 0
+                size = size + 1 + n if cur else n
+                cur.append(piece)
+        if cur and "\n".join(cur).strip():
+            parts.append("\n".join(cur))
+        now = time.monotonic()
+        for part in parts:
+            self._q.put((now, part))
+        with self._lock:
+            self.stats["blocks"] += len(parts)
+            self.stats["max_depth"] = max(self.stats["max_depth"], self.depth())
+
+    def close(self, timeout: float = None):
+        """
+        Дождаться отправки всего, что уже в очереди (для однократного прогона).
+        """
+        self._q.put(None)
+        self._thread.join(timeout)
+
+    def _collect(self, until: float) -> bool:
+        # добираем блоки до дедлайна или пока не наберётся на полное сообщение; True — очередь закрыта
+        size = sum(telegram_len(t) + 2 for _, t in self._pending)
+        while size < TELEGRAM_MESSAGE_BUDGET:
+            wait = until - time.monotonic()
+            try:
+                item = self._q.get(timeout=wait) if wait > 0 else self._q.get_nowait()
+            except queue.Empty:
+                return False
+            if item is None:
+                return True
+            self._pending.append(item)
+            size += telegram_len(item[1]) + 2
+        return False
+
+    def _pack(self) -> Tuple[str, int]:
+        text, n = self.header, 0
+        size = telegram_len(text)
+        for _, block in self._pending:
+            extra = telegram_len(block) + (2 if n else 0)
+            if n and size + extra > TELEGRAM_MESSAGE_BUDGET:
+                break
+            text += ("\n\n" if n else "") + block
+            size += extra
+            n += 1
+        return text, n
+
+    def _run(self):
+        closed = False
+        while not closed or self._pending:
+            if not self._pending:
+                item = self._q.get()
+                if item is None:
+                    closed = True
+                    continue
+                self._pending.append(item)
+            if not closed:
+                closed = self._collect(self._pending[0][0] + self.linger)
+            for b in self.buckets:
+                b.acquire()
+            if not closed:
+                # пока ждали лимитер, могли прийти ещё блоки
+                closed = self._collect(0)
+            text, n = self._pack()
+            stamps = [ts for ts, _ in self._pending[:n]]
+            del self._pending[:n]
+            self._deliver(text, stamps)
+
+    def _deliver(self, text: str, stamps: List[float]):
+        attempt = 0
+        while True:
+            try:
+                send_telegram(text, self.chat_id)
+                break
+            except TelegramRetryAfter as e:
+                delay = e.delay
+            except requests.HTTPError as e:
+                if e.response is not None and e.response.status_code < 500:
+                    # 400/403 и т.п. повтором не лечатся
+                    with self._lock:
+                        self.stats["dropped"] += len(stamps)
+                    return
+                delay = HTTP_BACKOFF_SEC * (2 ** attempt)
+            except Exception as e:
+                print(f"[TELEGRAM] send failed: {e}")
+                delay = HTTP_BACKOFF_SEC * (2 ** attempt)
+            if attempt >= TELEGRAM_MAX_RETRIES:
+                print(f"[TELEGRAM] giving up after {attempt + 1} attempts; {len(stamps)} alerts dropped")
+                with self._lock:
+                    self.stats["dropped"] += len(stamps)
+                return
+            attempt += 1
+            with self._lock:
+                self.stats["retries"] += 1
+            print(f"[TELEGRAM] retry in {delay:.1f}s")
+            time.sleep(delay)
+        done = time.monotonic()
+        with self._lock:
+            self.stats["messages"] += 1
+            self.latencies.extend(done - ts for ts in stamps)
+
+    def summary(self) -> Dict:
+        with self._lock:
+            st, lat = dict(self.stats), sorted(self.latencies)
+        st["depth"] = self.depth()
+        if lat:
+            st["latency_p50"] = round(lat[len(lat) // 2], 3)
+            st["latency_p95"] = round(lat[min(len(lat) - 1, int(len(lat) * 0.95))], 3)
+            st["latency_max"] = round(lat[-1], 3)
+        return st
+
+    def report(self) -> str:
+        st = self.summary()
+        line = (f"{st['blocks']} alerts -> {st['messages']} messages, {st['retries']} retries, "
+                f"{st['dropped']} dropped, max queue depth {st['max_depth']}, now {st['depth']}")
+        if "latency_p50" in st:
+            line += (f"; delivery latency p50 {st['latency_p50']:.2f}s, p95 {st['latency_p95']:.2f}s, "
+                     f"max {st['latency_max']:.2f}s")
+        return line
 
 
 # ----------- REALMS -----------
@@ -200,12 +1053,10 @@ def get_connected_realms(token: str) -> List[int]:
     1) Пытаемся через официальный индекс connected-realm.
     2) Если он пуст/ломается — fallback: читаем realm index и собираем connected_realm'ы.
     """
-    headers = {"Authorization": f"Bearer {token}"}
-
     # --- Попытка №1: прямой индекс connected-realms
     url_cr = f"{BASE_API}/data/wow/connected-realm/index"
     params_cr = {"namespace": NAMESPACE_DYNAMIC, "locale": "en_US"}
-    r = requests.get(url_cr, headers=headers, params=params_cr, timeout=60)
+    r = BLIZZARD.get(url_cr, "cr_index", token=token, params=params_cr, timeout=60)
     if r.status_code != 200:
         print(f"[DEBUG] CR index HTTP {r.status_code}")
         print(f"[DEBUG] URL: {r.url}")
@@ -233,7 +1084,7 @@ def get_connected_realms(token: str) -> List[int]:
     print("[DEBUG] Fallback to realm index…")
     url_realm = f"{BASE_API}/data/wow/realm/index"
     params_realm = {"namespace": NAMESPACE_DYNAMIC, "locale": "en_US"}
-    rr = requests.get(url_realm, headers=headers, params=params_realm, timeout=60)
+    rr = BLIZZARD.get(url_realm, "realm_index", token=token, params=params_realm, timeout=60)
     if rr.status_code != 200:
         print(f"[DEBUG] Realm index HTTP {rr.status_code}")
         print(f"[DEBUG] URL: {rr.url}")
@@ -262,17 +1113,88 @@ def get_connected_realms(token: str) -> List[int]:
 
 def get_connected_realm_detail(token: str, cr_id: int) -> Dict:
     url = f"{BASE_API}/data/wow/connected-realm/{cr_id}?namespace={NAMESPACE_DYNAMIC}&locale=en_US"
-    headers = {"Authorization": f"Bearer {token}"}
-    r = requests.get(url, headers=headers, timeout=60)
+    r = BLIZZARD.get(url, "cr_detail", token=token, timeout=60)
     r.raise_for_status()
     return r.json()
 
+def realm_names_from_detail(detail: Dict) -> List[str]:
+    # В некоторых ответах "realms" приходит как список словарей,
+    # в редких — попадаются строки/другие типы. Бережно обрабатываем.
+    realms = detail.get("realms", []) if isinstance(detail, dict) else []
+    names = []
+    for realm in realms:
+        if isinstance(realm, dict):
+            name_dict = realm.get("name", {}) if isinstance(realm.get("name", {}), dict) else {}
+            nm = (
+                name_dict.get("en_GB") or  # в EU часто en_GB
+                name_dict.get("en_US") or
+                name_dict.get("ru_RU") or
+                realm.get("slug")
+            )
+            if nm:
+                names.append(nm)
+        # игнорируем строки/нестандартные элементы
+    return names
+
+
+class RealmCache:
+    """
+    Локальный кэш индекса connected realms (TTL REALM_CACHE_TTL_HOURS) и имён реалмов по кластерам.
+    Имена кластеров почти не меняются: храним, пока кластер есть в индексе (или до REFRESH_REALM_CACHE).
+    """
+    FILE = "realms_cache.json"
+
+    def __init__(self, force_refresh: bool = False):
+        state = {} if force_refresh else load_state(self.FILE, {})
+        if state.get("namespace") != NAMESPACE_DYNAMIC:
+            state = {}
+        self.index_ts: float = state.get("index_ts", 0)
+        self.cr_list: List[int] = state.get("cr_list", [])
+        self.names: Dict[str, List[str]] = state.get("names", {})
+
+    def index_fresh(self) -> bool:
+        return bool(self.cr_list) and time.time() - self.index_ts < REALM_CACHE_TTL_HOURS * 3600
+
+    def set_index(self, cr_list: List[int]):
+        self.cr_list = list(cr_list)
+        self.index_ts = time.time()
+        alive = {str(cr) for cr in cr_list}
+        self.names = {k: v for k, v in self.names.items() if k in alive}
+
+    def save(self):
+        save_state(self.FILE, {
+            "namespace": NAMESPACE_DYNAMIC,
+            "index_ts": self.index_ts,
+            "cr_list": self.cr_list,
+            "names": self.names,
+        })
+
+
+def fetch_realm_names(token: str, cr_list: List[int], cache: RealmCache) -> Dict[int, List[str]]:
+    """
+    Имена реалмов по каждому CR: из кэша, а промахи (новые кластеры) — параллельными запросами detail.
+    """
+    misses = [cr for cr in cr_list if str(cr) not in cache.names]
+    if misses:
+        print(f"[INFO] Realm detail cache misses: {len(misses)}/{len(cr_list)}")
+        with ThreadPoolExecutor(max_workers=max(1, REALM_DETAIL_CONCURRENCY)) as pool:
+            futs = {pool.submit(get_connected_realm_detail, token, cr): cr for cr in misses}
+            for fut in as_completed(futs):
+                cr = futs[fut]
+                try:
+                    names = realm_names_from_detail(fut.result())
+                    if names:
+                        cache.names[str(cr)] = names
+                except Exception as e:
+                    print(f"realm detail failed for {cr}: {e}")
+
+    return {cr: cache.names.get(str(cr)) or [f"CR-{cr}"] for cr in cr_list}
+
 # ----------- ITEM SEARCH -----------
 def search_item_id(token: str, name: str) -> tuple[int, str]:
     """
     Возвращает (item_id, display_name) только при точном совпадении по английскому названию (без учёта регистра).
     """
-    headers = {"Authorization": f"Bearer {token}"}
     params = {
         "namespace": NAMESPACE_STATIC,
         "_pageSize": 100,
@@ -281,7 +1203,7 @@ def search_item_id(token: str, name: str) -> tuple[int, str]:
     }
 
     url = f"{BASE_API}/data/wow/search/item"
-    r = requests.get(url, headers=headers, params=params, timeout=60)
+    r = BLIZZARD.get(url, "search_item", token=token, params=params, timeout=60)
     r.raise_for_status()
     data = r.json()
 
@@ -300,14 +1222,500 @@ def search_item_id(token: str, name: str) -> tuple[int, str]:
     raise ValueError(f"Exact English match not found: {name}")
 
 
+# ----------- ITEM CACHE -----------
+class ItemCache:
+    """
+    Персистентный кэш резолва предметов: name -> (id, display_name) и id -> display_name.
+    Привязан к версии формата; записи живут ITEM_CACHE_TTL_DAYS. Общий для всех регионов:
+    id предметов и en_US-имена в static-namespace регионов совпадают, поэтому namespace в файл
+    не пишется и не сверяется — устаревание только по TTL (переименование в патче подхватится
+    не позже чем через ITEM_CACHE_TTL_DAYS).
+    read_only — шард multi-region: читает общий кэш, но не пишет (пишет родительский процесс).
+    """
+    FILE = "items_cache.json"
+    VERSION = 1
+
+    def __init__(self, read_only: bool = False):
+        state = load_state(self.FILE, {})
+        if state.get("version") != self.VERSION:
+            state = {}
+        self.by_name: Dict[str, Dict] = state.get("by_name", {})
+        self.by_id: Dict[str, Dict] = state.get("by_id", {})
+        self.read_only = read_only
+        self.dirty = False
+
+    @staticmethod
+    def _fresh(entry) -> bool:
+        return bool(entry) and time.time() - entry.get("ts", 0) < ITEM_CACHE_TTL_DAYS * 86400
+
+    def name_by_id(self, item_id: int):
+        e = self.by_id.get(str(item_id))
+        return e["name"] if self._fresh(e) else None
+
+    def id_by_name(self, name: str):
+        e = self.by_name.get(name.strip().lower())
+        return (e["id"], e["name"]) if self._fresh(e) else None
+
+    def put_id(self, item_id: int, display_name: str):
+        prev = self.by_id.get(str(item_id)) or {}
+        self.by_id[str(item_id)] = {**prev, "name": display_name, "ts": time.time()}
+        self.dirty = True
+
+    def kind(self, item_id: int):
+        """'commodity' — предмет уже встречался на региональном аукционе товаров; иначе None."""
+        return (self.by_id.get(str(item_id)) or {}).get("kind")
+
+    def set_kind(self, item_id: int, kind: str):
+        e = self.by_id.setdefault(str(item_id), {"name": f"Item ID {item_id}", "ts": 0})
+        if e.get("kind") != kind:
+            e["kind"] = kind
+            self.dirty = True
+
+    def put_name(self, name: str, item_id: int, display_name: str):
+        self.by_name[name.strip().lower()] = {"id": item_id, "name": display_name, "ts": time.time()}
+        self.put_id(item_id, display_name)
+
+    def commodity_ids(self) -> List[int]:
+        return [int(i) for i, e in self.by_id.items() if e.get("kind") == "commodity"]
+
+    def save(self):
+        if self.dirty and not self.read_only:
+            save_state(self.FILE, {
+                "version": self.VERSION,
+                "by_name": self.by_name,
+                "by_id": self.by_id,
+            })
+            self.dirty = False
+
+
+def _row_item(name: str, cache: ItemCache):
+    """
+    Строка листа -> (item_id, имя) по кэшу; None, если имя не резолвится.
+    """
+    # ВАРИАНТ 1: Если в таблице только цифры (ID)
+    if name.isdigit():
+        itm_id = int(name)
+        return itm_id, cache.name_by_id(itm_id) or f"Item ID {itm_id}"
+    # ВАРИАНТ 2: Если в таблице текст — ищем поиск по старинке
+    return cache.id_by_name(name)
+
+
+def resolve_items(token: str, rows, cache: ItemCache = None) -> Tuple[Dict[int, str], Dict[int, float]]:
+    """
+    Резолвит строки листа (name, thr) в id_map (id -> имя) и id_thr (id -> порог в золоте).
+    В API ходим только за строками, которых нет в кэше, и параллельно (под общим API_LIMITER).
+    """
+    cache = cache or ItemCache()
+
+    # списки держат порядок запросов, множества — проверку дублей за O(1) на строку
+    todo_ids, todo_names = [], []
+    seen_ids, seen_names = set(), set()
+    for name, *_ in rows:
+        if name.isdigit():
+            itm_id = int(name)
+            if itm_id not in seen_ids and cache.name_by_id(itm_id) is None:
+                seen_ids.add(itm_id)
+                todo_ids.append(itm_id)
+        elif name.lower() not in seen_names and cache.id_by_name(name) is None:
+            seen_names.add(name.lower())
+            todo_names.append(name)
+
+    errors: Dict[str, Exception] = {}
+    if todo_ids or todo_names:
+        print(f"[INFO] Item cache misses: {len(todo_ids)} ids, {len(todo_names)} names")
+        with ThreadPoolExecutor(max_workers=max(1, ITEM_LOOKUP_CONCURRENCY)) as pool:
+            id_futs = {pool.submit(fetch_item_name, token, i): i for i in todo_ids}
+            name_futs = {pool.submit(search_item_id, token, n): n for n in todo_names}
+            for fut in as_completed(id_futs):
+                itm_id = id_futs[fut]
+                try:
+                    cache.put_id(itm_id, fut.result())
+                except Exception as e:
+                    print(f"[WARN] Failed to fetch name for ID {itm_id}: {e}")
+            for fut in as_completed(name_futs):
+                name = name_futs[fut]
+                try:
+                    itm_id, disp = fut.result()
+                    cache.put_name(name, itm_id, disp)
+                except Exception as e:
+                    errors[name.lower()] = e
+
+    id_map: Dict[int, str] = {}
+    id_thr: Dict[int, float] = {}
+    for (name, per_item_thr, *_) in rows:
+        hit = _row_item(name, cache)
+        if hit is None:
+            print(f"Name -> id not found for '{name}': {errors.get(name.lower())}")
+            continue
+        itm_id, disp = hit
+        id_map[itm_id] = disp
+        id_thr[itm_id] = per_item_thr if per_item_thr is not None else PRICE_THRESHOLD_G
+
+    try:
+        cache.save()
+    except Exception as e:
+        print(f"[WARN] Failed to save item cache: {e}")
+    return id_map, id_thr
+
+
+# ----------- WATCH RULES -----------
+def auction_features(item: Dict) -> set:
+    """
+    Признаки варианта лота: bonus_lists, modifiers, вид и уровень питомца.
+    """
+    feats = {("bonus", b) for b in item.get("bonus_lists") or ()}
+    for m in item.get("modifiers") or ():
+        feats.add(("mod", m.get("type"), m.get("value")))
+    if "pet_species_id" in item:
+        feats.add(("pet", item["pet_species_id"]))
+    if "pet_level" in item:
+        feats.add(("pet_level", item["pet_level"]))
+    return feats
+
+
+def variant_features(variant: Dict) -> frozenset:
+    feats = {("bonus", b) for b in variant.get("bonus", ())}
+    feats.update(("mod", t, v) for t, v in variant.get("modifiers", ()))
+    if "pet_species" in variant:
+        feats.add(("pet", variant["pet_species"]))
+    if "pet_level" in variant:
+        feats.add(("pet_level", variant["pet_level"]))
+    return frozenset(feats)
+
+
+def variant_label(variant: Dict) -> str:
+    parts = []
+    if variant.get("bonus"):
+        parts.append("bonus " + "+".join(map(str, variant["bonus"])))
+    if variant.get("modifiers"):
+        parts.append("mod " + ",".join(f"{t}:{v}" for t, v in variant["modifiers"]))
+    if "pet_species" in variant:
+        parts.append(f"pet {variant['pet_species']}")
+    if "pet_level" in variant:
+        parts.append(f"L{variant['pet_level']}")
+    return " ".join(parts)
+
+
+class RuleIndex:
+    """
+    Скомпилированные правила вотчлиста для предметов, у которых есть варианты или пороги по реалмам.
+    Правило: порог (медь), набор признаков варианта, скоуп CR (None — все реалмы), подпись для алерта.
+    Правило подходит лоту, если все его признаки есть у лота; из подходящих побеждает самое
+    специфичное (со скоупом CR, затем с бОльшим числом признаков), при равенстве — больший порог,
+    затем более поздняя строка листа (как у общих правил) — выбор не зависит от порядка обхода set.
+
+    Диспетчеризация за O(1) от числа правил: item_id -> правила предмета; для правил без признаков
+    лучшее выбрано заранее (общее и по каждому CR), правила с признаками разложены по «якорному»
+    признаку (первому в сортировке) — лот проверяется только против правил, чей якорь у него есть.
+    Предметы с единственным общим правилом попадают в plain (item_id -> порог) и проверяются как раньше.
+    """
+    def __init__(self):
+        self.rules: Dict[int, List[Tuple[int, frozenset, Tuple[str, ...], str]]] = {}
+        self.plain: Dict[int, int] = {}
+        self.items: Dict[int, Tuple] = {}  # item_id -> (лучшее общее, лучшее по CR, якорь -> правила)
+        self.realm_ids: Dict[str, int] = {}
+        # исходные строки (id, порог, вариант) и реалмы из bind_realms — из них правила пересобираются
+        # у воркеров распределённого скана (dump_watch / load_watch)
+        self.rows: List[List] = []
+        self.realm_names: Dict[int, List[str]] = {}
+
+    def add(self, item_id: int, thr_gold: float, variant: Dict = None):
+        variant = variant or {}
+        self.rows.append([str(item_id), thr_gold, variant])
+        feats = variant_features(variant)
+        realms = tuple(sorted(set(variant.get("realms", ()))))
+        rule = (int(thr_gold * COPPER_PER_GOLD), feats, realms, variant_label(variant))
+        rules = self.rules.setdefault(item_id, [])
+        if not feats and not realms:
+            # общее правило предмета одно: как и раньше, последняя строка листа побеждает
+            rules[:] = [r for r in rules if r[1] or r[2]]
+        rules.append(rule)
+
+    def __len__(self):
+        return sum(len(r) for r in self.rules.values())
+
+    def fingerprint(self) -> str:
+        return hashlib.sha1(json.dumps(sorted(
+            [i, thr, sorted(map(list, feats)), list(realms)]
+            for i, rules in self.rules.items() for thr, feats, realms, _ in rules
+        )).encode("utf-8")).hexdigest()
+
+    def max_threshold_gold(self, item_id: int) -> float:
+        return max(r[0] for r in self.rules[item_id]) / COPPER_PER_GOLD
+
+    def bind_realms(self, realm_names_cache: Dict[int, List[str]]):
+        """
+        Сопоставляет реалмы из листа (slug/имя или id CR) с connected realm id и пересобирает индекс.
+        """
+        self.realm_names = realm_names_cache
+        self.realm_ids = {}
+        for cr, names in realm_names_cache.items():
+            self.realm_ids[str(cr)] = cr
+            for n in names:
+                self.realm_ids[realm_slug(n)] = cr
+        unknown = {n for rules in self.rules.values() for r in rules for n in r[2] if n not in self.realm_ids}
+        if unknown and realm_names_cache:
+            print(f"[WARN] Unknown realms in watch rules: {', '.join(sorted(unknown))}")
+        self._compile()
+
+    def _compile(self):
+        self.plain, self.items = {}, {}
+        for item_id, rules in self.rules.items():
+            if len(rules) == 1 and not rules[0][1] and not rules[0][2]:
+                self.plain[item_id] = rules[0][0]
+                continue
+            general, by_cr, anchored = None, {}, {}
+            for row, (thr, feats, realms, label) in enumerate(rules):
+                crs = frozenset(self.realm_ids[n] for n in realms if n in self.realm_ids) if realms else None
+                if realms and not crs:
+                    continue  # ни один реалм правила не найден — правило не действует
+                rule = (thr, feats, crs, label, (crs is not None, len(feats), thr, row))
+                if feats:
+                    anchored.setdefault(min(feats), []).append(rule)
+                elif crs is None:
+                    general = rule
+                else:
+                    for cr in crs:
+                        if cr not in by_cr or rule[4] > by_cr[cr][4]:
+                            by_cr[cr] = rule
+            self.items[item_id] = (general, by_cr, anchored)
+
+    def match(self, item_id: int, cr_id: int, item: Dict):
+        """
+        Порог и подпись правила для лота item на CR cr_id (0 — аукцион товаров); None — правил нет.
+        """
+        thr = self.plain.get(item_id)
+        if thr is not None:
+            return thr, ""
+        compiled = self.items.get(item_id)
+        if compiled is None:
+            return None
+        general, by_cr, anchored = compiled
+        # правило по CR специфичнее общего
+        best = by_cr.get(cr_id, general)
+        if anchored:
+            feats = auction_features(item)
+            for f in feats:
+                for rule in anchored.get(f, ()):
+                    if rule[1] <= feats and (rule[2] is None or cr_id in rule[2]) \
+                            and (best is None or rule[4] > best[4]):
+                        best = rule
+        return (best[0], best[3]) if best is not None else None
+
+
+def compile_rules(rows, cache: ItemCache, id_map: Dict[int, str], id_thr: Dict[int, float]):
+    """
+    Строки листа -> RuleIndex. None, если вариантов и порогов по реалмам нет (обычный матчинг по id_thr).
+    id_thr для предметов с правилами поднимается до максимального порога — грубый префильтр.
+    """
+    if not any(len(row) > 2 and row[2] for row in rows):
+        return None
+    rules = RuleIndex()
+    for name, thr, *rest in rows:
+        hit = _row_item(name, cache)
+        if hit is None or hit[0] not in id_map:
+            continue
+        rules.add(hit[0], thr if thr is not None else PRICE_THRESHOLD_G, rest[0] if rest else None)
+    for item_id in rules.rules:
+        id_thr[item_id] = rules.max_threshold_gold(item_id)
+    rules.bind_realms({})
+    n_var = len(rules) - len(rules.plain)
+    print(f"[INFO] Watch rules: {len(rules)} ({n_var} variant/per-realm rules on {len(rules.items)} items)")
+    return rules
+
+
 # ----------- AUCTIONS -----------
-def get_auctions_for_connected_realm(token: str, cr_id: int) -> Dict:
-    url = f"{BASE_API}/data/wow/connected-realm/{cr_id}/auctions"
+_AUCTIONS_ARRAY_RE = re.compile(r'"auctions"\s*:\s*\[')
+_SKIP_SEPARATORS_RE = re.compile(r"[\s,]*")
+
+def iter_auctions_filtered(chunks, wanted_ids=None):
+    """
+    Потоково разбирает тело ответа /auctions (итератор кусков bytes) и отдаёт только
+    аукционы, у которых item.id входит в wanted_ids (None — все подряд).
+    Весь документ в память не собираем: держим только недоразобранный хвост буфера,
+    каждый аукцион декодируется по одному и сразу отбрасывается, если не нужен.
+    """
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder("utf-8")()
+    chunks = iter(chunks)
+    buf = ""
+    pos = 0
+    eof = False
+    parsed = 0
+
+    def read_more() -> str:
+        nonlocal eof
+        for chunk in chunks:
+            if chunk:
+                return utf8.decode(chunk)
+        eof = True
+        return utf8.decode(b"", final=True)
+
+    # 1) доматываем до начала массива "auctions"
+    while True:
+        m = _AUCTIONS_ARRAY_RE.search(buf)
+        if m:
+            pos = m.end()
+            break
+        if eof:
+            return
+        # хвост оставляем, вдруг ключ разрезан между кусками
+        buf = buf[-32:] + read_more()
+
+    # 2) декодируем элементы массива по одному
+    try:
+        while True:
+            pos = _SKIP_SEPARATORS_RE.match(buf, pos).end()
+            if pos < len(buf):
+                if buf[pos] == "]":
+                    return
+                try:
+                    a, end = decoder.raw_decode(buf, pos)
+                except json.JSONDecodeError:
+                    # объект обрезан концом куска — дочитаем и попробуем ещё раз
+                    if eof:
+                        raise
+                else:
+                    pos = end
+                    parsed += 1
+                    item = a.get("item") or {}
+                    if wanted_ids is None or item.get("id") in wanted_ids:
+                        yield a
+                    continue
+            if eof:
+                raise ValueError("Truncated auctions payload")
+            buf = buf[pos:] + read_more()
+            pos = 0
+    finally:
+        METRICS.add("auctions_parsed", parsed)
+
+def threshold_copper_map(id_map: Dict[int, str], id_thr: Dict[int, float]) -> Dict[int, int]:
+    """
+    Пороги в меди для каждого предмета из вотчлиста — считаем один раз, а не на каждый аукцион.
+    """
+    out = {}
+    for item_id in id_map:
+        thr_gold = id_thr.get(item_id)
+        if thr_gold is None:
+            thr_gold = PRICE_THRESHOLD_G  # запасной фолбэк
+        out[item_id] = int(thr_gold * COPPER_PER_GOLD)
+    return out
+
+
+_ITEM_KEY = '"item"'
+_COMPACT_ITEM_KEY = '"item":{"id":'
+
+
+def _digits_trie_pattern(ids) -> str:
+    # альтернатива по префиксному дереву цифр: на каждом лоте regex отваливается за 1-2 символа,
+    # а не перебирает все id вотчлиста подряд
+    trie = {}
+    for s in map(str, ids):
+        node = trie
+        for ch in s:
+            node = node.setdefault(ch, {})
+        node[""] = {}
+
+    def emit(node) -> str:
+        alts = [k + emit(v) if k else "" for k, v in sorted(node.items())]
+        return alts[0] if len(alts) == 1 else "(?:" + "|".join(alts) + ")"
+
+    return emit(trie)
+
+
+_WATCHED_ITEM_RE_CACHE: Dict[frozenset, "re.Pattern"] = {}
+
+
+def _watched_item_re(wanted_ids) -> "re.Pattern":
+    key = frozenset(i for i in wanted_ids if isinstance(i, int) and i >= 0)
+    pattern = _WATCHED_ITEM_RE_CACHE.get(key)
+    if pattern is None:
+        pattern = re.compile(re.escape(_COMPACT_ITEM_KEY) + _digits_trie_pattern(key) + r"(?![0-9])")
+        if len(_WATCHED_ITEM_RE_CACHE) >= 8:
+            _WATCHED_ITEM_RE_CACHE.clear()
+        _WATCHED_ITEM_RE_CACHE[key] = pattern
+    return pattern
+
+
+def decode_watched_auctions(body: bytes, wanted_ids) -> Tuple[List[Dict], int]:
+    """
+    Сырое тело /auctions -> (аукционы предметов из wanted_ids, всего аукционов в снапшоте).
+    json.loads всего тела не делаем: regex по '"item":{"id":<id из вотчлиста>' находит нужные лоты,
+    raw_decode разбирает только их. Быстрый путь — для компактного JSON Blizzard (у каждого лота
+    item начинается с id); если это не так или объект лота не собрался — честный json.loads.
+    """
+    text = body.decode("utf-8")
+    total = text.count(_ITEM_KEY)
+    if not wanted_ids:
+        return [], total
+    if total == text.count(_COMPACT_ITEM_KEY):
+        decoder = json.JSONDecoder()
+        out = []
+        for m in _watched_item_re(wanted_ids).finditer(text):
+            # ключи лота перед item — скаляры ("id"), так что ближайшая '{' слева — начало лота
+            start = text.rfind("{", 0, m.start())
+            try:
+                a, _ = decoder.raw_decode(text, start)
+            except json.JSONDecodeError:
+                break
+            if not isinstance(a, dict) or (a.get("item") or {}).get("id") not in wanted_ids:
+                break
+            out.append(a)
+        else:
+            return out, total
+    auctions = json.loads(text).get("auctions", [])
+    return [a for a in auctions if (a.get("item") or {}).get("id") in wanted_ids], len(auctions)
+
+def _fetch_auctions_url(token: str, url: str, endpoint: str, last_modified: str = None,
+                        wanted_ids=None, raw: bool = False) -> Tuple[Dict, str]:
+    """
+    Условный запрос аукционов: при last_modified шлём If-Modified-Since.
+    Возвращает (auctions_json | None при 304, значение Last-Modified из ответа).
+    При STREAM_AUCTIONS и заданном wanted_ids вместо r.json() отдаём
+    {"auctions": <генератор только нужных аукционов>} — тело читается по мере обхода.
+    raw — сырое тело (bytes) без разбора: его разбирает пул DECODE_WORKERS.
+    """
+    stream = STREAM_AUCTIONS and wanted_ids is not None and not raw
     params = {"namespace": NAMESPACE_DYNAMIC, "locale": "en_US"}
-    headers = {"Authorization": f"Bearer {token}"}
-    r = requests.get(url, headers=headers, params=params, timeout=120)
+    headers = {"If-Modified-Since": last_modified} if last_modified else {}
+    r = BLIZZARD.get(url, endpoint, token=token, params=params, headers=headers, timeout=120, stream=stream)
+    if r.status_code == 304:
+        r.close()
+        return None, last_modified
     r.raise_for_status()
-    return r.json()
+    if stream:
+        return {"auctions": _iter_response_auctions(r, endpoint, wanted_ids)}, r.headers.get("Last-Modified")
+    if raw:
+        return r.content, r.headers.get("Last-Modified")
+    return r.json(), r.headers.get("Last-Modified")
+
+def fetch_auctions_if_modified(token: str, cr_id: int, last_modified: str = None,
+                               wanted_ids=None, raw: bool = False) -> Tuple[Dict, str]:
+    url = f"{BASE_API}/data/wow/connected-realm/{cr_id}/auctions"
+    return _fetch_auctions_url(token, url, "auctions", last_modified, wanted_ids, raw)
+
+def fetch_commodities_if_modified(token: str, last_modified: str = None,
+                                  wanted_ids=None, raw: bool = False) -> Tuple[Dict, str]:
+    """
+    Региональный аукцион товаров: один payload на весь регион, у лотов unit_price вместо buyout.
+    """
+    url = f"{BASE_API}/data/wow/auctions/commodities"
+    return _fetch_auctions_url(token, url, "commodities", last_modified, wanted_ids, raw)
+
+def _iter_response_auctions(r, endpoint: str, wanted_ids):
+    def chunks():
+        for chunk in r.iter_content(chunk_size=STREAM_CHUNK_BYTES):
+            BLIZZARD.count(endpoint, "bytes", len(chunk))
+            yield chunk
+
+    try:
+        yield from iter_auctions_filtered(chunks(), wanted_ids)
+    finally:
+        r.close()
+
+def get_auctions_for_connected_realm(token: str, cr_id: int) -> Dict:
+    aj, _ = fetch_auctions_if_modified(token, cr_id)
+    return aj
 
 def check_items_in_auctions(auctions_json: Dict, item_ids: Dict[int, str], threshold_gold: float) -> List[Dict]:
     found = []
@@ -338,11 +1746,15 @@ def check_items_in_auctions(auctions_json: Dict, item_ids: Dict[int, str], thres
     return found
 def check_items_in_auctions_per_item(auctions_json: Dict,
                                      item_ids: Dict[int, str],
-                                     id_to_threshold_gold: Dict[int, float]) -> List[Dict]:
+                                     id_to_threshold_gold: Dict[int, float],
+                                     watched_lots: Dict[int, List] = None) -> List[Dict]:
     """
     То же, что check_items_in_auctions, только порог берём из per-item словаря id_to_threshold_gold.
+    watched_lots — если передан, в том же проходе копим (цена за штуку, qty, auction_id) по всем
+    лотам отслеживаемых предметов, а не только прошедшим порог (история цен, дифф снапшотов).
     """
     found = []
+    thresholds = threshold_copper_map(item_ids, id_to_threshold_gold)
     for a in auctions_json.get("auctions", []):
         item = a.get("item", {})
         item_id = item.get("id")
@@ -350,18 +1762,20 @@ def check_items_in_auctions_per_item(auctions_json: Dict,
             continue
         if item_id not in item_ids:
             continue
-        buyout = a.get("buyout")
         quantity = a.get("quantity", 1)
-        if not buyout or quantity <= 0:
-            continue
-        per_unit = buyout // quantity
-
-        thr_gold = id_to_threshold_gold.get(item_id)
-        if thr_gold is None:
-            thr_gold = PRICE_THRESHOLD_G  # запасной фолбэк
-        thr_copper = int(thr_gold * COPPER_PER_GOLD)
-
-        if per_unit <= thr_copper:
+        # у лотов товаров (commodities) цена сразу за штуку, у обычных — buyout за весь лот
+        unit_price = a.get("unit_price")
+        if unit_price:
+            per_unit = unit_price
+        else:
+            buyout = a.get("buyout")
+            if not buyout or quantity <= 0:
+                continue
+            per_unit = buyout // quantity
+        if watched_lots is not None:
+            watched_lots.setdefault(item_id, []).append((per_unit, quantity, a.get("id")))
+
+        if per_unit <= thresholds[item_id]:
             found.append({
                 "item_id": item_id,
                 "item_name": item_ids[item_id],
@@ -373,189 +1787,2045 @@ def check_items_in_auctions_per_item(auctions_json: Dict,
             })
     return found
 
-def main():
-    # 1) токен
-    token = get_token(BLIZZARD_CLIENT_ID, BLIZZARD_CLIENT_SECRET)
+def check_items_with_rules(auctions_json: Dict, item_ids: Dict[int, str], rules: RuleIndex, cr_id: int,
+                           watched_lots: Dict[int, List] = None) -> List[Dict]:
+    """
+    Построчный матчинг по RuleIndex: порог зависит от варианта лота и CR. Находки по правилу
+    с вариантом помечаются полем rule (best_per_item не схлопывает разные варианты одного предмета).
+    """
+    found = []
+    for a in auctions_json.get("auctions", []):
+        item = a.get("item", {})
+        item_id = item.get("id")
+        if item_id not in item_ids:
+            continue
+        quantity = a.get("quantity", 1)
+        unit_price = a.get("unit_price")
+        if unit_price:
+            per_unit = unit_price
+        else:
+            buyout = a.get("buyout")
+            if not buyout or quantity <= 0:
+                continue
+            per_unit = buyout // quantity
+        if watched_lots is not None:
+            watched_lots.setdefault(item_id, []).append((per_unit, quantity, a.get("id")))
+
+        hit = rules.match(item_id, cr_id, item)
+        if hit is None or per_unit > hit[0]:
+            continue
+        thr_copper, label = hit
+        rec = {
+            "item_id": item_id,
+            "item_name": f"{item_ids[item_id]} [{label}]" if label else item_ids[item_id],
+            "per_unit_copper": per_unit,
+            "quantity": quantity,
+            "auction_id": a.get("id"),
+            "time_left": a.get("time_left"),
+            "owner": a.get("owner", "unknown"),
+            "threshold_copper": thr_copper,
+        }
+        if label:
+            rec["rule"] = label
+        found.append(rec)
+    return found
 
-    # 2) читаем список предметов + индивидуальные пороги из Google Sheet
-    rows = load_items_with_thresholds(GSHEET_SPREADSHEET_ID, GSHEET_WORKSHEET_NAME)
-    if not rows:
-        print("No item names in the sheet. Exit quietly.")
-        return
-    
-# 3) резолвим в item_id и собираем два словаря:
-    id_map: Dict[int, str] = {}
-    id_thr: Dict[int, float] = {}
+def match_auctions(auctions_json: Dict, id_map: Dict[int, str], id_thr: Dict[int, float],
+                   watched_lots: Dict[int, List] = None, rules: RuleIndex = None, cr_id: int = 0) -> List[Dict]:
+    """
+    Точка входа матчинга для скана: с правилами по вариантам/реалмам — через RuleIndex,
+    иначе check_items_in_auctions_per_item.
+    """
+    if rules is not None:
+        return check_items_with_rules(auctions_json, id_map, rules, cr_id, watched_lots)
+    return check_items_in_auctions_per_item(auctions_json, id_map, id_thr, watched_lots)
 
-    for (name, per_item_thr) in rows:
-        # ВАРИАНТ 1: Если в таблице только цифры (ID)
-        if name.isdigit():
-            itm_id = int(name)
-            
-            # --- МАГИЯ ТУТ: Спрашиваем имя у API ---
-            print(f"[INFO] Fetching name for ID {itm_id}...")
-            pretty_name = get_item_name_by_id(token, itm_id)
-            # ---------------------------------------
-            
-            id_map[itm_id] = pretty_name
-            id_thr[itm_id] = per_item_thr if per_item_thr is not None else PRICE_THRESHOLD_G
+
+# ----------- DECODE POOL -----------
+_DECODE_POOL = None
+_DECODE_POOL_LOCK = threading.Lock()
+
+
+def decode_pool():
+    """
+    Пул процессов для разбора тел /auctions (создаётся при первом обращении; None — DECODE_WORKERS=0).
+    spawn: воркеры не наследуют потоки и сокеты сканера. Первыми обращаются потоки скана —
+    создание под блокировкой, иначе двое могут поднять по пулу.
+    """
+    global _DECODE_POOL
+    if _DECODE_POOL is None and DECODE_WORKERS > 0:
+        with _DECODE_POOL_LOCK:
+            if _DECODE_POOL is None:
+                _DECODE_POOL = ProcessPoolExecutor(max_workers=DECODE_WORKERS,
+                                                   mp_context=multiprocessing.get_context("spawn"))
+    return _DECODE_POOL
+
+
+def shutdown_decode_pool():
+    global _DECODE_POOL
+    with _DECODE_POOL_LOCK:
+        pool, _DECODE_POOL = _DECODE_POOL, None
+    if pool is not None:
+        pool.shutdown()
+
+
+def _tap_seen(auctions, id_map: Dict[int, str], seen: set):
+    # попутно запоминаем, какие предметы вотчлиста вообще есть в снапшоте
+    for a in auctions:
+        item_id = (a.get("item") or {}).get("id")
+        if item_id in id_map:
+            seen.add(item_id)
+        yield a
+
+
+def decode_match_worker(body: bytes, id_map: Dict[int, str], id_thr: Dict[int, float], want_lots: bool,
+                        rules, cr_id: int, want_seen: bool, reduce: bool):
+    """
+    Задача пула: разбор сырого тела, матчинг и (reduce) лучший лот на предмет.
+    Родителю возвращаются только находки, лоты вотчлиста и встреченные id — не весь снапшот.
+    """
+    seen = set() if want_seen else None
+    auctions, parsed = decode_watched_auctions(body, id_map)
+    found, lots = match_payload({"auctions": auctions}, id_map, id_thr, want_lots, rules, cr_id, seen)
+    if reduce:
+        found = list(best_per_item(found).values())
+    return found, lots, seen, parsed
+
+
+def match_payload(aj, id_map: Dict[int, str], id_thr: Dict[int, float], want_lots: bool = False,
+                  rules=None, cr_id: int = 0, seen: set = None,
+                  reduce: bool = False) -> Tuple[List[Dict], Dict]:
+    """
+    Матчинг скачанного снапшота: dict (r.json() или потоковый генератор) — в текущем потоке,
+    bytes — в пуле DECODE_WORKERS (без пула — здесь же; разбираются только лоты вотчлиста,
+    см. decode_watched_auctions). Возвращает (находки, лоты вотчлиста | None); seen пополняется
+    id встреченных предметов вотчлиста.
+    """
+    if isinstance(aj, bytes):
+        pool = decode_pool()
+        if pool is not None:
+            found, lots, got, parsed = pool.submit(
+                decode_match_worker, aj, id_map, id_thr, want_lots, rules, cr_id, seen is not None, reduce
+            ).result()
+            METRICS.add("auctions_parsed", parsed)
+            if seen is not None:
+                seen.update(got)
+            return found, lots
+        auctions, parsed = decode_watched_auctions(aj, id_map)
+        METRICS.add("auctions_parsed", parsed)
+    else:
+        auctions = aj.get("auctions", [])
+        if isinstance(auctions, list):
+            # потоковый генератор считает разобранные аукционы сам
+            METRICS.add("auctions_parsed", len(auctions))
+    if seen is not None:
+        auctions = _tap_seen(auctions, id_map, seen)
+    lots = {} if want_lots else None
+    with MATCH_PROFILER.measure():
+        found = match_auctions({"auctions": auctions}, id_map, id_thr, lots, rules, cr_id)
+    return found, lots
+
+
+# ----------- PRICE HISTORY -----------
+COMMODITIES_REALM = 0  # «реалм» регионального аукциона товаров в истории цен
+
+
+def _weighted_percentile(sorted_lots: List[Tuple[int, int]], total_qty: int, q: float) -> int:
+    # процентиль цены за штуку с весом по количеству: цена, на которой набирается q от всего объёма
+    need = q * total_qty
+    acc = 0
+    for price, qty in sorted_lots:
+        acc += qty
+        if acc >= need:
+            return price
+    return sorted_lots[-1][0]
+
+
+def summarize_price_stats(watched_lots: Dict[int, List]) -> Dict[int, Tuple[int, int, int, int]]:
+    """
+    item_id -> (min, p10, median, total_qty) по ценам за штуку; процентили взвешены количеством.
+    """
+    out = {}
+    for item_id, lots in watched_lots.items():
+        if not lots:
             continue
+        weighted = sorted((p, max(q, 1)) for p, q, _ in lots)
+        total = sum(q for _, q in weighted)
+        out[item_id] = (weighted[0][0], _weighted_percentile(weighted, total, 0.10),
+                        _weighted_percentile(weighted, total, 0.50), sum(q for _, q, _ in lots))
+    return out
 
-        # ВАРИАНТ 2: Если в таблице текст — ищем поиск по старинке
-        try:
-            itm_id, disp = search_item_id(token, name)
-            id_map[itm_id] = disp
-            id_thr[itm_id] = per_item_thr if per_item_thr is not None else PRICE_THRESHOLD_G
-        except Exception as e:
-            print(f"Name -> id not found for '{name}': {e}")
 
+class PriceHistory:
+    """
+    История цен в SQLite. price_history — одна строка на предмет × CR × скан, но только если сводка
+    отличается от прошлой записанной для этого предмета и CR: значение действует до следующей строки,
+    неизменный снапшот (повторный 200, replay того же блоба) ничего не пишет. Только целые, таблица
+    WITHOUT ROWID с первичным ключом под запросы «предмет [+ реалм] за период».
+    prune() сворачивает сырые строки старше PRICE_HISTORY_RAW_DAYS в price_history_daily (min минимумов
+    и медиана медиан за сутки UTC) и удаляет дневные старше PRICE_HISTORY_RETENTION_DAYS; звать
+    регулярно (скан — после прохода, демон — по таймеру).
+    Сканирующие потоки складывают сводки в буфер, flush() пишет их одной транзакцией на скан.
+    """
+    FILE = "price_history.sqlite"
+
+    def __init__(self, path: str = None):
+        if path is None:
+            path = _state_path(self.FILE)
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS price_history (
+                item_id INTEGER NOT NULL,
+                realm INTEGER NOT NULL,
+                ts INTEGER NOT NULL,
+                min_copper INTEGER NOT NULL,
+                p10_copper INTEGER NOT NULL,
+                median_copper INTEGER NOT NULL,
+                quantity INTEGER NOT NULL,
+                PRIMARY KEY (item_id, realm, ts)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS price_history_ts ON price_history (ts);
+            CREATE TABLE IF NOT EXISTS price_history_daily (
+                item_id INTEGER NOT NULL,
+                realm INTEGER NOT NULL,
+                day INTEGER NOT NULL,
+                min_copper INTEGER NOT NULL,
+                median_copper INTEGER NOT NULL,
+                PRIMARY KEY (item_id, realm, day)
+            ) WITHOUT ROWID;
+        """)
+        self.scan_ts = int(time.time())
+        self._pending: List[Tuple] = []
+        # realm -> {item_id: сводка} последней записанной строки: с ней сравниваем новые
+        self._last: Dict[int, Dict[int, Tuple]] = {}
+        for item_id, realm, *summary in self.db.execute(
+                "SELECT item_id, realm, min_copper, p10_copper, median_copper, quantity, MAX(ts) "
+                "FROM price_history GROUP BY item_id, realm"):
+            self._last.setdefault(realm, {})[item_id] = tuple(summary[:4])
+        self._lock = threading.Lock()
+
+    def begin_scan(self, ts: float = None):
+        self.scan_ts = int(ts if ts is not None else time.time())
+
+    def add(self, realm: int, watched_lots: Dict[int, List]):
+        summaries = summarize_price_stats(watched_lots)
+        with self._lock:
+            # предметы, пропавшие из снапшота, забываем: вернутся — запишутся заново
+            last, self._last[realm] = self._last.get(realm, {}), summaries
+            self._pending.extend((item_id, realm, self.scan_ts, *summary)
+                                 for item_id, summary in summaries.items() if last.get(item_id) != summary)
+
+    def flush(self) -> int:
+        with self._lock:
+            rows, self._pending = self._pending, []
+        if rows:
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO price_history VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+        return len(rows)
+
+    def rollup(self, raw_days: float = PRICE_HISTORY_RAW_DAYS) -> int:
+        """
+        Сырые строки за сутки UTC целиком старше raw_days -> price_history_daily. Возвращает число дневных строк.
+        """
+        cutoff = int(time.time() - raw_days * 86400) // 86400 * 86400
+        daily: Dict[Tuple[int, int, int], Tuple[List[int], List[int]]] = {}
+        for item_id, realm, ts, min_copper, median_copper in self.db.execute(
+                "SELECT item_id, realm, ts, min_copper, median_copper FROM price_history WHERE ts < ?", (cutoff,)):
+            mins, medians = daily.setdefault((item_id, realm, ts - ts % 86400), ([], []))
+            mins.append(min_copper)
+            medians.append(median_copper)
+        rows = [(*key, min(mins), sorted(medians)[len(medians) // 2]) for key, (mins, medians) in daily.items()]
+        with self.db:
+            # сутки, уже свёрнутые раньше (replay старого архива), — минимум уточняем, медиану оставляем
+            self.db.executemany(
+                "INSERT INTO price_history_daily VALUES (?, ?, ?, ?, ?) ON CONFLICT (item_id, realm, day) "
+                "DO UPDATE SET min_copper = MIN(min_copper, excluded.min_copper)", rows)
+            self.db.execute("DELETE FROM price_history WHERE ts < ?", (cutoff,))
+        return len(rows)
+
+    def prune(self, retention_days: float = PRICE_HISTORY_RETENTION_DAYS):
+        self.rollup()
+        with self.db:
+            self.db.execute("DELETE FROM price_history_daily WHERE day < ?",
+                            (int(time.time() - retention_days * 86400),))
+
+    def range(self, item_id: int, since: float, until: float = None, realm: int = None) -> List[Tuple]:
+        """
+        [(realm, ts, min, p10, median, qty)] по предмету за [since, until], по ключу без сканов таблицы.
+        """
+        sql = ("SELECT realm, ts, min_copper, p10_copper, median_copper, quantity FROM price_history "
+               "WHERE item_id = ? AND ts BETWEEN ? AND ?")
+        args = [item_id, int(since), int(until if until is not None else time.time())]
+        if realm is not None:
+            sql += " AND realm = ?"
+            args.append(realm)
+        return self.db.execute(sql + " ORDER BY ts", args).fetchall()
+
+    def daily(self, item_id: int, since: float, until: float = None, realm: int = None) -> List[Tuple]:
+        """
+        [(realm, day, min, median)] свёрнутой истории по предмету за [since, until].
+        """
+        sql = ("SELECT realm, day, min_copper, median_copper FROM price_history_daily "
+               "WHERE item_id = ? AND day BETWEEN ? AND ?")
+        args = [item_id, int(since), int(until if until is not None else time.time())]
+        if realm is not None:
+            sql += " AND realm = ?"
+            args.append(realm)
+        return self.db.execute(sql + " ORDER BY day", args).fetchall()
+
+    def baseline(self, item_id: int, days: float = 7, realm: int = None) -> Dict:
+        """
+        Скользящая база за последние days суток: медиана минимумов и медиан по строкам (изменениям
+        сводки, не сканам), p10 минимумов. days не больше PRICE_HISTORY_RAW_DAYS — дальше только daily().
+        """
+        rows = self.range(item_id, time.time() - days * 86400, realm=realm)
+        if not rows:
+            return {}
+        mins = sorted(r[2] for r in rows)
+        medians = sorted(r[4] for r in rows)
+        return {
+            "samples": len(rows),
+            "min_copper": mins[0],
+            "p10_min_copper": mins[len(mins) // 10],
+            "median_min_copper": mins[len(mins) // 2],
+            "median_median_copper": medians[len(medians) // 2],
+        }
+
+    def close(self):
+        self.db.close()
+
+# ----------- SNAPSHOT ARCHIVE -----------
+def _http_date_ts(value: str, default: float) -> int:
+    try:
+        return int(parsedate_to_datetime(value).timestamp())
+    except (TypeError, ValueError):
+        return int(default)
+
+
+class SnapshotArchive:
+    """
+    Архив сырых снапшотов для бэктеста. Тела сжимаются zlib и дописываются в сегмент на сутки
+    (YYYYMMDD.seg); индекс SQLite — снапшот (CR или commodities) × проход скана -> (сегмент,
+    смещение, длина) и время снапшота по Last-Modified. Неизменный снапшот (тот же Last-Modified,
+    в т.ч. 304) второй раз не пишется: строка индекса ссылается на уже сохранённый блоб.
+    304 без сохранённого блоба (архив включили позже кэша, блоб удалён по сроку) пишется в gaps —
+    replay предупреждает о снапшотах, которых в проходе нет.
+    Чтение — срезом mmap сегмента, без загрузки файла целиком.
+    """
+    INDEX = "index.sqlite"
+
+    def __init__(self, path: str = None):
+        if path is None:
+            path = os.path.join(SNAPSHOT_ARCHIVE_DIR, REGION) if SNAPSHOT_ARCHIVE_DIR else _state_path("snapshot_archive")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.db = sqlite3.connect(os.path.join(path, self.INDEX))
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS snapshots (
+                key TEXT NOT NULL,
+                scan_ts INTEGER NOT NULL,
+                ts INTEGER NOT NULL,
+                last_modified TEXT,
+                segment TEXT NOT NULL,
+                pos INTEGER NOT NULL,
+                length INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                PRIMARY KEY (key, scan_ts)
+            ) WITHOUT ROWID;
+            CREATE INDEX IF NOT EXISTS snapshots_scan ON snapshots (scan_ts);
+            CREATE TABLE IF NOT EXISTS gaps (
+                key TEXT NOT NULL,
+                scan_ts INTEGER NOT NULL,
+                last_modified TEXT,
+                PRIMARY KEY (key, scan_ts)
+            ) WITHOUT ROWID;
+        """)
+        # (key, ts) -> (сегмент, смещение, длина, размер тела): по нему и дедуплицируем
+        self.blobs: Dict[Tuple[str, int], Tuple] = {
+            (key, ts): blob for key, ts, *blob in
+            self.db.execute("SELECT key, ts, segment, pos, length, size FROM snapshots")
+        }
+        self.scan_ts = int(time.time())
+        self.written = 0
+        self._pending: List[Tuple] = []
+        self._gaps: List[Tuple] = []
+        self._out = None  # (имя сегмента, файл) — текущий сегмент записи
+        self._maps: Dict[str, mmap.mmap] = {}
+        self._lock = threading.Lock()
+
+    def begin_scan(self, ts: float = None):
+        self.scan_ts = int(ts if ts is not None else time.time())
+        self.written = 0
+
+    def put(self, key, body: bytes, last_modified: str = None):
+        """
+        body — сырое тело ответа; None — 304: проход ссылается на блоб с тем же Last-Modified, если он есть.
+        """
+        key = str(key)
+        ts = _http_date_ts(last_modified, self.scan_ts)
+        with self._lock:
+            blob = self.blobs.get((key, ts))
+        if blob is None:
+            if body is None:
+                with self._lock:
+                    self._gaps.append((key, self.scan_ts, last_modified))
+                return
+            # сжимаем вне блокировки: zlib отпускает GIL, потоки скана жмут параллельно
+            data = zlib.compress(body, SNAPSHOT_ARCHIVE_LEVEL)
+            segment = time.strftime("%Y%m%d", time.gmtime(self.scan_ts)) + ".seg"
+            with self._lock:
+                if self._out is None or self._out[0] != segment:
+                    if self._out is not None:
+                        self._out[1].close()
+                    self._out = (segment, open(os.path.join(self.path, segment), "ab"))
+                f = self._out[1]
+                blob = (segment, f.tell(), len(data), len(body))
+                f.write(data)
+                self.blobs[(key, ts)] = blob
+                self.written += len(data)
+        with self._lock:
+            self._pending.append((key, self.scan_ts, ts, last_modified, *blob))
+
+    def flush(self) -> int:
+        # сначала данные сегмента, потом индекс: строка индекса не может указывать на недописанный блоб
+        with self._lock:
+            rows, self._pending = self._pending, []
+            gaps, self._gaps = self._gaps, []
+            if self._out is not None:
+                self._out[1].flush()
+        if rows or gaps:
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+                self.db.executemany("INSERT OR REPLACE INTO gaps VALUES (?, ?, ?)", gaps)
+        if gaps:
+            print(f"[WARN] Snapshot archive: {len(gaps)} snapshots answered 304 with no archived body, "
+                  f"replay will miss them")
+        return len(rows)
+
+    def passes(self, since: float, until: float) -> List[Tuple[int, Dict[str, Tuple]]]:
+        """
+        Проходы скана за [since, until]: [(scan_ts, {key: (last_modified, сегмент, смещение, длина, размер)})].
+        """
+        out = []
+        for scan_ts, key, *row in self.db.execute(
+                "SELECT scan_ts, key, last_modified, segment, pos, length, size FROM snapshots "
+                "WHERE scan_ts BETWEEN ? AND ? ORDER BY scan_ts", (int(since), int(until))):
+            if not out or out[-1][0] != scan_ts:
+                out.append((scan_ts, {}))
+            out[-1][1][key] = tuple(row)
+        return out
+
+    def gaps(self, since: float, until: float) -> Dict[int, List[str]]:
+        """
+        Снапшоты, которых нет в проходах за [since, until]: {scan_ts: [key]}.
+        """
+        out = {}
+        for scan_ts, key in self.db.execute("SELECT scan_ts, key FROM gaps WHERE scan_ts BETWEEN ? AND ? "
+                                            "ORDER BY scan_ts, key", (int(since), int(until))):
+            out.setdefault(scan_ts, []).append(key)
+        return out
+
+    def read(self, row: Tuple) -> Tuple[bytes, str]:
+        """
+        Строка из passes() -> (сырое тело, Last-Modified).
+        """
+        last_modified, segment, pos, length, size = row
+        with self._lock:
+            mm = self._maps.get(segment)
+            if mm is None or pos + length > len(mm):
+                # сегмент мог дорасти после того, как мы его отобразили: старое отображение закрываем
+                # (срез ниже берётся под той же блокировкой, так что чужой read его не держит)
+                if mm is not None:
+                    mm.close()
+                with open(os.path.join(self.path, segment), "rb") as f:
+                    mm = self._maps[segment] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            blob = mm[pos:pos + length]
+        return zlib.decompress(blob, bufsize=size), last_modified
+
+    def prune(self, retention_days: float = SNAPSHOT_ARCHIVE_DAYS):
+        cutoff = int(time.time() - retention_days * 86400)
+        with self.db:
+            self.db.execute("DELETE FROM snapshots WHERE scan_ts < ?", (cutoff,))
+            self.db.execute("DELETE FROM gaps WHERE scan_ts < ?", (cutoff,))
+        alive = {seg for (seg,) in self.db.execute("SELECT DISTINCT segment FROM snapshots")}
+        with self._lock:
+            if self._out is not None:
+                alive.add(self._out[0])
+            self.blobs = {k: b for k, b in self.blobs.items() if b[0] in alive}
+            for segment in [seg for seg in self._maps if seg not in alive]:
+                self._maps.pop(segment).close()
+        for name in os.listdir(self.path):
+            if name.endswith(".seg") and name not in alive:
+                os.remove(os.path.join(self.path, name))
+
+    def close(self):
+        with self._lock:
+            if self._out is not None:
+                self._out[1].close()
+                self._out = None
+            for mm in self._maps.values():
+                mm.close()
+            self._maps = {}
+        self.db.close()
+
+# ----------- WORK QUEUE -----------
+class WorkQueue:
+    """
+    Общая очередь CR распределённого скана (RUN_MODE=coordinator / worker) в SQLite-файле.
+    Координатор публикует проход: вотчлист (JSON, dump_watch) и CR в порядке приоритета с Last-Modified из своего
+    кэша снапшотов. Воркеры берут CR в аренду, сканируют условным запросом и сдают компактные находки
+    (лучший лот на предмет) в JSON; на 304 находки подставляет координатор. Просроченная
+    аренда (воркер упал или завис) снова доступна; сдача принимается только от текущего арендатора,
+    так что каждый CR попадает в сводку ровно один раз. Соединение одно на объект, под блокировкой:
+    запросы крошечные, а потоки воркера делят его между собой.
+    """
+    FILE = "work_queue.sqlite"
+    KEEP_RUNS_SEC = 86400  # закрытые проходы старше суток удаляются при публикации
+
+    def __init__(self, path: str = None):
+        path = path or WORK_QUEUE or _state_path(self.FILE)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        # isolation_level=None — транзакции явные: захват CR — BEGIN IMMEDIATE, без гонки между SELECT и UPDATE
+        self.db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS runs (
+                run_id TEXT PRIMARY KEY,
+                region TEXT NOT NULL,
+                created REAL NOT NULL,
+                closed INTEGER NOT NULL DEFAULT 0,
+                watch TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS tasks (
+                run_id TEXT NOT NULL,
+                cr_id INTEGER NOT NULL,
+                seq INTEGER NOT NULL,
+                state TEXT NOT NULL DEFAULT 'queued',
+                worker TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                collected INTEGER NOT NULL DEFAULT 0,
+                last_modified TEXT,
+                result TEXT,
+                PRIMARY KEY (run_id, cr_id)
+            );
+            CREATE INDEX IF NOT EXISTS tasks_state ON tasks (run_id, state, seq);
+        """)
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _tx(self):
+        with self._lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.db
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+
+    def publish(self, region: str, watch: str, cr_list: List[int], last_modified: Dict[int, str] = None) -> str:
+        """
+        Новый проход региона (watch — dump_watch); незакрытые прошлые (координатор упал) закрываются.
+        Возвращает run_id.
+        """
+        last_modified = last_modified or {}
+        now = time.time()
+        run_id = f"{region}-{int(now * 1000):x}"
+        with self._tx() as db:
+            old = [r for r, in db.execute("SELECT run_id FROM runs WHERE closed = 1 AND created < ?",
+                                          (now - self.KEEP_RUNS_SEC,))]
+            db.executemany("DELETE FROM tasks WHERE run_id = ?", [(r,) for r in old])
+            db.executemany("DELETE FROM runs WHERE run_id = ?", [(r,) for r in old])
+            db.execute("UPDATE runs SET closed = 1 WHERE region = ?", (region,))
+            db.execute("INSERT INTO runs (run_id, region, created, watch) VALUES (?, ?, ?, ?)",
+                       (run_id, region, now, watch))
+            db.executemany("INSERT INTO tasks (run_id, cr_id, seq, last_modified) VALUES (?, ?, ?, ?)",
+                           [(run_id, cr, seq, last_modified.get(cr)) for seq, cr in enumerate(cr_list)])
+        return run_id
+
+    def open_run(self, region: str):
+        """
+        Последний открытый проход региона -> (run_id, watch — JSON из dump_watch) или None.
+        """
+        with self._lock:
+            row = self.db.execute("SELECT run_id, watch FROM runs WHERE region = ? AND closed = 0 "
+                                  "ORDER BY created DESC LIMIT 1", (region,)).fetchone()
+        return (row[0], row[1]) if row else None
+
+    def claim(self, run_id: str, worker: str):
+        """
+        Следующий CR прохода в аренду worker'у: из очереди или с просроченной арендой.
+        Возвращает (cr_id, Last-Modified прошлого снапшота | None); None — брать нечего.
+        """
+        now = time.time()
+        with self._tx() as db:
+            row = db.execute("""
+                SELECT t.cr_id, t.worker, t.state, t.last_modified FROM tasks t JOIN runs r ON r.run_id = t.run_id
+                WHERE t.run_id = ? AND r.closed = 0 AND (t.state = 'queued'
+                    OR (t.state = 'leased' AND t.lease_until < ? AND t.attempts < ?))
+                ORDER BY t.seq LIMIT 1
+            """, (run_id, now, WORK_MAX_ATTEMPTS)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE tasks SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1 "
+                       "WHERE run_id = ? AND cr_id = ?", (worker, now + WORK_LEASE_SEC, run_id, row[0]))
+        if row[2] == "leased":
+            print(f"[WORK] CR {row[0]}: lease of {row[1]} expired, re-queued to {worker}")
+        return row[0], row[3]
+
+    def complete(self, run_id: str, cr_id: int, worker: str, result: Dict) -> bool:
+        """
+        Сдаёт находки CR. False — аренду уже перехватил другой воркер, результат отброшен.
+        Опоздавший с последней попытки (аренда просрочена, но никому не ушла) ещё принимается.
+        """
+        with self._tx() as db:
+            cur = db.execute("UPDATE tasks SET state = 'done', result = ? WHERE run_id = ? AND cr_id = ? "
+                             "AND (state = 'leased' OR (state = 'failed' AND result IS NULL)) AND worker = ?",
+                             (json.dumps(result, ensure_ascii=False, separators=(",", ":")), run_id, cr_id, worker))
+        return cur.rowcount == 1
+
+    def fail(self, run_id: str, cr_id: int, worker: str, error: str):
+        # ошибка скана — CR возвращается в очередь, пока есть попытки
+        with self._tx() as db:
+            db.execute("UPDATE tasks SET state = CASE WHEN attempts < ? THEN 'queued' ELSE 'failed' END, result = ? "
+                       "WHERE run_id = ? AND cr_id = ? AND state = 'leased' AND worker = ?",
+                       (WORK_MAX_ATTEMPTS, json.dumps({"error": error}), run_id, cr_id, worker))
+
+    def collect(self, run_id: str) -> List[Tuple[int, Dict]]:
+        """
+        Сданные с прошлого вызова CR -> [(cr_id, result)].
+        """
+        with self._tx() as db:
+            rows = db.execute("SELECT cr_id, result FROM tasks WHERE run_id = ? AND state = 'done' AND collected = 0",
+                              (run_id,)).fetchall()
+            db.executemany("UPDATE tasks SET collected = 1 WHERE run_id = ? AND cr_id = ?",
+                           [(run_id, cr) for cr, _ in rows])
+        return [(cr, json.loads(result)) for cr, result in rows]
+
+    def pending(self, run_id: str) -> int:
+        """
+        Сколько CR прохода ещё не сдано; аренды, просроченные на последней попытке, — провал.
+        """
+        with self._tx() as db:
+            db.execute("UPDATE tasks SET state = 'failed' WHERE run_id = ? AND state = 'leased' "
+                       "AND lease_until < ? AND attempts >= ?", (run_id, time.time(), WORK_MAX_ATTEMPTS))
+            return db.execute("SELECT COUNT(*) FROM tasks WHERE run_id = ? AND state IN ('queued', 'leased')",
+                              (run_id,)).fetchone()[0]
+
+    def cancel_queued(self, run_id: str) -> List[int]:
+        """
+        Снимает ещё не взятые CR прохода (бюджет скана исчерпан; взятые доигрываются). Возвращает их по порядку.
+        """
+        with self._tx() as db:
+            crs = [cr for cr, in db.execute("SELECT cr_id FROM tasks WHERE run_id = ? AND state = 'queued' "
+                                            "ORDER BY seq", (run_id,))]
+            db.execute("UPDATE tasks SET state = 'skipped' WHERE run_id = ? AND state = 'queued'", (run_id,))
+        return crs
+
+    def close_run(self, run_id: str) -> Dict:
+        """
+        Закрывает проход (воркеры перестают брать его CR). Возвращает итог по состояниям CR и число перевыдач.
+        """
+        with self._tx() as db:
+            db.execute("UPDATE runs SET closed = 1 WHERE run_id = ?", (run_id,))
+            out = dict(db.execute("SELECT state, COUNT(*) FROM tasks WHERE run_id = ? GROUP BY state", (run_id,)))
+            out["re_leased"] = db.execute("SELECT COALESCE(SUM(attempts - 1), 0) FROM tasks "
+                                          "WHERE run_id = ? AND attempts > 1", (run_id,)).fetchone()[0]
+        return out
+
+    def close(self):
+        self.db.close()
+
+
+def dump_watch(id_map: Dict[int, str], id_thr: Dict[int, float], rules: RuleIndex = None) -> str:
+    """
+    Вотчлист прохода для воркеров — только данные (JSON, без pickle): id_map, id_thr,
+    строки правил (id, порог, вариант) и реалмы, к которым правила привязаны.
+    """
+    return json.dumps({
+        "id_map": sorted(id_map.items()),
+        "id_thr": sorted(id_thr.items()),
+        "rules": rules.rows if rules is not None else None,
+        "realms": sorted(rules.realm_names.items()) if rules is not None else [],
+    }, ensure_ascii=False, separators=(",", ":"))
+
+
+def load_watch(text: str, item_cache: ItemCache):
+    """
+    JSON из dump_watch -> (id_map, id_thr, rules): правила пересобираются compile_rules + bind_realms.
+    """
+    state = json.loads(text)
+    id_map = {int(i): n for i, n in state["id_map"]}
+    id_thr = {int(i): float(t) for i, t in state["id_thr"]}
+    rules = None
+    if state.get("rules"):
+        rules = compile_rules([tuple(row) for row in state["rules"]], item_cache, id_map, id_thr)
+        if rules is not None:
+            rules.bind_realms({int(cr): names for cr, names in state["realms"]})
+    return id_map, id_thr, rules
+
+
+# ----------- СКАН РЕАЛМОВ -----------
+def best_per_item(found: List[Dict]) -> Dict[int, Dict]:
+    """
+    По одному предмету на connected realm оставляем самый дешёвый per-unit и суммарный qty по этой цене.
+    """
+    per_item_best = {}  # item_id -> rec
+
+    for f in found:
+        item_id = f.get("item_id")
+        item_name = f["item_name"]
+        price_copper = f["per_unit_copper"]
+        qty = int(f["quantity"])
+        auc = f.get("auction_id")
+        time_left = str(f.get("time_left", ""))
+        # варианты предмета из правил (bonus_lists, питомцы) — отдельными записями
+        key = (item_id, f["rule"]) if f.get("rule") else item_id
+
+        cur = per_item_best.get(key)
+        if cur is None or price_copper < cur["per_unit_copper"]:
+            per_item_best[key] = {
+                "item_id": item_id,
+                "item_name": item_name,
+                "per_unit_copper": price_copper,
+                "quantity": qty,
+                "auction_id": auc,
+                "time_left": time_left,
+            }
+            for extra in ("threshold_copper", "rule"):
+                if extra in f:
+                    per_item_best[key][extra] = f[extra]
+        else:
+            # если нашлась дороже — игнорируем, если такая же — докидываем количество
+            if price_copper == cur["per_unit_copper"]:
+                cur["quantity"] += qty
+    return per_item_best
+
+
+class TopOffers:
+    """
+    Потоковая сводка находок для алертов: (item_id, item_name) -> K самых дешёвых предложений
+    по всем реалмам (куча фиксированного размера, на вершине — самое дорогое из оставленных)
+    и накопительные итоги: сколько CR, суммарное количество по лучшим ценам, диапазон порогов.
+    Память — предметы × K, а не предметы × реалмы; итог не зависит от порядка прихода реалмов
+    (равные цены разводим по auction_id и имени реалма). k=0 — без ограничения.
+    (SnapshotCache при SNAPSHOT_CACHE=1 отдельно держит лучшие находки каждого CR — см. там.)
+    """
+    def __init__(self, k: int = ALERT_TOP_K):
+        self.k = k
+        self.items: Dict[Tuple[int, str], Dict] = {}
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def _agg(self, key) -> Dict:
+        agg = self.items.get(key)
+        if agg is None:
+            agg = self.items[key] = {"top": [], "realms": 0, "quantity": 0, "thresholds": None}
+        return agg
+
+    def _offer(self, agg: Dict, realm_str: str, rec: Dict):
+        top = agg["top"]
+        full = self.k and len(top) >= self.k
+        if full and -rec["per_unit_copper"] < top[0][0]:
+            return  # дороже всех оставленных — типичный случай, кортеж не собираем
+        entry = (-rec["per_unit_copper"], -(rec.get("auction_id") or 0), realm_str, rec)
+        if not full:
+            heapq.heappush(top, entry)
+        elif entry > top[0]:
+            heapq.heapreplace(top, entry)
+
+    @staticmethod
+    def _count(agg: Dict, realms: int, quantity: int, thresholds):
+        agg["realms"] += realms
+        agg["quantity"] += quantity
+        if thresholds is not None:
+            lo, hi = agg["thresholds"] or thresholds
+            agg["thresholds"] = (min(lo, thresholds[0]), max(hi, thresholds[1]))
+
+    def add(self, realm_str: str, per_item_best: Dict) -> set:
+        """
+        Находки одного CR (best_per_item) — по одной записи на предмет: из вариантов правил самая дешёвая.
+        Возвращает ключи затронутых предметов.
+        """
+        best: Dict[Tuple[int, str], Dict] = {}
+        for rec in per_item_best.values():
+            key = (rec["item_id"], rec["item_name"])
+            if key not in best or rec["per_unit_copper"] < best[key]["per_unit_copper"]:
+                best[key] = rec
+        for key, rec in best.items():
+            agg = self._agg(key)
+            thr = rec.get("threshold_copper")
+            self._count(agg, 1, int(rec["quantity"]), None if thr is None else (thr, thr))
+            self._offer(agg, realm_str, rec)
+        return set(best)
+
+    def merge(self, other: "TopOffers", relabel=None):
+        """
+        Сводка другого шарда: итоги складываются, кучи сливаются (K лучших из объединения —
+        среди K лучших каждой части). relabel(realm_str) -> новое имя реалма.
+        """
+        for key, src in other.items.items():
+            agg = self._agg(key)
+            self._count(agg, src["realms"], src["quantity"], src["thresholds"])
+            for _, _, realm_str, rec in src["top"]:
+                self._offer(agg, relabel(realm_str) if relabel else realm_str, rec)
+
+    def offers(self, key) -> List[Tuple[str, Dict]]:
+        """
+        [(realm_str, rec)] предмета от дешёвых к дорогим.
+        """
+        return [(realm_str, rec) for _, _, realm_str, rec in
+                sorted(self.items[key]["top"], key=lambda e: (-e[0], -e[1], e[2]))]
+
+
+def watch_fingerprint(id_map: Dict[int, str], id_thr: Dict[int, float], rules: RuleIndex = None) -> str:
+    watch = [sorted(id_map.items()), sorted(id_thr.items())]
+    if rules is not None:
+        watch.append(rules.fingerprint())
+    return hashlib.sha1(json.dumps(watch, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+class SnapshotCache:
+    """
+    Last-Modified и находки по каждому connected realm с прошлого запуска.
+    Находки переиспользуются только для того же вотчлиста (сверяем отпечаток id_map + id_thr + правил).
+    Хранится ровно то, что нужно по 304, — лучшая цена на предмет (вариант) в CR, то есть
+    CR × найденные предметы; это держится в памяти весь проход и пишется в auction_snapshots.json.
+    Граница TopOffers (предметы × K) относится к сводке алертов, не к этому кэшу.
+    """
+    FILE = "auction_snapshots.json"
+
+    def __init__(self, id_map: Dict[int, str], id_thr: Dict[int, float], rules: RuleIndex = None):
+        self.watch_key = watch_fingerprint(id_map, id_thr, rules)
+        state = load_state(self.FILE, {})
+        self.realms = state.get("realms", {}) if state.get("watch_key") == self.watch_key else {}
+        self.skipped = 0
+        self.unchanged = set()  # ключи, отданные из кэша по 304 в текущем проходе
+        self._lock = threading.Lock()
+
+    def begin_pass(self):
+        self.skipped = 0
+        self.unchanged = set()
+
+    def last_modified(self, cr_id: int):
+        return (self.realms.get(str(cr_id)) or {}).get("last_modified")
+
+    def cached_found(self, cr_id: int) -> List[Dict]:
+        with self._lock:
+            self.skipped += 1
+            self.unchanged.add(str(cr_id))
+        return list(self.realms[str(cr_id)]["found"])
+
+    def store(self, cr_id: int, last_modified: str, found: List[Dict]):
+        if last_modified:
+            # по 304 находки идут только в best_per_item -> TopOffers: все лоты ниже порога не нужны
+            best = list(best_per_item(found).values())
+            # пишут потоки скана (и сборщик находок воркеров) — под той же блокировкой, что cached_found
+            with self._lock:
+                self.realms[str(cr_id)] = {"last_modified": last_modified, "found": best}
+
+    def seed(self, cr_id: int, last_modified: str):
+        """
+        Только Last-Modified без находок (воркер: условный запрос по значению координатора, по 304 сдавать нечего).
+        """
+        with self._lock:
+            self.realms.pop(str(cr_id), None)
+            if last_modified:
+                self.realms[str(cr_id)] = {"last_modified": last_modified, "found": []}
+
+    def save(self):
+        with self._lock:
+            realms = dict(self.realms)
+        save_state(self.FILE, {"watch_key": self.watch_key, "realms": realms})
+
+
+class SnapshotDiff:
+    """
+    Память о лотах отслеживаемых предметов по каждому CR (и аукциону товаров) с прошлого скана:
+    отсортированные auction_id и параллельные им цены за штуку и id предметов (array('q') в base64 —
+    компактно в JSON). update() считает новые и снятые лоты множественными операциями, а «подешевевшие» —
+    по предмету в CR: цену существующего лота Blizzard не меняет, дешевле становится лучший лот предмета.
+    persist=False — только в памяти (replay не трогает состояние живого скана).
+    """
+    FILE = "seen_auctions.json"
+    DELTAS_FILE = "snapshot_deltas.json"
+
+    def __init__(self, persist: bool = True):
+        self.persist = persist
+        self.realms: Dict[str, Dict[str, str]] = load_state(self.FILE, {}).get("realms", {}) if persist else {}
+        self.deltas: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _pack(values) -> str:
+        return base64.b64encode(array("q", values).tobytes()).decode("ascii")
+
+    @staticmethod
+    def _unpack(text: str) -> array:
+        out = array("q")
+        out.frombytes(base64.b64decode(text))
+        return out
+
+    def update(self, key, watched_lots: Dict[int, List]) -> Dict:
+        """
+        -> {"new": auction_id, "removed": auction_id, "cheaper": {item_id: (прошлый лучший, текущий лучший)}}.
+        """
+        cur, cur_best = {}, {}
+        for item_id, lots in watched_lots.items():
+            for per_unit, _, auction_id in lots:
+                if auction_id:
+                    cur[auction_id] = (per_unit, item_id)
+            if lots:
+                cur_best[item_id] = min(p for p, _, _ in lots)
+        with self._lock:
+            prev_state = self.realms.get(str(key))
+        prev_ids, prev_best = set(), {}
+        if prev_state:
+            prev_ids = set(self._unpack(prev_state["ids"]))
+            # состояние без id предметов (старый формат) — сравнивать лучшие цены не с чем
+            if "items" in prev_state:
+                for per_unit, item_id in zip(self._unpack(prev_state["prices"]), self._unpack(prev_state["items"])):
+                    if per_unit < prev_best.get(item_id, per_unit + 1):
+                        prev_best[item_id] = per_unit
+
+        cur_ids = set(cur)
+        delta = {
+            "new": cur_ids - prev_ids,
+            "removed": prev_ids - cur_ids,
+            "cheaper": {i: (prev_best[i], p) for i, p in cur_best.items() if i in prev_best and p < prev_best[i]},
+        }
+        ids = sorted(cur)
+        with self._lock:
+            self.realms[str(key)] = {"ids": self._pack(ids), "prices": self._pack(cur[a][0] for a in ids),
+                                     "items": self._pack(cur[a][1] for a in ids)}
+            self.deltas[str(key)] = {
+                "new": sorted(delta["new"]),
+                "removed": sorted(delta["removed"]),
+                "cheaper": [[i, was, now] for i, (was, now) in sorted(delta["cheaper"].items())],
+            }
+        return delta
+
+    def save(self):
+        if not self.persist:
+            self.deltas = {}
+            return
+        save_state(self.FILE, {"realms": self.realms})
+        # дельты последнего скана — для внешних потребителей
+        save_state(self.DELTAS_FILE, {"ts": int(time.time()), "realms": self.deltas})
+        self.deltas = {}
+
+
+class RealmStats:
+    """
+    Статистика CR между запусками для порядка скана: скользящие средние (EWMA) числа предметов
+    с находками, секунд и байт на полный снапшот, Last-Modified последнего снапшота и период обновления.
+    Находки относятся к вотчлисту: при смене отпечатка они сбрасываются, время и размер — нет.
+    """
+    FILE = "realm_stats.json"
+    ALPHA = 0.3         # вес нового наблюдения в EWMA
+    STALE_WEIGHT = 0.2  # CR, чей снапшот по прогнозу ещё не обновился (ответит 304 с прошлыми находками)
+    EXPLORE = 0.1       # прибавка к ценности: сам по себе и за каждый запуск, не попавший в бюджет
+
+    def __init__(self, watch_key: str):
+        state = load_state(self.FILE, {})
+        self.watch_key = watch_key
+        self.realms: Dict[str, Dict] = state.get("realms", {})
+        if state.get("watch_key") != watch_key:
+            for e in self.realms.values():
+                e.pop("hits", None)
+        self._lock = threading.Lock()
+
+    def _ewma(self, e: Dict, field: str, value: float):
+        e[field] = value if field not in e else round(e[field] + self.ALPHA * (value - e[field]), 4)
+
+    def observe(self, cr_id: int, found: List[Dict], rec: Dict, last_modified: str):
+        """
+        Итог скана CR: found — его находки, rec — запись METRICS.realm (секунды, байты, 304).
+        """
+        ts = _http_date_ts(last_modified, 0) if last_modified else 0
+        with self._lock:
+            e = self.realms.setdefault(str(cr_id), {})
+            self._ewma(e, "hits", len({f["item_id"] for f in found}))
+            if not rec["not_modified"]:
+                # 304 почти ничего не стоит — стоимость учим только по полным снапшотам
+                self._ewma(e, "sec", rec["sec"])
+                self._ewma(e, "bytes", rec["http_bytes"])
+            prev = e.get("last_modified_ts")
+            if ts and prev and 0 < ts - prev < 6 * 3600:
+                self._ewma(e, "period", ts - prev)
+            if ts:
+                e["last_modified_ts"] = ts
+            e["scanned"] = int(time.time())
+            e["missed"] = 0
+
+    def skipped(self, cr_ids):
+        with self._lock:
+            for cr in cr_ids:
+                e = self.realms.setdefault(str(cr), {})
+                e["missed"] = e.get("missed", 0) + 1
+
+    def score(self, cr_id: int, now: float, default_sec: float) -> float:
+        """
+        Ожидаемые предметы с находками на секунду скана. CR без статистики по этому вотчлисту — первыми.
+        """
+        e = self.realms.get(str(cr_id)) or {}
+        if "hits" not in e:
+            return math.inf
+        value = e["hits"] + self.EXPLORE * (1 + e.get("missed", 0))
+        lm = e.get("last_modified_ts")
+        if lm and now < lm + e.get("period", DAEMON_DEFAULT_PERIOD_SEC):
+            value *= self.STALE_WEIGHT
+        return value / max(e.get("sec", default_sec), 0.01)
+
+    def order(self, cr_list: List[int], now: float = None) -> List[int]:
+        now = now or time.time()
+        secs = sorted(e["sec"] for e in self.realms.values() if "sec" in e)
+        default_sec = secs[len(secs) // 2] if secs else 1.0
+
+        def key(cr):
+            # при равной ценности (в т.ч. у новых CR) — сначала дешёвые
+            return -self.score(cr, now, default_sec), (self.realms.get(str(cr)) or {}).get("sec", default_sec), cr
+        return sorted(cr_list, key=key)
+
+    def save(self):
+        save_state(self.FILE, {"watch_key": self.watch_key, "realms": self.realms})
+
+
+class ScanBudget:
+    """
+    Бюджет скана реалмов на запуск: секунды с создания и число снапшотов CR (0 — без ограничения).
+    allow() решает, начинать ли следующий CR (начатые доигрываются); skipped — CR, не попавшие в бюджет.
+    """
+    def __init__(self, seconds: float = 0, max_requests: int = 0):
+        self.deadline = time.time() + seconds if seconds > 0 else None
+        self.max_requests = max_requests
+        self.started = 0
+        self.skipped: List[int] = []
+
+    @classmethod
+    def from_env(cls):
+        if SCAN_BUDGET_SEC <= 0 and SCAN_BUDGET_REQUESTS <= 0:
+            return None
+        return cls(SCAN_BUDGET_SEC, SCAN_BUDGET_REQUESTS)
+
+    def allow(self) -> bool:
+        if self.max_requests and self.started >= self.max_requests:
+            return False
+        if self.deadline is not None and time.time() >= self.deadline:
+            return False
+        self.started += 1
+        return True
+
+
+class ScanContext:
+    """
+    Побочные хранилища скана, общие для всех реалмов: кэш снапшотов (304), история цен, дифф лотов,
+    очередь уведомлений (алерты уходят по мере готовности, а не после всего скана),
+    а также правила вотчлиста по вариантам/реалмам (None — хватает id_thr).
+    archive — архив сырых снапшотов: при replay (проход из archive.passes()) снапшоты читаются
+    из него вместо API, иначе каждое скачанное тело дописывается в архив.
+    stats — статистика CR для порядка скана, budget — лимит времени/запросов на проход по CR.
+    work — очередь распределённого скана: CR сканируют воркеры, здесь только собираем их находки.
+    """
+    def __init__(self, snap_cache: SnapshotCache = None, history: PriceHistory = None,
+                 differ: SnapshotDiff = None, alerts: AlertQueue = None, rules: RuleIndex = None,
+                 archive: SnapshotArchive = None, replay: Dict[str, Tuple] = None,
+                 stats: RealmStats = None, budget: ScanBudget = None, work: WorkQueue = None):
+        self.snap_cache = snap_cache
+        self.history = history
+        self.differ = differ
+        self.alerts = alerts
+        self.rules = rules
+        self.archive = archive
+        self.replay = replay
+        self.stats = stats
+        self.budget = budget
+        self.work = work
+
+
+def _match_snapshot(key, aj, last_modified: str, id_map: Dict[int, str], id_thr: Dict[int, float],
+                    ctx: ScanContext, history_realm: int, seen: set = None) -> List[Dict]:
+    """
+    Общая часть скана снапшота (CR или товары): матчинг + история + дифф + кэш для 304.
+    aj is None — снапшот не менялся (304); bytes — сырое тело для пула DECODE_WORKERS.
+    """
+    new_only = ALERT_MODE == "new" and ctx.differ is not None
+    if aj is None:
+        # 304: снапшот не менялся — берём прошлые находки (в режиме new новых лотов нет)
+        METRICS.add("not_modified")
+        found = ctx.snap_cache.cached_found(key)
+        return [] if new_only else found
+
+    # для фильтра по новым лотам нужны все лоты ниже порога, а не только лучший на предмет
+    found, lots = match_payload(aj, id_map, id_thr, ctx.history is not None or ctx.differ is not None,
+                                rules=ctx.rules, cr_id=history_realm, seen=seen, reduce=not new_only)
+    if ctx.history is not None:
+        ctx.history.add(history_realm, lots)
+    if ctx.snap_cache is not None:
+        # кэшируем все находки и в режиме new: тот же кэш (ключ — вотчлист, не режим) прочтёт и ALERT_MODE=all
+        ctx.snap_cache.store(key, last_modified, found)
+    if ctx.differ is not None:
+        delta = ctx.differ.update(key, lots)
+        if new_only:
+            found = [f for f in found if f["auction_id"] in delta["new"] or f["item_id"] in delta["cheaper"]]
+    METRICS.add("matches", len(found))
+    return found
+
+
+def _load_snapshot(token: str, key, id_map: Dict[int, str], ctx: ScanContext):
+    """
+    Снапшот key (id CR или "commodities") -> (тело | None при 304, Last-Modified): условным запросом
+    к API с записью в архив или, при replay, из архива.
+    """
+    if ctx.replay is not None:
+        return ctx.archive.read(ctx.replay[str(key)])
+    last_modified = ctx.snap_cache.last_modified(key) if ctx.snap_cache is not None else None
+    # сырое тело разбирает decode_watched_auctions — только лоты вотчлиста, без json.loads всего снапшота;
+    # r.json() остаётся разве что потоковому разбору (STREAM_AUCTIONS)
+    raw = not STREAM_AUCTIONS or decode_pool() is not None or ctx.archive is not None
+    if key == "commodities":
+        aj, last_modified = fetch_commodities_if_modified(token, last_modified, wanted_ids=id_map, raw=raw)
+    else:
+        aj, last_modified = fetch_auctions_if_modified(token, key, last_modified, wanted_ids=id_map, raw=raw)
+    if ctx.archive is not None:
+        ctx.archive.put(key, aj, last_modified)
+    return aj, last_modified
+
+
+def scan_realm(token: str, cr_id: int, id_map: Dict[int, str], id_thr: Dict[int, float],
+               ctx: ScanContext = None) -> List[Dict]:
+    ctx = ctx or ScanContext()
+    with METRICS.realm(cr_id) as rec:
+        aj, last_modified = _load_snapshot(token, cr_id, id_map, ctx)
+        found = _match_snapshot(cr_id, aj, last_modified, id_map, id_thr, ctx, cr_id)
+    if ctx.stats is not None:
+        ctx.stats.observe(cr_id, found, rec, last_modified)
+    return found
+
+
+def scan_commodities(token: str, id_map: Dict[int, str], id_thr: Dict[int, float],
+                     ctx: ScanContext = None) -> Tuple[List[Dict], set]:
+    """
+    Скан регионального аукциона товаров. Возвращает (находки, id предметов из вотчлиста,
+    которые вообще встретились в payload) — по ним классифицируем предметы как commodity.
+    """
+    ctx = ctx or ScanContext()
+    key = "commodities"
+    with METRICS.realm(key):
+        aj, last_modified = _load_snapshot(token, key, id_map, ctx)
+        seen = set()
+        found = _match_snapshot(key, aj, last_modified, id_map, id_thr, ctx, COMMODITIES_REALM, seen)
+    return found, seen
+
+
+def iter_realm_scans(token: str, cr_list: List[int], id_map: Dict[int, str], id_thr: Dict[int, float],
+                     ctx: ScanContext = None):
+    """
+    Генератор (cr_id, found); реалмы с ошибкой пропускаются.
+    SCAN_CONCURRENCY <= 1 — старый последовательный путь со sleep между реалмами (при replay без пауз).
+    Иначе качаем пулом потоков под общим API_LIMITER и отдаём результаты по мере готовности:
+    TopOffers от порядка не зависит, так что буфер для восстановления порядка cr_list не нужен.
+    С ctx.budget CR стартуют по порядку cr_list, пока бюджет позволяет; остальные — в budget.skipped.
+    """
+    budget = ctx.budget if ctx is not None else None
+    todo = iter(cr_list)
+
+    def next_cr():
+        cr = next(todo, None)
+        if cr is not None and budget is not None and not budget.allow():
+            budget.skipped = [cr, *todo]
+            return None
+        return cr
 
-    # 4) берём все EU connected realms
+    if SCAN_CONCURRENCY <= 1:
+        for cr in iter(next_cr, None):
+            try:
+                found = scan_realm(token, cr, id_map, id_thr, ctx)
+            except Exception as e:
+                print(f"CR {cr} fetch error: {e}")
+                time.sleep(1)
+                continue
+            yield cr, found
+            if ctx is None or ctx.replay is None:
+                time.sleep(SLEEP_BETWEEN_REALMS_SEC)
+        return
+
+    with ThreadPoolExecutor(max_workers=SCAN_CONCURRENCY) as pool:
+        def submit() -> bool:
+            cr = next_cr()
+            if cr is not None:
+                futures[pool.submit(scan_realm, token, cr, id_map, id_thr, ctx)] = cr
+            return cr is not None
+
+        # без бюджета ставим в пул все CR сразу; с бюджетом в полёте не больше SCAN_CONCURRENCY,
+        # чтобы каждый следующий CR проверял бюджет в момент старта
+        futures = {}
+        while (budget is None or len(futures) < SCAN_CONCURRENCY) and submit():
+            pass
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for fut in done:
+                cr = futures.pop(fut)
+                if budget is not None:
+                    submit()
+                try:
+                    found = fut.result()
+                except Exception as e:
+                    print(f"CR {cr} fetch error: {e}")
+                    continue
+                yield cr, found
+
+
+def publish_worker_scans(cr_list: List[int], id_map: Dict[int, str], id_thr: Dict[int, float], ctx: ScanContext):
+    """
+    Координатор: публикует проход в ctx.work (CR в порядке cr_list) сразу — воркеры начинают, пока
+    вызывающий занят своим. Возвращает (run_id, генератор (cr_id, found) в том виде, как iter_realm_scans).
+    Генератор закрывает проход сам, когда его дочитали; если до обхода не дошло — close_run за вызывающим.
+    ctx.budget: лимит запросов режет публикуемый список, лимит времени снимает ещё не взятые CR.
+    """
+    budget = ctx.budget
+    if budget is not None and budget.max_requests and len(cr_list) > budget.max_requests:
+        cr_list, budget.skipped = cr_list[:budget.max_requests], cr_list[budget.max_requests:]
+    if budget is not None:
+        budget.started = len(cr_list)
+    last_modified = {}
+    if ctx.snap_cache is not None:
+        last_modified = {cr: ctx.snap_cache.last_modified(cr) for cr in cr_list}
+    run_id = ctx.work.publish(REGION, dump_watch(id_map, id_thr, ctx.rules), cr_list, last_modified)
+    print(f"[WORK] run {run_id}: {len(cr_list)} CR published to {ctx.work.path}")
+    return run_id, _collect_worker_scans(run_id, len(cr_list), ctx)
+
+
+def _collect_worker_scans(run_id: str, total: int, ctx: ScanContext):
+    """
+    Отдаёт находки CR по мере того, как воркеры их сдают. Ждёт не дольше WORK_RUN_TIMEOUT_SEC
+    с публикации; несданные CR в этот проход не попадут. По дедлайну ctx.budget ещё не взятые
+    воркерами CR снимаются (в budget.skipped), взятые доигрываются.
+    """
+    work, budget = ctx.work, ctx.budget
+    deadline = time.time() + WORK_RUN_TIMEOUT_SEC
+    workers = set()
+    cancelled = budget is None or budget.deadline is None
+    try:
+        while True:
+            if not cancelled and time.time() >= budget.deadline:
+                cancelled = True
+                dropped = work.cancel_queued(run_id)
+                budget.skipped = dropped + budget.skipped
+                budget.started -= len(dropped)
+            for cr, res in work.collect(run_id):
+                workers.add(res["worker"])
+                found = res["found"]
+                if res["not_modified"]:
+                    # 304 у воркера — снапшот тот же, находки берём из своего кэша
+                    METRICS.add("not_modified")
+                    found = ctx.snap_cache.cached_found(cr)
+                else:
+                    METRICS.add("matches", len(found))
+                    if ctx.snap_cache is not None:
+                        ctx.snap_cache.store(cr, res["last_modified"], found)
+                if ctx.stats is not None:
+                    ctx.stats.observe(cr, found, res, res["last_modified"])
+                yield cr, found
+            left = work.pending(run_id)
+            if not left:
+                break
+            if time.time() > deadline:
+                print(f"[WARN] [WORK] run {run_id}: {left} CR not done in {WORK_RUN_TIMEOUT_SEC:.0f}s, skipped")
+                break
+            time.sleep(WORK_POLL_SEC)
+    finally:
+        summary = work.close_run(run_id)
+        print(f"[WORK] run {run_id}: {summary.get('done', 0)}/{total} CR done by {len(workers)} workers, "
+              f"{summary.get('failed', 0)} failed, {summary['re_leased']} re-leased")
+
+
+# ----------- ЭТАПЫ MAIN -----------
+def load_watchlist(token: str, item_cache: ItemCache):
+    """
+    Шаги 2–3: вотчлист (WATCHLIST_SOURCE) -> (id_map, id_thr, rules). Пустой вотчлист -> None.
+    rules — RuleIndex, если в листе есть варианты предметов или пороги по реалмам, иначе None.
+    Строки кэшируются по ревизии источника, резолв имён — в ItemCache: при неизменном листе
+    ни Google, ни Blizzard API не нужны.
+    """
+    source = watchlist_source()
+    with METRICS.span("sheet", source=source.kind):
+        rows = load_watch_rows(source)
+    if not rows:
+        return None
+    with METRICS.span("resolve_items"):
+        id_map, id_thr = resolve_items(token, rows, item_cache)
+        rules = compile_rules(rows, item_cache, id_map, id_thr)
+    return id_map, id_thr, rules
+
+
+def load_connected_realms(token: str, realm_cache: RealmCache) -> Tuple[str, List[int]]:
+    """
+    Шаг 4: список CR (индекс из кэша, пока свежий). При пустом ответе — одна повторная попытка
+    со свежим токеном; возвращаем и токен, т.к. он мог смениться.
+    """
+    if realm_cache.index_fresh():
+        return token, realm_cache.cr_list
     cr_list = get_connected_realms(token)
     if not cr_list:
-        print("⚠️ No EU connected realms fetched. Retrying with a fresh token…")
+        print(f"⚠️ No {REGION.upper()} connected realms fetched. Retrying with a fresh token…")
         time.sleep(2)
-        token = get_token(BLIZZARD_CLIENT_ID, BLIZZARD_CLIENT_SECRET)
+        token = get_token(BLIZZARD_CLIENT_ID, BLIZZARD_CLIENT_SECRET, force=True)
         cr_list = get_connected_realms(token)
-    
-    print(f"[DEBUG] EU connected realms: {len(cr_list)}")
+    if cr_list:
+        realm_cache.set_index(cr_list)
+    return token, cr_list
+
+
+def realm_watch(id_map: Dict[int, str], id_thr: Dict[int, float], item_cache: ItemCache):
+    """
+    Вотчлист для реалмовых аукционов: товары там не встречаются — по реалмам ищем только остальное.
+    """
+    if not SCAN_COMMODITIES:
+        return id_map, id_thr
+    realm_id_map = {i: n for i, n in id_map.items() if item_cache.kind(i) != "commodity"}
+    return realm_id_map, {i: t for i, t in id_thr.items() if i in realm_id_map}
+
+
+def scan_auctions(token: str, cr_list: List[int], realm_names_cache: Dict[int, List[str]],
+                  id_map: Dict[int, str], id_thr: Dict[int, float], item_cache: ItemCache,
+                  ctx: ScanContext = None, with_commodities: bool = SCAN_COMMODITIES,
+                  skip_unchanged: bool = False) -> Dict:
+    """
+    Шаг 6: региональные товары + все CR из cr_list.
+    Возвращает TopOffers: по каждому предмету K самых дешёвых CR и итоги по всем.
+    skip_unchanged — не включать находки, переиспользованные из кэша по 304 (для демона).
+    ctx — кэш снапшотов, история цен (одна транзакция на скан) и дифф лотов (ALERT_MODE=new);
+    с ctx.stats CR идут по убыванию ценности, с ctx.budget не влезшие в бюджет ждут следующего запуска.
+    С ctx.work CR сканируют воркеры (RUN_MODE=coordinator): здесь — товары, сводка и алерты.
+    """
+    ctx = ctx or ScanContext()
+    snap_cache, history, differ, alerts = ctx.snap_cache, ctx.history, ctx.differ, ctx.alerts
+    stats, budget = ctx.stats, ctx.budget
+    archive = ctx.archive if ctx.replay is None else None
+    grouped = TopOffers()
+    queued = set()  # предметы, алерты по которым уже в очереди
+    if snap_cache is not None:
+        snap_cache.begin_pass()
+    if history is not None:
+        history.begin_scan()
+    if archive is not None:
+        archive.begin_scan()
+
+    realm_scans = None
+    work_run_id = None
+    if ctx.work is not None and cr_list:
+        # воркеры берут CR сразу, а товары сканируем тем временем здесь; вотчлист для реалмов
+        # делим по видам предметов из кэша (выучены прошлыми проходами)
+        realm_id_map, realm_id_thr = realm_watch(id_map, id_thr, item_cache)
+        if realm_id_map:
+            if stats is not None:
+                cr_list = stats.order(cr_list)
+            work_run_id, realm_scans = publish_worker_scans(cr_list, realm_id_map, realm_id_thr, ctx)
+
+    try:
+        realm_id_map, realm_id_thr = id_map, id_thr
+        if with_commodities:
+            try:
+                found, seen = scan_commodities(token, id_map, id_thr, ctx)
+                for item_id in seen:
+                    item_cache.set_kind(item_id, "commodity")
+                if skip_unchanged and snap_cache is not None and "commodities" in snap_cache.unchanged:
+                    found = []
+                if found:
+                    grouped.add(f"Commodities ({REGION.upper()}, region-wide)", best_per_item(found))
+                    if alerts is not None:
+                        # товары по реалмам не ищем — их находки окончательные, шлём сразу
+                        queue_grouped_alerts(alerts, grouped, id_thr)
+                        queued.update(grouped.items)
+            except Exception as e:
+                print(f"Commodities fetch error: {e}")
+            try:
+                item_cache.save()
+            except Exception as e:
+                print(f"[WARN] Failed to save item cache: {e}")
+
+        if SCAN_COMMODITIES:
+            realm_id_map, realm_id_thr = realm_watch(id_map, id_thr, item_cache)
+            print(f"[INFO] Watchlist: {len(id_map) - len(realm_id_map)} commodities, {len(realm_id_map)} per-realm/unknown")
+
+        if realm_scans is None and cr_list and realm_id_map:
+            if stats is not None:
+                cr_list = stats.order(cr_list)
+            realm_scans = iter_realm_scans(token, cr_list, realm_id_map, realm_id_thr, ctx)
+        if realm_scans is not None:
+            for cr, found in realm_scans:
+                if skip_unchanged and str(cr) in snap_cache.unchanged:
+                    continue
+                if found:
+                    # красивое имя кластера реалмов
+                    realms_names = realm_names_cache.get(cr, [f"CR-{cr}"])
+                    realm_str = pretty_realms(realms_names)
+                    per_item = best_per_item(found)
+                    grouped.add(realm_str, per_item)
+                    if alerts is not None and ALERT_GROUP_BY == "realm":
+                        part = TopOffers()
+                        queued.update(part.add(realm_str, per_item))
+                        queue_grouped_alerts(alerts, part, id_thr)
+        elif cr_list:
+            print("[INFO] Watchlist contains only commodities; per-realm scan skipped.")
+        if alerts is not None:
+            queue_grouped_alerts(alerts, grouped, id_thr, skip=queued)
+    except BaseException:
+        if work_run_id is not None:
+            # генератор сборки мог так и не начаться — тогда его finally проход не закроет
+            ctx.work.close_run(work_run_id)
+        raise
+
+    if budget is not None and budget.skipped:
+        METRICS.add("realms_skipped", len(budget.skipped))
+        print(f"[INFO] Scan budget exhausted: {budget.started}/{len(cr_list)} CR scanned, "
+              f"{len(budget.skipped)} left for the next run")
+    if stats is not None:
+        stats.skipped(budget.skipped if budget is not None else ())
+        try:
+            stats.save()
+        except Exception as e:
+            print(f"[WARN] Failed to save realm stats: {e}")
+    if snap_cache is not None:
+        print(f"[INFO] Snapshots unchanged since last run (304, cached matches reused): {snap_cache.skipped}")
+        try:
+            snap_cache.save()
+        except Exception as e:
+            print(f"[WARN] Failed to save snapshot cache: {e}")
+    if history is not None:
+        try:
+            print(f"[INFO] Price history rows written: {history.flush()}")
+        except Exception as e:
+            print(f"[WARN] Failed to write price history: {e}")
+    if archive is not None:
+        try:
+            n = archive.flush()
+            print(f"[INFO] Snapshots archived: {n} ({archive.written / 1e6:.1f} MB compressed, new)")
+        except Exception as e:
+            print(f"[WARN] Failed to write snapshot archive: {e}")
+    if differ is not None:
+        n_new = sum(len(d["new"]) for d in differ.deltas.values())
+        n_gone = sum(len(d["removed"]) for d in differ.deltas.values())
+        print(f"[INFO] Watched lots since last snapshot: +{n_new} new, -{n_gone} removed")
+        try:
+            differ.save()
+        except Exception as e:
+            print(f"[WARN] Failed to save snapshot diff: {e}")
+    return grouped
+
+
+def format_item_alert(item_id: int, item_name: str, offers: TopOffers, id_thr: Dict[int, float]) -> str:
+    """
+    Блок алерта по одному предмету: порог, K самых дешёвых CR (дешёвые сверху), итог по всем CR, ссылка на wowhead.
+    """
+    key = (item_id, item_name)
+    agg = offers.items[key]
+    thr_show = int(id_thr.get(item_id, PRICE_THRESHOLD_G))
+    # с правилами порог свой у варианта/реалма — показываем диапазон по найденным лотам
+    if agg["thresholds"] is not None:
+        lo, hi = (t // COPPER_PER_GOLD for t in agg["thresholds"])
+        thr_show = f"{lo}" if lo == hi else f"{lo}–{hi}"
+    lines = [f"🔔 {item_name} (ID {item_id}) — порог ≤ {thr_show}g/шт"]
+
+    top = offers.offers(key)
+    for realm_str, rec in top:
+        price = human_price(rec["per_unit_copper"])
+        qty = rec["quantity"]
+        auc = rec.get("auction_id")
+        tleft = rec.get("time_left", "")
+        lines.append(f"- {price} • x{qty} • {realm_str} • auc {auc} • {tleft}")
+    if agg["realms"] > len(top):
+        lines.append(f"… и ещё {agg['realms'] - len(top)} CR; всего {agg['realms']} CR, x{agg['quantity']} по лучшим ценам")
+
+    # при желании: короткая ссылка на wowhead
+    lines.append(f"https://www.wowhead.com/item={item_id}")
+    return "\n".join(lines)
+
+
+def queue_grouped_alerts(alerts: AlertQueue, grouped: TopOffers, id_thr: Dict[int, float], skip: set = ()):
+    # порядок блоков — по предмету, а не по тому, какой поток скана первым принёс находку
+    for item_id, item_name in sorted(grouped.items):
+        if (item_id, item_name) not in skip:
+            alerts.put(format_item_alert(item_id, item_name, grouped, id_thr))
+
+
+def scan_region(token: str, watch, item_cache: ItemCache, alerts: AlertQueue = None, work: WorkQueue = None):
+    """
+    Шаги 4–6 для текущего REGION: connected realms, их имена, скан аукционов.
+    Возвращает группировку находок; None — не удалось получить список CR.
+    work — CR сканируют воркеры через общую очередь (RUN_MODE=coordinator), товары — здесь.
+    """
+    id_map, id_thr, rules = watch
+
+    # 4) берём все connected realms региона (индекс кэшируется на REALM_CACHE_TTL_HOURS)
+    realm_cache = RealmCache(force_refresh=REFRESH_REALM_CACHE)
+    with METRICS.span("realm_index"):
+        token, cr_list = load_connected_realms(token, realm_cache)
+
+    print(f"[DEBUG] {REGION.upper()} connected realms: {len(cr_list)}")
     if not cr_list:
         print("❌ Still empty after retry; Blizzard API/namespace may be acting up. Exit.")
+        return None
+
+
+    # 5) детализируем имена реалмов (локальный кэш, промахи — параллельно)
+    with METRICS.span("realm_details"):
+        realm_names_cache = fetch_realm_names(token, cr_list, realm_cache)
+    try:
+        realm_cache.save()
+    except Exception as e:
+        print(f"[WARN] Failed to save realm cache: {e}")
+    if rules is not None:
+        rules.bind_realms(realm_names_cache)
+
+
+    # 6) скан аукционов: региональные товары + по всем CR
+    snap_cache = SnapshotCache(id_map, id_thr, rules) if SNAPSHOT_CACHE else None
+    history = PriceHistory() if PRICE_HISTORY else None
+    differ = SnapshotDiff() if (SNAPSHOT_DIFF or ALERT_MODE == "new") else None
+    archive = SnapshotArchive() if SNAPSHOT_ARCHIVE else None
+    stats = RealmStats(watch_fingerprint(id_map, id_thr, rules)) if REALM_PRIORITY else None
+    with METRICS.span("scan_auctions", realms=len(cr_list)):
+        grouped = scan_auctions(token, cr_list, realm_names_cache, id_map, id_thr, item_cache,
+                                ScanContext(snap_cache, history, differ, alerts, rules, archive,
+                                            stats=stats, budget=ScanBudget.from_env(), work=work))
+    if history is not None:
+        with METRICS.span("price_history"):
+            history.prune()
+            history.close()
+    if archive is not None:
+        archive.prune()
+        archive.close()
+    return grouped
+
+
+def main():
+    if RUN_MODE == "replay":
+        return main_replay()
+    if RUN_MODE == "worker":
+        return main_worker()
+    if len(REGIONS) > 1:
+        if RUN_MODE != "coordinator":
+            return main_multi_region(REGIONS)
+        print(f"[WORK] coordinator mode is single-region; publishing {REGIONS[0].upper()}")
+    if REGIONS and REGIONS[0] != REGION:
+        configure_region(REGIONS[0])
+
+    METRICS.reset()
+    BLIZZARD.reset_stats()
+    # 1) токен
+    with METRICS.span("token"):
+        token = get_token(BLIZZARD_CLIENT_ID, BLIZZARD_CLIENT_SECRET)
+
+    # 2–3) читаем список предметов + индивидуальные пороги из Google Sheet,
+    #      резолвим в item_id и собираем два словаря (через локальный кэш предметов)
+    item_cache = ItemCache()
+    watch = load_watchlist(token, item_cache)
+    if not watch:
+        print("No item names in the sheet. Exit quietly.")
         return
 
+    # 4–6) скан; 7) уведомления уходят из очереди по ходу скана: товары — сразу, реалмы — по ALERT_GROUP_BY
+    alerts = AlertQueue()
+    work = WorkQueue() if RUN_MODE == "coordinator" else None
+    try:
+        grouped = scan_region(token, watch, item_cache, alerts, work)
+    finally:
+        shutdown_decode_pool()
+        if work is not None:
+            work.close()
+        with METRICS.span("telegram_drain"):
+            alerts.close()
+        report = METRICS.write(alerts=alerts.summary(), profile=MATCH_PROFILER.summary())
+    if grouped is None:
+        return
+    if grouped:
+        print(f"[TELEGRAM] {alerts.report()}")
+    else:
+        print("Nothing found; no notification sent.")
 
-    # 5) детализируем имена реалмов (кэш)
-    realm_names_cache: Dict[int, List[str]] = {}
-    for cr in cr_list:
+    print(f"[HTTP] {BLIZZARD.report()}")
+    print(f"[METRICS] {report['wall_sec']}s: "
+          + ", ".join(f"{stage} {st['sec']:.2f}s" for stage, st in report["stages"].items()))
+
+
+# ----------- MULTI-REGION -----------
+def region_worker(region: str, tasks, results, shards: int = 1):
+    """
+    Шард multi-region в отдельном процессе: свой регион, свой токен и API_LIMITER (модуль
+    импортируется заново — spawn), своё состояние в AH_STATE_DIR/<region>. Квота API_RATE_* —
+    на клиента, а не на процесс, поэтому лимитер шарда получает её 1/shards. Вотчлист приходит
+    через tasks (None — отбой). Алерты не шлёт: находки, выученные товары и отчёт HTTP уходят
+    родителю через results.
+    """
+    global API_LIMITER
+    configure_region(region, own_state_dir=True)
+    API_LIMITER = RateLimiter(API_RATE_PER_SEC / shards, API_RATE_PER_HOUR / shards)
+    watch = tasks.get()
+    if watch is None:
+        return
+    t0 = time.time()
+    METRICS.reset()
+    BLIZZARD.reset_stats()
+    try:
+        with METRICS.span("token"):
+            token = get_token(BLIZZARD_CLIENT_ID, BLIZZARD_CLIENT_SECRET)
+        item_cache = ItemCache(read_only=True)
         try:
-            detail = get_connected_realm_detail(token, cr)
-            # В некоторых ответах "realms" приходит как список словарей,
-            # в редких — попадаются строки/другие типы. Бережно обрабатываем.
-            realms = detail.get("realms", []) if isinstance(detail, dict) else []
-            names = []
-            for realm in realms:
-                if isinstance(realm, dict):
-                    name_dict = realm.get("name", {}) if isinstance(realm.get("name", {}), dict) else {}
-                    nm = (
-                        name_dict.get("en_GB") or  # в EU часто en_GB
-                        name_dict.get("en_US") or
-                        name_dict.get("ru_RU") or
-                        realm.get("slug")
-                    )
-                    if nm:
-                        names.append(nm)
-                # игнорируем строки/нестандартные элементы
-            realm_names_cache[cr] = names or [f"CR-{cr}"]
-        except Exception as e:
-            realm_names_cache[cr] = [f"CR-{cr}"]
-            print(f"realm detail failed for {cr}: {e}")
-        time.sleep(0.05)
+            grouped = scan_region(token, watch, item_cache) or TopOffers()
+        finally:
+            shutdown_decode_pool()
+        results.put((region, {
+            "grouped": grouped,
+            "commodities": item_cache.commodity_ids(),
+            "http": BLIZZARD.report(),
+            "wall_sec": round(time.time() - t0, 2),
+            "metrics": METRICS.write(profile=MATCH_PROFILER.summary()),
+        }, None))
+    except Exception as e:
+        results.put((region, None, f"{e.__class__.__name__}: {e}"))
 
 
-    # 6) скан аукционов по всем CR
-    # Группируем находки: (item_id, item_name) -> { realm_str -> rec }
-    grouped = {}
+def main_multi_region(regions: List[str]):
+    """
+    Multi-region: вотчлист резолвится один раз (общий кэш предметов), регионы сканируются
+    параллельно в процессах-шардах, находки сводятся в одну группировку и одну очередь алертов.
+    Шарды, не сдавшие результат за REGIONS_TIMEOUT_SEC, завершаются — алерты уходят по остальным.
+    """
+    # spawn, а не fork: у шарда должен быть свой HTTP-пул, токен и лимитер, без унаследованных сокетов.
+    # Стартуем сразу — импорт модуля в шардах идёт параллельно с чтением листа в родителе
+    t0 = time.time()
+    mp = multiprocessing.get_context("spawn")
+    results = mp.Queue()
+    tasks = {r: mp.Queue() for r in regions}
+    procs = {r: mp.Process(target=region_worker, args=(r, tasks[r], results, len(regions)), name=f"region-{r}")
+             for r in regions}
+    for p in procs.values():
+        p.start()
+
+    configure_region(regions[0])
+    METRICS.reset()
+    BLIZZARD.reset_stats()
+    watch = None
+    try:
+        with METRICS.span("token"):
+            token = get_token(BLIZZARD_CLIENT_ID, BLIZZARD_CLIENT_SECRET)
+        item_cache = ItemCache()
+        watch = load_watchlist(token, item_cache)
+    finally:
+        for q in tasks.values():
+            q.put(watch or None)
+    if not watch:
+        for p in procs.values():
+            p.join()
+        print("No item names in the sheet. Exit quietly.")
+        return
+    id_map, id_thr, _ = watch
 
-    for idx, cr in enumerate(cr_list, 1):
+    grouped = TopOffers()
+    shards: Dict[str, Dict] = {}
+    pending = set(regions)
+    deadline = t0 + REGIONS_TIMEOUT_SEC
+    while pending:
         try:
-            aj = get_auctions_for_connected_realm(token, cr)
-            found = check_items_in_auctions_per_item(aj, id_map, id_thr)
-
-            if found:
-                # красивое имя кластера реалмов
-                realms_names = realm_names_cache.get(cr, [f"CR-{cr}"])
-                realm_str = pretty_realms(realms_names)
-
-                # по одному предмету на этот connected realm оставим самый дешёвый per-unit и суммарный qty
-                per_item_best = {}  # item_id -> rec
-
-                for f in found:
-                    item_id = f.get("item_id")
-                    item_name = f["item_name"]
-                    price_copper = f["per_unit_copper"]
-                    qty = int(f["quantity"])
-                    auc = f.get("auction_id")
-                    time_left = str(f.get("time_left", ""))
-
-                    cur = per_item_best.get(item_id)
-                    if cur is None or price_copper < cur["per_unit_copper"]:
-                        per_item_best[item_id] = {
-                            "item_id": item_id,
-                            "item_name": item_name,
-                            "per_unit_copper": price_copper,
-                            "quantity": qty,
-                            "auction_id": auc,
-                            "time_left": time_left,
-                        }
-                    else:
-                        # если нашлась дороже — игнорируем, если такая же — докидываем количество
-                        if price_copper == cur["per_unit_copper"]:
-                            cur["quantity"] += qty
+            region, out, err = results.get(timeout=max(min(5.0, deadline - time.time()), 0.1))
+        except queue.Empty:
+            # шард упал, не успев ничего прислать
+            for r in [r for r in pending if not procs[r].is_alive()]:
+                print(f"[WARN] [{r.upper()}] worker exited with code {procs[r].exitcode}")
+                pending.discard(r)
+            if pending and time.time() >= deadline:
+                # зависший шард (сеть, дедлок) не должен держать алерты остальных регионов
+                for r in sorted(pending):
+                    print(f"[WARN] [{r.upper()}] no result in {REGIONS_TIMEOUT_SEC:.0f}s; terminating")
+                    procs[r].terminate()
+                pending.clear()
+            continue
+        pending.discard(region)
+        if err:
+            print(f"[WARN] [{region.upper()}] scan failed: {err}")
+            continue
+        shards[region] = out["metrics"]
+        # реалмы разных регионов могут называться одинаково — помечаем регионом
+        tag = region.upper()
+        grouped.merge(out["grouped"], lambda rs: rs if rs.startswith("Commodities") else f"{tag} · {rs}")
+        for item_id in out["commodities"]:
+            if item_id in id_map:
+                item_cache.set_kind(item_id, "commodity")
+        print(f"[{region.upper()}] {out['wall_sec']}s, {len(out['grouped'])} items matched | HTTP {out['http']}")
+    for p in procs.values():
+        p.join()
+    print(f"[INFO] Regions {', '.join(r.upper() for r in regions)} scanned in {time.time() - t0:.2f}s")
+    try:
+        item_cache.save()
+    except Exception as e:
+        print(f"[WARN] Failed to save item cache: {e}")
+
+    alerts = AlertQueue(regions=regions)
+    with METRICS.span("telegram_drain"):
+        queue_grouped_alerts(alerts, grouped, id_thr)
+        alerts.close()
+    # сводный отчёт — в AH_STATE_DIR, отчёты шардов — ещё и в их подпапках <region>/
+    METRICS.write(alerts=alerts.summary(), regions=shards)
+    if not grouped:
+        print("Nothing found; no notification sent.")
+        return
+    print(f"[TELEGRAM] {alerts.report()}")
 
-                # теперь покладём лучшую запись по каждому предмету в общую группировку
-                for item_id, rec in per_item_best.items():
-                    key = (item_id, rec["item_name"])
-                    bucket = grouped.setdefault(key, {})
-                    # если по этому connected realm уже есть запись — оставляем более дешёвую
-                    prev = bucket.get(realm_str)
-                    if (prev is None) or (rec["per_unit_copper"] < prev["per_unit_copper"]):
-                        bucket[realm_str] = rec
 
-            time.sleep(SLEEP_BETWEEN_REALMS_SEC)
+# ----------- WORKER -----------
+def work_run(work: WorkQueue, run_id: str, worker: str, token: str, watch, ctx: ScanContext) -> int:
+    """
+    Разбирает CR прохода run_id, пока есть что брать: SCAN_CONCURRENCY потоков, каждый по кругу
+    claim -> scan_realm -> complete. Сдаёт лучший лот на предмет и замеры CR для RealmStats координатора.
+    Кэш снапшотов воркера — только носитель Last-Modified от координатора: на 304 находки не нужны.
+    Возвращает число принятых CR.
+    """
+    id_map, id_thr, _ = watch
+
+    def loop() -> int:
+        n = 0
+        while True:
+            task = work.claim(run_id, worker)
+            if task is None:
+                return n
+            cr, last_modified = task
+            if ctx.snap_cache is not None:
+                ctx.snap_cache.seed(cr, last_modified)
+            try:
+                found = scan_realm(token, cr, id_map, id_thr, ctx)
+            except Exception as e:
+                print(f"CR {cr} fetch error: {e}")
+                work.fail(run_id, cr, worker, f"{e.__class__.__name__}: {e}")
+                continue
+            rec = METRICS.realms[str(cr)]
+            result = {
+                "worker": worker,
+                "found": list(best_per_item(found).values()),
+                "sec": rec["sec"],
+                "http_bytes": rec["http_bytes"],
+                "not_modified": rec["not_modified"],
+                "last_modified": ctx.snap_cache.last_modified(cr) if ctx.snap_cache is not None else None,
+            }
+            if work.complete(run_id, cr, worker, result):
+                n += 1
+            else:
+                print(f"[WORK] CR {cr}: lease taken over by another worker, result dropped")
+
+    threads = max(SCAN_CONCURRENCY, 1)
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        return sum(pool.map(lambda _: loop(), range(threads)))
+
+
+def main_worker():
+    """
+    RUN_MODE=worker: берёт CR текущего REGION из общей очереди WORK_QUEUE, пока координатор держит
+    проход открытым, и сканирует их тем же scan_realm — со своим токеном и HTTP-пулом. Вотчлист
+    и Last-Modified для 304 приходят из прохода; группировку и Telegram делает координатор.
+    API_LIMITER у каждого воркера свой: квоту клиента Blizzard делим между воркерами через API_RATE_*.
+    Выходит, если открытых проходов нет дольше WORK_IDLE_EXIT_SEC.
+    """
+    configure_region(REGIONS[0])
+    work = WorkQueue()
+    worker = WORK_WORKER_ID or f"{socket.gethostname()}:{os.getpid()}"
+    print(f"[WORK] worker {worker} on {work.path}")
+    run_id = None
+    idle_since = time.time()
+    try:
+        while True:
+            run = work.open_run(REGION)
+            if run is None:
+                if WORK_IDLE_EXIT_SEC and time.time() - idle_since > WORK_IDLE_EXIT_SEC:
+                    print(f"[WORK] no open runs for {WORK_IDLE_EXIT_SEC:.0f}s; exiting")
+                    return
+                time.sleep(WORK_POLL_SEC)
+                continue
+            idle_since = time.time()
+            if run[0] != run_id:
+                run_id = run[0]
+                watch = load_watch(run[1], ItemCache(read_only=True))
+                id_map, id_thr, rules = watch
+                ctx = ScanContext(SnapshotCache(id_map, id_thr, rules) if SNAPSHOT_CACHE else None, rules=rules)
+                METRICS.reset()
+                BLIZZARD.reset_stats()
+                done = 0
+            # токен кэшируется клиентом до истечения и обновляется сам на 401
+            token = get_token(BLIZZARD_CLIENT_ID, BLIZZARD_CLIENT_SECRET)
+            n = work_run(work, run_id, worker, token, watch, ctx)
+            if n:
+                done += n
+                print(f"[WORK] run {run_id}: {done} CR done by {worker}")
+                METRICS.write(profile=MATCH_PROFILER.summary())
+            # свободных CR нет — ждём просроченных аренд или закрытия прохода координатором
+            time.sleep(WORK_POLL_SEC)
+    finally:
+        shutdown_decode_pool()
+        work.close()
+
+
+# ----------- REPLAY -----------
+def parse_time_arg(value: str, default: float) -> float:
+    """
+    Unix-время или ISO-дата/время (без зоны — UTC): "1760000000", "2026-10-10", "2026-10-10T12:00".
+    """
+    if not value:
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    dt = datetime.fromisoformat(value)
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.timestamp()
 
-        except Exception as e:
-            print(f"CR {cr} fetch error: {e}")
-            time.sleep(1)
 
+class ReplayAlerts(AlertQueue):
+    """
+    Алерты replay: та же склейка блоков в сообщения, что и у AlertQueue, но без лимитеров
+    и без Telegram — готовые сообщения пишутся в out (None — stdout).
+    """
+    def __init__(self, scan_ts: int, out=None):
+        super().__init__(start=False)
+        self.header = f"🧭 Replay {time.strftime('%Y-%m-%d %H:%M', time.gmtime(scan_ts))} UTC ({REGION.upper()})\n"
+        self.buckets = []
+        self.linger = 3600  # копим до close(): проход архива целиком — одна пачка сообщений
+        self.out = out
+        self._thread.start()
 
+    def _deliver(self, text: str, stamps: List[float]):
+        print(text + "\n", file=self.out)
+        with self._lock:
+            self.stats["messages"] += 1
 
-    # 7) шлём уведомления, только если есть находки
-    # Отправляем: один предмет — одно сообщение со списком CR
-    if grouped:
-        header_tpl = "🧭 Найдены лоты (EU)\n"
-        # plain-text режим по умолчанию (USE_HTML = 0)
-        # если захочешь — включим HTML, но сейчас не надо
-
-        for (item_id, item_name), realms_map in grouped.items():
-            thr_show = int(id_thr.get(item_id, PRICE_THRESHOLD_G))
-            lines = [f"🔔 {item_name} (ID {item_id}) — порог ≤ {thr_show}g/шт"]
-
-            # сортируем кластеры по цене
-            entries = sorted(
-                realms_map.items(),
-                key=lambda kv: kv[1]["per_unit_copper"]
-            )
-            for realm_str, rec in entries:
-                price = human_price(rec["per_unit_copper"])
-                qty = rec["quantity"]
-                auc = rec.get("auction_id")
-                tleft = rec.get("time_left", "")
-                lines.append(f"- {price} • x{qty} • {realm_str} • auc {auc} • {tleft}")
-
-            # при желании: короткая ссылка на wowhead
-            lines.append(f"https://www.wowhead.com/item={item_id}")
-
-            msg = header_tpl + "\n".join(lines)
-
-            # режем на чанки, если вдруг очень длинно
-            parts = []
-            cur = ""
-            for ln in msg.split("\n"):
-                if len(cur) + len(ln) + 1 > 3500:
-                    parts.append(cur)
-                    cur = ln + "\n"
-                else:
-                    cur += ln + "\n"
-            if cur.strip():
-                parts.append(cur)
 
-            for part in parts:
-                send_telegram(part)
+def replay_region(watch, item_cache: ItemCache, since: float, until: float, out=None) -> Dict:
+    """
+    Прогон текущего REGION по архиву: каждый архивный проход — как отдельный скан (матчинг,
+    группировка, сообщения). Кэш снапшотов, история цен и дифф живого скана не трогаются;
+    при ALERT_MODE=new дифф ведётся в памяти от прохода к проходу.
+    """
+    id_map, id_thr, rules = watch
+    archive = SnapshotArchive()
+    passes = archive.passes(since, until)
+    print(f"[REPLAY] {REGION.upper()}: {len(passes)} archived scans in {archive.path}")
+    gaps = archive.gaps(since, until)
+    if gaps:
+        print(f"[WARN] [REPLAY] {sum(map(len, gaps.values()))} snapshots in {len(gaps)} scans were 304 "
+              f"with no archived body; those realms are missing from their scans")
+    realm_names_cache = {int(cr): names for cr, names in RealmCache().names.items()}
+    if rules is not None:
+        rules.bind_realms(realm_names_cache)
+    differ = SnapshotDiff(persist=False) if ALERT_MODE == "new" else None
+    totals = {"scans": 0, "snapshots": 0, "matched": 0, "alerts": 0, "messages": 0}
+    t0 = time.time()
+    try:
+        for scan_ts, snaps in passes:
+            if scan_ts in gaps:
+                print(f"[WARN] [REPLAY] scan {scan_ts}: not archived: {', '.join(gaps[scan_ts])}")
+            cr_list = [int(k) for k in snaps if k != "commodities"]
+            alerts = ReplayAlerts(scan_ts, out)
+            ctx = ScanContext(differ=differ, alerts=alerts, rules=rules, archive=archive, replay=snaps)
+            try:
+                grouped = scan_auctions(None, cr_list, realm_names_cache, id_map, id_thr, item_cache, ctx,
+                                        with_commodities=SCAN_COMMODITIES and "commodities" in snaps)
+            finally:
+                alerts.close()
+            st = alerts.summary()
+            totals["scans"] += 1
+            totals["snapshots"] += len(snaps)
+            totals["matched"] += len(grouped)
+            totals["alerts"] += st["blocks"]
+            totals["messages"] += st["messages"]
+    finally:
+        archive.close()
+    totals["sec"] = round(time.time() - t0, 2)
+    print(f"[REPLAY] {REGION.upper()}: {totals['scans']} scans, {totals['snapshots']} snapshots in {totals['sec']}s; "
+          f"{totals['matched']} item matches, {totals['alerts']} alerts -> {totals['messages']} messages")
+    return totals
+
+
+def main_replay():
+    """
+    RUN_MODE=replay: бэктест вотчлиста по архиву снапшотов (SNAPSHOT_ARCHIVE) за [REPLAY_FROM, REPLAY_UNTIL].
+    Квоту API не тратит: токен нужен только для резолва новых имён предметов (промахи кэша).
+    """
+    since = parse_time_arg(REPLAY_FROM, time.time() - 7 * 86400)
+    until = parse_time_arg(REPLAY_UNTIL, time.time())
+    token = get_token(BLIZZARD_CLIENT_ID, BLIZZARD_CLIENT_SECRET) if BLIZZARD_CLIENT_ID else None
+    item_cache = ItemCache()
+    watch = load_watchlist(token, item_cache)
+    if not watch:
+        print("No item names in the sheet. Exit quietly.")
+        return
+    out = open(REPLAY_OUTPUT, "w", encoding="utf-8") if REPLAY_OUTPUT else None
+    try:
+        for region in REGIONS:
+            # архивы multi-region лежат в подпапках регионов, как и остальное состояние шардов
+            configure_region(region, own_state_dir=len(REGIONS) > 1)
+            replay_region(watch, item_cache, since, until, out)
+    finally:
+        shutdown_decode_pool()
+        if out is not None:
+            out.close()
+
+
+# ----------- DAEMON -----------
+class RealmSchedule:
+    """
+    Учит период обновления снапшота каждого CR (и аукциона товаров) по Last-Modified
+    и планирует следующий опрос сразу после предсказанного обновления.
+    """
+    FILE = "realm_schedule.json"
+    HISTORY = 8  # сколько последних интервалов держим для медианы
+
+    def __init__(self):
+        self.realms: Dict[str, Dict] = load_state(self.FILE, {}).get("realms", {})
+
+    def period(self, key) -> float:
+        intervals = sorted((self.realms.get(str(key)) or {}).get("intervals", []))
+        if not intervals:
+            return DAEMON_DEFAULT_PERIOD_SEC
+        return intervals[len(intervals) // 2]
+
+    def next_poll(self, key) -> float:
+        return (self.realms.get(str(key)) or {}).get("next_poll", 0)
+
+    def observe(self, key, last_modified: str, now: float):
+        """
+        Отмечает результат опроса: новый Last-Modified — учим интервал и ждём следующего
+        обновления; тот же (304/ошибка) — повторяем с нарастающей паузой.
+        """
+        e = self.realms.setdefault(str(key), {})
+        ts = None
+        if last_modified:
+            try:
+                ts = parsedate_to_datetime(last_modified).timestamp()
+            except Exception:
+                ts = None
+        prev = e.get("last_modified_ts")
+        if ts is not None and ts != prev:
+            if prev and 0 < ts - prev < 6 * 3600:
+                e["intervals"] = (e.get("intervals", []) + [ts - prev])[-self.HISTORY:]
+            e["last_modified_ts"] = ts
+            e["misses"] = 0
+            e["next_poll"] = ts + self.period(key) + DAEMON_POLL_DELAY_SEC
+            if e["next_poll"] > now:
+                return
+        # снапшот ещё не обновился (или обновление по прогнозу уже просрочено) — пауза растёт
+        e["misses"] = e.get("misses", 0) + 1
+        e["next_poll"] = now + min(DAEMON_RETRY_SEC * 2 ** (e["misses"] - 1), DAEMON_MAX_RETRY_SEC)
+
+    def save(self):
+        save_state(self.FILE, {"realms": self.realms})
+
+
+def run_daemon():
+    """
+    Долгоживущий режим вокруг тех же этапов, что и main(): токен, HTTP-сессия, вотчлист,
+    резолв предметов и метаданные реалмов живут в памяти, а каждый CR опрашивается
+    вскоре после предсказанного обновления его снапшота. Алерты — только по обновившимся.
+    """
+    if len(REGIONS) > 1:
+        print(f"[DAEMON] multi-region is scan-mode only; polling {REGIONS[0].upper()}")
+    configure_region(REGIONS[0])
+    token = None
+    item_cache = ItemCache()
+    realm_cache = RealmCache(force_refresh=REFRESH_REALM_CACHE)
+    schedule = RealmSchedule()
+    history = PriceHistory() if PRICE_HISTORY else None
+    differ = SnapshotDiff() if (SNAPSHOT_DIFF or ALERT_MODE == "new") else None
+    archive = SnapshotArchive() if SNAPSHOT_ARCHIVE else None
+    alerts = AlertQueue()
+    id_map: Dict[int, str] = {}
+    id_thr: Dict[int, float] = {}
+    rules = None
+    watch_ts = 0.0
+    prune_ts = 0.0
+    snap_cache = None
+    stats = None
+    cr_list: List[int] = []
+    realm_names_cache: Dict[int, List[str]] = {}
 
-    else:
-        print("Nothing found; no notification sent.")
+    print("[DAEMON] started")
+    while True:
+        now = time.time()
+        METRICS.reset()
+        BLIZZARD.reset_stats()
+        try:
+            # токен кэшируется клиентом до истечения и обновляется сам на 401
+            token = get_token(BLIZZARD_CLIENT_ID, BLIZZARD_CLIENT_SECRET)
+
+            if now - prune_ts > DAEMON_PRUNE_SEC:
+                # демон живёт неделями — срок хранения соблюдаем по таймеру, а не только при старте
+                prune_ts = now
+                if archive is not None:
+                    try:
+                        archive.prune()
+                    except Exception as e:
+                        print(f"[WARN] Failed to prune snapshot archive: {e}")
+                if history is not None:
+                    try:
+                        history.prune()
+                    except Exception as e:
+                        print(f"[WARN] Failed to prune price history: {e}")
+
+            if now - watch_ts > DAEMON_WATCHLIST_REFRESH_SEC:
+                watch = load_watchlist(token, item_cache)
+                watch_ts = now
+                if not watch:
+                    print("[DAEMON] No item names in the sheet; waiting.")
+                elif snap_cache is None or watch_fingerprint(*watch) != snap_cache.watch_key:
+                    id_map, id_thr, rules = watch
+                    snap_cache = SnapshotCache(id_map, id_thr, rules)
+                    stats = RealmStats(snap_cache.watch_key) if REALM_PRIORITY else None
+                    if rules is not None:
+                        rules.bind_realms(realm_names_cache)
+                    print(f"[DAEMON] Watchlist loaded: {len(id_map)} items")
+
+            if not cr_list or not realm_cache.index_fresh():
+                with METRICS.span("realm_index"):
+                    token, cr_list = load_connected_realms(token, realm_cache)
+                with METRICS.span("realm_details"):
+                    realm_names_cache = fetch_realm_names(token, cr_list, realm_cache)
+                realm_cache.save()
+                if rules is not None:
+                    rules.bind_realms(realm_names_cache)
+
+            if id_map and cr_list:
+                keys = (["commodities"] if SCAN_COMMODITIES else []) + [str(cr) for cr in cr_list]
+                due = [k for k in keys if schedule.next_poll(k) <= now]
+                if due:
+                    due_crs = [int(k) for k in due if k != "commodities"]
+                    with METRICS.span("scan_auctions", realms=len(due_crs)):
+                        grouped = scan_auctions(token, due_crs, realm_names_cache, id_map, id_thr, item_cache,
+                                                ScanContext(snap_cache, history, differ, alerts, rules, archive,
+                                                            stats=stats),
+                                                with_commodities="commodities" in due, skip_unchanged=True)
+                    for k in due:
+                        schedule.observe(k, snap_cache.last_modified(k), now)
+                    schedule.save()
+                    print(f"[DAEMON] polled {len(due)} snapshots, "
+                          f"{len(due) - len(snap_cache.unchanged)} updated, {len(grouped)} items matched")
+                    if grouped:
+                        print(f"[TELEGRAM] {alerts.report()}")
+                    METRICS.write(alerts=alerts.summary(), profile=MATCH_PROFILER.summary())
+                wake = min(schedule.next_poll(k) for k in keys)
+            else:
+                wake = now + 60
+        except Exception as e:
+            print(f"[DAEMON] cycle failed: {e}")
+            wake = now + 30
 
+        time.sleep(min(max(wake - time.time(), 1.0), 60.0))
 
 
 if __name__ == "__main__":
-    main()
+    if RUN_MODE == "daemon":
+        run_daemon()
+    else:
+        main()